@@ -1,4 +1,9 @@
 import gzip
+import os
+import mmap
+import zlib
+import struct
+from bisect import bisect_right
 # import django
 
 
@@ -17,80 +22,301 @@ class FastaEntry:
         self.sequence = sequence
 
     def reverse_complement(self):
-        complements = {
-            "A": "T",
-            "a": "t",
-            "C": "G",
-            "c": "g",
-            "G": "C",
-            "g": "c",
-            "T": "A",
-            "t": "a",
-            "N": "N",
-            "n": "n",
-        }
-        result = list()
-
-        for i in range(len(self.sequence) - 1, -1, -1):
-            try:
-                result.append(complements[self.sequence[i]])
-            except IndexError:
-                error_message = (
-                    "Invalid character (%s) in the fasta sequence with header \n"
-                    "%s" % (self.sequence[i], self.header)
-                )
-                raise IOError(error_message)
-        self.sequence = "".join(result)
+        invalid = self.sequence.translate(_VALID_NUCLEOTIDES)
+        if invalid:
+            error_message = (
+                "Invalid character (%s) in the fasta sequence with header \n"
+                "%s" % (invalid[0], self.header)
+            )
+            raise IOError(error_message)
+        self.sequence = self.sequence.translate(_COMPLEMENTS)[::-1]
 
     def __str__(self):
         chunk_size = 50  # Do not change this!
         result_list = [">" + self.header]
-        sequence_size = len(self.sequence)
-        number_of_remaining_letters = sequence_size
-        number_of_processed_letters = 0
-
-        while number_of_remaining_letters > 0:
-            if number_of_remaining_letters <= chunk_size:
-                result_list.append(self.sequence[number_of_processed_letters:])
-                number_of_remaining_letters = 0
-                number_of_processed_letters = sequence_size
-            else:
-                new_number_of_processed_letters = (
-                    number_of_processed_letters + chunk_size
-                )
-                result_list.append(
-                    self.sequence[
-                        number_of_processed_letters:new_number_of_processed_letters
-                    ]
-                )
-                number_of_remaining_letters -= chunk_size
-                number_of_processed_letters = new_number_of_processed_letters
-
+        result_list.extend(
+            self.sequence[i:i + chunk_size]
+            for i in range(0, len(self.sequence), chunk_size)
+        )
         return "\n".join(result_list)
 
 
+def reverse_complement_batch(entries):
+    """
+    Reverse complements the sequences of many FastaEntry objects in place.
+    All sequences are translated and reversed together as one bytes object.
+    """
+    entries = list(entries)
+    if not entries:
+        return entries
+    joined = "\n".join(entry.sequence for entry in entries).encode()
+    invalid = joined.translate(None, _VALID_NUCLEOTIDE_BYTES + b"\n")
+    if invalid:
+        bad_character = chr(invalid[0])
+        header = next(e.header for e in entries if bad_character in e.sequence)
+        raise IOError(
+            "Invalid character (%s) in the fasta sequence with header \n"
+            "%s" % (bad_character, header)
+        )
+    sequences = joined.translate(_COMPLEMENT_BYTES)[::-1].split(b"\n")
+    for entry, sequence in zip(entries, reversed(sequences)):
+        entry.sequence = sequence.decode()
+    return entries
+
+
+def write_fasta(file, entries, buffer_size=1 << 22):
+    """
+    Writes FastaEntry objects to a fasta file (gzip-compressed if the name ends with .gz),
+    with 50 nts per line, as in FastaEntry.__str__.
+    Output is assembled as bytes and written in blocks of about buffer_size bytes.
+    """
+    chunk_size = 50
+    myopen = gzip.open if file.endswith(".gz") else open
+    with myopen(file, "wb") as f:
+        buffer, buffered = [], 0
+        for entry in entries:
+            sequence = entry.sequence.encode()
+            lines = [b">" + entry.header.encode()]
+            lines.extend(
+                sequence[i:i + chunk_size] for i in range(0, len(sequence), chunk_size)
+            )
+            record = b"\n".join(lines) + b"\n"
+            buffer.append(record)
+            buffered += len(record)
+            if buffered >= buffer_size:
+                f.write(b"".join(buffer))
+                buffer, buffered = [], 0
+        f.write(b"".join(buffer))
+
+
+_COMPLEMENT_PAIRS = ("ACGTNacgtn", "TGCANtgcan")
+_COMPLEMENTS = str.maketrans(*_COMPLEMENT_PAIRS)
+_VALID_NUCLEOTIDES = str.maketrans("", "", _COMPLEMENT_PAIRS[0])
+_COMPLEMENT_BYTES = bytes.maketrans(*(pair.encode() for pair in _COMPLEMENT_PAIRS))
+_VALID_NUCLEOTIDE_BYTES = _COMPLEMENT_PAIRS[0].encode()
+
+
 ############################################################################################
 
 
+def is_bgzf(file):
+    """
+    Tells if the given file is compressed with blocked gzip (bgzip),
+    which allows random access to the uncompressed data.
+    """
+    with open(file, "rb") as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+class BgzfReader:
+    """
+    Random access to the uncompressed data of a blocked gzip file.
+    The block offsets are kept in a .gzi file next to the compressed file,
+    in the same format as bgzip / samtools.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.f = open(file, "rb")
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.compressed_offsets, self.uncompressed_offsets = self._load_blocks()
+        self._block_cache = (None, b"")
+
+    def _load_blocks(self):
+        gzi_file = self.file + ".gzi"
+        if os.path.exists(gzi_file) and os.path.getmtime(gzi_file) >= os.path.getmtime(self.file):
+            with open(gzi_file, "rb") as f:
+                (count,) = struct.unpack("<Q", f.read(8))
+                pairs = struct.unpack("<%dQ" % (2 * count), f.read(16 * count))
+            return [0] + list(pairs[0::2]), [0] + list(pairs[1::2])
+
+        compressed_offsets, uncompressed_offsets = [], []
+        position, uncompressed = 0, 0
+        while position < len(self.data):
+            (block_size,) = struct.unpack("<H", self.data[position + 16:position + 18])
+            block_end = position + block_size + 1
+            (data_size,) = struct.unpack("<I", self.data[block_end - 4:block_end])
+            if data_size:
+                compressed_offsets.append(position)
+                uncompressed_offsets.append(uncompressed)
+            uncompressed += data_size
+            position = block_end
+        if not compressed_offsets:
+            compressed_offsets, uncompressed_offsets = [0], [0]
+
+        try:
+            with open(gzi_file, "wb") as f:
+                f.write(struct.pack("<Q", len(compressed_offsets) - 1))
+                for pair in zip(compressed_offsets[1:], uncompressed_offsets[1:]):
+                    f.write(struct.pack("<QQ", *pair))
+        except OSError:
+            pass
+        return compressed_offsets, uncompressed_offsets
+
+    def _block(self, i):
+        if self._block_cache[0] != i:
+            position = self.compressed_offsets[i]
+            (block_size,) = struct.unpack("<H", self.data[position + 16:position + 18])
+            (extra_length,) = struct.unpack("<H", self.data[position + 10:position + 12])
+            payload = self.data[position + 12 + extra_length:position + block_size + 1 - 8]
+            self._block_cache = (i, zlib.decompress(payload, -15))
+        return self._block_cache[1]
+
+    def read(self, start, stop):
+        """
+        Returns the uncompressed bytes from start to stop.
+        """
+        result = []
+        i = bisect_right(self.uncompressed_offsets, start) - 1
+        while start < stop and i < len(self.compressed_offsets):
+            block = self._block(i)
+            block_start = self.uncompressed_offsets[i]
+            result.append(block[start - block_start:stop - block_start])
+            start = block_start + len(block)
+            i += 1
+        return b"".join(result)
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+
 class FastaFile:
     """
     This object is used to read fasta files into FastaEntry objects.
     For writing fasta files, we only need FastaEntry objects and using
     their str function, we can convert them to string and write to files.
     Note that it can be used as a context manager as well.
+
+    Iterating gives the entries in file order.
+    Indexing with a header, e.g. fasta["ENST0001"], reads only that entry,
+    using a .fai index (built and saved next to the file on first use).
+    Random access works for uncompressed and blocked gzip (bgzip) files.
     """
 
+    block_size = 1 << 22
+
     def __init__(self, file):
         myopen = open
         if file.endswith(".gz"):
             myopen = gzip.open
         if file:
-            self.f = myopen(file, "rt")
+            self.f = myopen(file, "rb")
         else:
-            self.f = stdin
+            self.f = stdin.buffer
+
+        self.file = file
+        self._entries = None
+        self._index = None
+        self._reader = None
+
+    #####################################################
 
-        self.current_header = ""
-        self.current_sequence = list()
+    def is_indexable(self):
+        """
+        Tells if entries can be read by header without reading the whole file.
+        """
+        return bool(self.file) and (not self.file.endswith(".gz") or is_bgzf(self.file))
+
+    #####################################################
+
+    def index(self):
+        """
+        Returns the .fai index of the file as a dictionary:
+        header -> (sequence length, offset, bases per line, bytes per line).
+        Offsets are in uncompressed coordinates.
+        """
+        if self._index is not None:
+            return self._index
+
+        fai_file = self.file + ".fai"
+        if os.path.exists(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(self.file):
+            self._index = dict()
+            with open(fai_file) as f:
+                for line in f:
+                    name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+                    self._index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+            return self._index
+
+        self._index = self._build_index()
+        try:
+            with open(fai_file, "w") as f:
+                for name, values in self._index.items():
+                    f.write("\t".join(map(str, (name,) + values)) + "\n")
+        except OSError:
+            pass
+        return self._index
+
+    def _build_index(self):
+        myopen = gzip.open if self.file.endswith(".gz") else open
+        index = dict()
+        name = None
+        position = 0
+
+        def add_entry():
+            if name is None:
+                return
+            if irregular:
+                raise ValueError(
+                    "Lines of %s in %s have different lengths, it cannot be indexed."
+                    % (name, self.file)
+                )
+            index[name] = (length, offset, line_bases, line_width)
+
+        with myopen(self.file, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    add_entry()
+                    name = (line[1:].decode().split())[0]
+                    offset = position + len(line)
+                    length, line_bases, line_width = 0, 0, 0
+                    last_line_short, irregular = False, False
+                else:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if name is not None and bases:
+                        if not line_bases:
+                            line_bases, line_width = bases, len(line)
+                        elif last_line_short or bases > line_bases:
+                            irregular = True
+                        last_line_short = bases < line_bases
+                        length += bases
+                    elif name is not None and length:
+                        last_line_short = True
+                position += len(line)
+        add_entry()
+        return index
+
+    def _read(self, start, stop):
+        if self._reader is None:
+            if self.file.endswith(".gz"):
+                self._reader = BgzfReader(self.file)
+            else:
+                self._raw = open(self.file, "rb")
+                self._reader = mmap.mmap(self._raw.fileno(), 0, access=mmap.ACCESS_READ)
+        if isinstance(self._reader, BgzfReader):
+            return self._reader.read(start, stop)
+        return self._reader[start:stop]
+
+    def fetch(self, header):
+        """
+        Reads the entry with the given header, using the index.
+        """
+        length, offset, line_bases, line_width = self.index()[header]
+        if length == 0:
+            return FastaEntry(header=header, sequence="")
+        full_lines, remainder = divmod(length, line_bases)
+        raw = self._read(offset, offset + full_lines * line_width + remainder)
+        sequence = raw.replace(b"\n", b"").replace(b"\r", b"").decode()
+        return FastaEntry(header=header, sequence=sequence)
+
+    #####################################################
+
+    def keys(self):
+        return self.index().keys()
+
+    def __contains__(self, header):
+        return header in self.index()
 
     #####################################################
 
@@ -104,39 +330,65 @@ class FastaFile:
 
     ######################################################
 
-    def __getitem__(self, index):
+    def __iter__(self):
+        if self._entries is None:
+            self._entries = self._parse()
+        return self._entries
 
-        for raw_line in self.f:
-            line = raw_line.strip()
-            if not line:
+    def _parse(self):
+        """
+        Reads the file in large blocks and splits them on record boundaries,
+        so that sequence lines are never handled one by one in Python.
+        """
+        pending = []
+        first = True
+        for block in iter(lambda: self.f.read(self.block_size), b""):
+            if b">" not in block:
+                pending.append(block)
                 continue
+            pending.append(block)
+            records = b"".join(pending).split(b"\n>")
+            pending = [records.pop()]
+            for record in records:
+                entry = self._parse_record(record, first)
+                first = False
+                if entry is not None:
+                    yield entry
 
-            if line[0] == ">":
-                if not self.current_header:
-                    self.current_header = (line[1:].split())[0]
-                    self.current_sequence = list()
-                else:
-                    this_entry = FastaEntry(
-                        header=self.current_header,
-                        sequence="".join(self.current_sequence),
-                    )
-                    self.current_header = (line[1:].split())[0]
-                    self.current_sequence = list()
-                    return this_entry
-            else:
-                self.current_sequence.append(line)
+        record = b"".join(pending)
+        if record.strip():
+            entry = self._parse_record(record, first)
+            if entry is not None:
+                yield entry
 
-        # this returns the last entry
-        if len(self.current_sequence) > 0:
-            this_entry = FastaEntry(
-                header=self.current_header, sequence="".join(self.current_sequence)
-            )
-            self.current_sequence = list()
-            return this_entry
+    @staticmethod
+    def _parse_record(record, first):
+        if first:
+            # Anything before the first header is skipped
+            if not record.startswith(b">"):
+                return None
+            record = record[1:]
+        header, _, sequence = record.partition(b"\n")
+        return FastaEntry(
+            header=(header.decode().split())[0],
+            sequence=sequence.translate(None, b" \t\r\n").decode(),
+        )
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            return self.fetch(index)
 
-        raise IndexError
+        try:
+            return next(iter(self))
+        except StopIteration:
+            raise IndexError
 
     #########################################################
 
     def __del__(self):
         self.f.close()
+        if isinstance(self._reader, BgzfReader):
+            self._reader.close()
+        elif self._reader is not None:
+            self._reader.close()
+            self._raw.close()
@@ -1,51 +1,17 @@
 import ribopy
 from ribopy import Ribo
-from functions import get_cds_range_lookup, get_asite_offset, get_psite_offset
+from functions import get_cds_range_lookup, get_offset_report, get_offsets, get_file_fingerprint
+from functions_coverage import get_transcript_layout, compute_coverages, DEFAULT_FLANK
+from coverage_store import (create_coverage_store, add_experiment, get_completed_experiments, export_pickle,
+                            import_pickle, is_coverage_store)
 import numpy as np
-import multiprocessing
-import time
-import pickle
 import logging
-import math
-import gzip
+import shutil
+import os
+import sys
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-print("yipee")
-
-# Function to process a single transcript and return coverage
-def process_transcript(transcript, exp, min_len, max_len, alias, cds_range, offset, ribo_path):
-    try:
-        # Initialize a new Ribo object within the worker process
-        if alias == True:
-            ribo_object = Ribo(ribo_path, alias=ribopy.api.alias.apris_human_alias)
-        else:
-            ribo_object = Ribo(ribo_path)
-        
-        start, stop = cds_range[transcript]
-
-        coverages = []
-        for i in range(min_len, max_len + 1): 
-            if offset[i] <= start:
-                coverage = ribo_object.get_coverage(experiment=exp, range_lower=i, range_upper=i, alias=alias)\
-                           [transcript][start - offset[i] : stop - offset[i]]
-                coverages.append(coverage)
-            else:
-                coverage = ribo_object.get_coverage(experiment=exp, range_lower=i, range_upper=i, alias=alias)\
-                           [transcript][: stop - offset[i]]
-                coverage = np.concatenate((np.zeros(offset[i] - start), coverage))
-                coverages.append(coverage)
-                
-        coverage = sum(coverages, np.zeros_like(coverages[0]))
-        
-        return transcript, coverage
-    except Exception as e:
-        logging.error(f"Error processing transcript {transcript}: {e}")
-        return transcript, None
-
-# Wrapper function to pass to multiprocessing.Pool.imap_unordered
-def process_wrapper(args):
-    return process_transcript(*args)
 
 if __name__ == '__main__':
     try:
@@ -55,6 +21,12 @@ if __name__ == '__main__':
         alias_int = int(input('Enter 1 for mouse or 2 for other: '))
         ribo_path = input('Enter ribo file path, e.g., \'/home/all.ribo\': ')
         offset_mode = int(input('Enter 1 for P-site Offset, Enter 2 for A-site Offset'))
+        output_format = int(input('Enter 1 to save as coverage store or 2 to save as gzipped pickle: '))
+        build_mode = int(input('Enter 1 to start a new build, 2 to resume an interrupted build or 3 to append new experiments: '))
+        # Per-read-length coverage lets other offsets or read lengths be applied later without reading the ribo file again
+        flank = None
+        if output_format == 1 and int(input('Enter 1 to also keep the coverage of each read length or 2 to not: ')) == 1:
+            flank = DEFAULT_FLANK
         if alias_int == 1:
             alias = True
             ribo_object = Ribo(ribo_path, alias=ribopy.api.alias.apris_human_alias)
@@ -62,31 +34,74 @@ if __name__ == '__main__':
             alias = False
             ribo_object = Ribo(ribo_path)
         cds_range = get_cds_range_lookup(ribo_object)
+        layout = get_transcript_layout(ribo_object, cds_range)
+        cds_offsets = np.zeros(len(layout['names']) + 1, dtype=np.int64)
+        np.cumsum(layout['cds_stop'] - layout['cds_start'], out=cds_offsets[1:])
+
+        # Every finished experiment is checkpointed in a coverage store.
+        # For pickle output, the store is exported and removed once all experiments are done.
+        if output_format == 1:
+            output_file = 'coverage'
+            store_path = output_file
+        else:
+            output_file = 'coverage.pkl.gz'
+            store_path = output_file + '.checkpoint'
+
+        parameters = {'min_len': min_len, 'max_len': max_len, 'offset_mode': offset_mode, 'alias': alias}
+        if flank is not None:
+            parameters['flank'] = flank
+        ribo_fingerprint = get_file_fingerprint(ribo_path)
+        if build_mode == 1:
+            create_coverage_store(store_path, layout['names'], cds_offsets, parameters, ribo_fingerprint)
+            completed = []
+        else:
+            imported = False
+            if not is_coverage_store(store_path):
+                if build_mode == 3 and output_format != 1 and os.path.exists(output_file):
+                    imported = True
+                else:
+                    raise ValueError(f"There is no build to {'resume' if build_mode == 2 else 'append to'}: "
+                                     f"{store_path if build_mode == 2 or output_format == 1 else output_file} does not exist.")
+            try:
+                if imported:
+                    # A finished pickle file has no checkpoint left, so the experiments to append to are read back from it.
+                    # The pickle file does not record its read lengths, organism and offset, so these are taken as given.
+                    # Its transcripts are in the order their coverage was finished, so they are put in reference order.
+                    logging.warning(f"Appending to {output_file} assuming it was built with {parameters}.")
+                    import_pickle(output_file, store_path, parameters, ribo_fingerprint, names=layout['names'])
+                completed = get_completed_experiments(store_path, layout['names'], cds_offsets, parameters,
+                                                      ribo_fingerprint, append=(build_mode == 3))
+            except Exception:
+                # The pickle file is left as it is, so a checkpoint imported from it is removed to let a rerun import it again
+                if imported:
+                    shutil.rmtree(store_path, ignore_errors=True)
+                raise
+            for exp in completed:
+                logging.info(f"Skipping {exp}, already in {store_path}.")
+        experiments = [exp for exp in ribo_object.experiments if exp not in completed]
 
-        all_coverage_dict = {}
-        for exp in ribo_object.experiments:
-            logging.info(f"Starting {exp}...")
-            coverage_dict = {}
-            if offset_mode == 1:
-                offset = get_psite_offset(ribo_object, exp, min_len, max_len)
-            if offset_mode == 2:
-                offset = get_asite_offset(ribo_object, exp, min_len, max_len)
+        # Offsets of all experiments from one metagene, reused from the sidecar file next to the ribo file on reruns
+        offsets = {}
+        if experiments:
+            offset_report = get_offset_report(ribo_object, ribo_path, experiments, min_len, max_len)
+            logging.info(f"Offsets:\n{offset_report.to_string()}")
+            for exp in experiments:
+                offsets[exp] = get_offsets(offset_report, exp, {1: 'psite', 2: 'asite'}[offset_mode])
 
-            # Parallelize transcript processing
-            with multiprocessing.Pool() as pool:
-                for transcript, coverage in pool.imap_unordered(
-                        process_wrapper,
-                        [(t, exp, min_len, max_len, alias, cds_range, offset, ribo_path) for t in ribo_object.transcript_names]
-                    ):
-                    # Accumulate the coverage for each transcript in the dictionary
-                    coverage_dict[transcript] = coverage
-            all_coverage_dict[exp] = coverage_dict
+        for exp, coverage, *length_coverage in compute_coverages(ribo_path, alias, layout, offsets, min_len, max_len,
+                                                                 experiments, flank=flank):
+            add_experiment(store_path, exp, coverage,
+                           metadata={'offset': {int(i): int(offset) for i, offset in offsets[exp].items()},
+                                     'ribo': ribo_fingerprint},
+                           length_coverage=length_coverage[0] if length_coverage else None, min_len=min_len, flank=flank)
+            logging.info(f"Finished {exp}.")
 
-        output_file = 'coverage.pkl.gz'
-        with gzip.open(output_file, 'wb') as f:
-            pickle.dump(all_coverage_dict, f)
+        if output_format != 1:
+            export_pickle(store_path, output_file, ribo_object.experiments)
+            shutil.rmtree(store_path)
 
         logging.info(f"Saved as {output_file}.")
 
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
\ No newline at end of file
+        logging.error(f"An error occurred: {e}")
+        sys.exit(1)
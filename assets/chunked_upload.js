@@ -0,0 +1,56 @@
+// Streams files selected with a button of class chunked-upload to the /upload route of codon_heatmap_v4.py
+// in chunks, so that large ribo and coverage files are never held in memory by the browser or the server.
+// The button's data-kind attribute names the dropdown to select the file in once the upload is complete.
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+
+    function setProps(id, props) {
+        if (window.dash_clientside && window.dash_clientside.set_props) {
+            window.dash_clientside.set_props(id, props);
+        }
+    }
+
+    function uploadFile(file, kind) {
+        var statusId = kind + '-upload-status';
+        var offset = 0;
+
+        function sendChunk() {
+            var chunk = file.slice(offset, offset + CHUNK_SIZE);
+            var url = '/upload?name=' + encodeURIComponent(file.name) + '&offset=' + offset + '&total=' + file.size;
+            return fetch(url, {method: 'POST', body: chunk}).then(function (response) {
+                if (!response.ok) {
+                    return response.text().then(function (text) { throw new Error(text); });
+                }
+                return response.json();
+            }).then(function (result) {
+                offset += chunk.size;
+                if (!result.complete) {
+                    setProps(statusId, {children: 'Uploading ' + file.name + ': ' + Math.floor(100 * offset / file.size) + '%'});
+                    return sendChunk();
+                }
+                setProps(statusId, {children: 'Uploaded ' + file.name + '.'});
+                setProps('uploaded-file', {data: {kind: kind, path: result.path}});
+            });
+        }
+
+        setProps(statusId, {children: 'Uploading ' + file.name + ': 0%'});
+        sendChunk().catch(function (error) {
+            setProps(statusId, {children: 'Upload of ' + file.name + ' failed: ' + error.message});
+        });
+    }
+
+    document.addEventListener('click', function (event) {
+        var button = event.target.closest && event.target.closest('.chunked-upload');
+        if (!button) {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.addEventListener('change', function () {
+            if (input.files.length) {
+                uploadFile(input.files[0], button.getAttribute('data-kind'));
+            }
+        });
+        input.click();
+    });
+})();
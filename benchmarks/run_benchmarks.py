@@ -0,0 +1,205 @@
+import os
+import sys
+import gc
+import json
+import time
+import gzip
+import pickle
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from ribopy import Ribo
+from Fasta import FastaFile
+from functions import get_cds_range_lookup, get_sequence, compute_offset_report, get_offsets
+from functions_coverage import get_transcript_layout, get_experiment_coverage
+from functions_codon import get_codon_occupancy
+from functions_filter import get_filtered_transcripts, get_filtered_zscores
+from functions_heatmap_v4 import (find_common_stall_sites, get_stall_codon_matrix, create_raw_heatmap,
+                                  normalize_heatmap, sweep_stall_sites)
+from synthetic import PRESETS, LENGTH_MIN, LENGTH_MAX, make_dataset
+
+# Stored results of each preset, compared against by default
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+# Percentile of the stall site stages; lower than the app default so that the synthetic data has stall sites
+PERCENTILE = 95
+
+def get_usable_cpus():
+    """
+    Returns the number of CPUs this process may run on, which containers and batch schedulers may limit below os.cpu_count().
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def measure(function, repeat=3):
+    """
+    Measures the best wall time of repeat calls of function, and the peak memory allocated during one more call
+    traced with tracemalloc, which covers Python objects and NumPy arrays but not memory allocated by HDF5.
+
+    Returns:
+        tuple: The result of the function, the time in seconds and the peak memory in MB.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(times), peak / 2 ** 20
+
+def get_stages(paths, preset, with_ribo):
+    """
+    Returns the benchmark stages as (name, function(inputs)) pairs. Each function reads the results of earlier stages
+    from inputs and returns its own result, which is added to inputs under the stage name.
+    """
+    config = PRESETS[preset]
+    experiments = [f'exp{e}' for e in range(config['num_experiments'])]
+
+    def load_coverage(inputs):
+        with gzip.open(paths['coverage'], 'rb') as f:
+            return pickle.load(f)
+
+    stages = [('fasta_parse', lambda inputs: sum(len(entry.sequence) for entry in FastaFile(paths['reference'])))]
+    if with_ribo:
+        stages += [
+            ('get_sequence', lambda inputs: get_sequence(inputs['ribo_object'], paths['reference'], False)),
+            ('offset_report', lambda inputs: compute_offset_report(inputs['ribo_object'], experiments, LENGTH_MIN, LENGTH_MAX)),
+            ('coverage', lambda inputs: get_experiment_coverage(inputs['ribo_object'], experiments[0], LENGTH_MIN, LENGTH_MAX,
+                                                                get_transcript_layout(inputs['ribo_object'], inputs['cds_range']),
+                                                                get_offsets(inputs['offset_report'], experiments[0], 'psite'))),
+        ]
+    stages += [
+        ('load_coverage', load_coverage),
+        ('codon_occupancy', lambda inputs: get_codon_occupancy(inputs['load_coverage'], inputs['sequence'], inputs['cds_range'], 2)),
+        ('filter_transcripts', lambda inputs: get_filtered_transcripts(inputs['load_coverage'], experiments, config['num_top'])),
+        ('zscores', lambda inputs: {exp: get_filtered_zscores(inputs['load_coverage'], inputs['filter_transcripts'], exp)
+                                    for exp in experiments}),
+        ('stall_sites', lambda inputs: find_common_stall_sites(experiments, inputs['load_coverage'], inputs['filter_transcripts'],
+                                                               PERCENTILE, zscores=inputs['zscores'])),
+        ('stall_codon_matrix', lambda inputs: get_stall_codon_matrix(inputs['stall_sites'], inputs['sequence'], inputs['cds_range'])),
+        ('raw_heatmap', lambda inputs: create_raw_heatmap(inputs['stall_codon_matrix'])),
+        ('normalize_heatmap', lambda inputs: normalize_heatmap(inputs['raw_heatmap'], inputs['sequence'], inputs['cds_range'],
+                                                               inputs['filter_transcripts'])),
+        ('percentile_sweep', lambda inputs: sweep_stall_sites(experiments, inputs['load_coverage'], inputs['filter_transcripts'],
+                                                              list(range(80, 100)), inputs['sequence'], inputs['cds_range'],
+                                                              inputs['zscores'])),
+    ]
+    return stages
+
+def run_benchmarks(preset, data_dir, repeat=3, with_ribo=True, stages=None):
+    """
+    Generates (or reuses) the synthetic data of a preset and measures each benchmark stage.
+
+    Returns:
+        dict: 'preset', 'machine' and 'stages', mapping stage name to its 'seconds' and 'peak_mb'.
+    """
+    logging.info(f"Preparing {preset} data in {data_dir}...")
+    paths = make_dataset(data_dir, preset, with_ribo=with_ribo)
+    transcriptome = paths['transcriptome']
+    inputs = {'sequence': dict(zip(transcriptome['names'], transcriptome['sequences']))}
+    if with_ribo:
+        inputs['ribo_object'] = Ribo(paths['ribo'])
+        inputs['cds_range'] = get_cds_range_lookup(inputs['ribo_object'])
+    else:
+        inputs['cds_range'] = transcriptome['cds_range']
+
+    results = {}
+    for name, function in get_stages(paths, preset, with_ribo):
+        # Stages that are not selected still run once to provide the inputs of later stages
+        if stages and name not in stages:
+            inputs[name] = function(inputs)
+            continue
+        inputs[name], seconds, peak_mb = measure(lambda: function(inputs), repeat)
+        results[name] = {'seconds': round(seconds, 4), 'peak_mb': round(peak_mb, 1)}
+        logging.info(f"{name}: {seconds:.3f} s, {peak_mb:.1f} MB")
+
+    return {
+        'preset': preset,
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'numpy': np.__version__, 'cpu_count': os.cpu_count(), 'usable_cpus': get_usable_cpus()},
+        'stages': results,
+    }
+
+def compare_results(results, baseline, tolerance):
+    """
+    Prints the results next to the baseline and returns the stages that are slower or use more memory
+    than the baseline by more than the tolerance factor. Times are not compared if the baseline was recorded
+    with a different number of CPUs, as the coverage extraction runs on all of them.
+    """
+    regressions = []
+    compare_times = True
+    if baseline:
+        cpus = {key: results['machine'].get(key) for key in ('cpu_count', 'usable_cpus')}
+        baseline_cpus = {key: baseline.get('machine', {}).get(key, cpus[key]) for key in cpus}
+        if cpus != baseline_cpus:
+            logging.warning(f"The baseline was recorded with {baseline_cpus['usable_cpus']} of {baseline_cpus['cpu_count']} CPUs, "
+                            f"this machine has {cpus['usable_cpus']} of {cpus['cpu_count']}; only peak memory is compared.")
+            compare_times = False
+    print(f"{'stage':<20}{'seconds':>10}{'baseline':>10}{'ratio':>8}{'peak MB':>10}{'baseline':>10}{'ratio':>8}")
+    for name, result in results['stages'].items():
+        base = baseline.get('stages', {}).get(name) if baseline else None
+        if base is None:
+            print(f"{name:<20}{result['seconds']:>10.3f}{'-':>10}{'-':>8}{result['peak_mb']:>10.1f}{'-':>10}{'-':>8}")
+            continue
+        # Ratios of very short or very small stages are dominated by noise, so they are floored at 50 ms and 1 MB
+        time_ratio = max(result['seconds'], 0.05) / max(base['seconds'], 0.05)
+        memory_ratio = max(result['peak_mb'], 1.0) / max(base['peak_mb'], 1.0)
+        flag = ' <' if (compare_times and time_ratio > tolerance) or memory_ratio > tolerance else ''
+        print(f"{name:<20}{result['seconds']:>10.3f}{base['seconds']:>10.3f}{time_ratio:>8.2f}"
+              f"{result['peak_mb']:>10.1f}{base['peak_mb']:>10.1f}{memory_ratio:>8.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Measures the time and peak memory of the analysis stages on synthetic data.')
+    parser.add_argument('--preset', choices=list(PRESETS), default='tiny', help='Transcriptome size (default: tiny).')
+    parser.add_argument('--data-dir', help='Directory of the synthetic data, generated on first use. '
+                                           'Defaults to ribopy_benchmarks/<preset> in the temporary directory.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each stage; the best is reported (default: 3).')
+    parser.add_argument('--no-ribo', action='store_true', help='Skip generating the ribo file and the stages that read it.')
+    parser.add_argument('--stages', nargs='+', help='Stages to measure (default: all).')
+    parser.add_argument('--output', help='Save the results as JSON at this path.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline JSON to compare with (default: benchmarks/baseline.json).')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Report a regression when time or peak memory exceeds the baseline by this factor (default: 1.5).')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the baseline of the preset.')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), 'ribopy_benchmarks', args.preset)
+    results = run_benchmarks(args.preset, data_dir, args.repeat, not args.no_ribo, args.stages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    regressions = compare_results(results, baselines.get(args.preset), args.tolerance)
+
+    if args.update_baseline:
+        baselines[args.preset] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=1)
+            f.write('\n')
+        logging.info(f"Saved the {args.preset} baseline to {args.baseline}.")
+    elif regressions:
+        logging.error(f"Regressions compared to the baseline: {', '.join(regressions)}")
+        sys.exit(1)
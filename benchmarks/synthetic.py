@@ -0,0 +1,193 @@
+import os
+import gzip
+import pickle
+import h5py
+import numpy as np
+import pandas as pd
+from ribopy.create import create_ribo
+from ribopy.merge import merge_ribo_files
+
+# Transcriptome sizes of the benchmark presets; yeast and mouse approximate the number and lengths of their coding transcripts
+PRESETS = {
+    'tiny': {'num_transcripts': 300, 'cds_codons': 300, 'num_experiments': 3, 'reads_per_transcript': 40, 'num_top': 100},
+    'yeast': {'num_transcripts': 6000, 'cds_codons': 450, 'num_experiments': 3, 'reads_per_transcript': 40, 'num_top': 1000},
+    'mouse': {'num_transcripts': 22000, 'cds_codons': 550, 'num_experiments': 3, 'reads_per_transcript': 40, 'num_top': 2000},
+}
+
+# Read length range of the synthetic ribo files
+LENGTH_MIN = 26
+LENGTH_MAX = 35
+
+def make_transcriptome(num_transcripts, cds_codons=450, seed=0):
+    """
+    Generates random transcripts with a 5' UTR, a CDS starting with ATG and ending with a stop codon, and a 3' UTR.
+
+    Parameters:
+        num_transcripts (int): Number of transcripts.
+        cds_codons (int): Mean number of codons of a CDS. CDS lengths are drawn from a gamma distribution.
+        seed (int): Seed of the random number generator.
+
+    Returns:
+        dict: 'names' (list), 'sequences' (list of str), 'lengths' (np.ndarray) and
+              'cds_range' (dict mapping transcript to CDS range (start, stop), as from get_cds_range_lookup()).
+    """
+    rng = np.random.default_rng(seed)
+    utr5 = rng.integers(20, 200, num_transcripts)
+    codons = np.maximum(rng.gamma(2.0, cds_codons / 2.0, num_transcripts).astype(np.int64), 20)
+    utr3 = rng.integers(50, 400, num_transcripts)
+    lengths = utr5 + 3 * codons + utr3
+
+    names = [f'TX{i:06d}' for i in range(num_transcripts)]
+    nucleotides = np.frombuffer(b'ACGT', dtype=np.uint8)
+    sequence = nucleotides[rng.integers(0, 4, int(lengths.sum()))]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    sequences = []
+    cds_range = {}
+    for name, start, length, u5, n in zip(names, starts, lengths, utr5, codons):
+        seq = sequence[start:start + length].copy()
+        seq[u5:u5 + 3] = np.frombuffer(b'ATG', dtype=np.uint8)
+        seq[u5 + 3 * n - 3:u5 + 3 * n] = np.frombuffer(b'TAA', dtype=np.uint8)
+        sequences.append(seq.tobytes().decode())
+        cds_range[name] = (int(u5), int(u5 + 3 * n))
+    return {'names': names, 'sequences': sequences, 'lengths': lengths, 'cds_range': cds_range}
+
+def write_reference_fasta(path, transcriptome, line_width=60):
+    """
+    Writes the transcripts of make_transcriptome() as a FASTA file.
+    """
+    with open(path, 'w') as f:
+        for name, seq in zip(transcriptome['names'], transcriptome['sequences']):
+            f.write(f'>{name}\n')
+            f.write('\n'.join(seq[i:i + line_width] for i in range(0, len(seq), line_width)))
+            f.write('\n')
+
+def make_reads(transcriptome, reads_per_transcript, seed=0):
+    """
+    Generates ribosome footprints in BED format. Expression follows a gamma distribution; footprints are placed on codons
+    of the CDS with a peak at the start codon, and their 5' ends lie 12 to 14 nucleotides upstream of the P-site
+    depending on the read length, so that offsets can be calibrated from the start site metagene.
+
+    Returns:
+        DataFrame: BED columns of the footprints, sorted by transcript and position.
+    """
+    rng = np.random.default_rng(seed)
+    names = transcriptome['names']
+    cds = np.array([transcriptome['cds_range'][name] for name in names], dtype=np.int64)
+    expression = rng.gamma(0.5, 2.0, len(names))
+    reads = rng.poisson(reads_per_transcript * expression / expression.mean())
+    transcript = np.repeat(np.arange(len(names)), reads)
+
+    num_codons = (cds[transcript, 1] - cds[transcript, 0]) // 3
+    codon = (rng.random(len(transcript)) * num_codons).astype(np.int64)
+    codon[rng.random(len(transcript)) < 0.05] = 0
+    length = rng.integers(LENGTH_MIN, LENGTH_MAX + 1, len(transcript))
+    start = cds[transcript, 0] + 3 * codon - (12 + (length - LENGTH_MIN) // 4)
+    end = start + length
+    valid = (start >= 0) & (end <= transcriptome['lengths'][transcript])
+
+    order = np.lexsort((start[valid], transcript[valid]))
+    return pd.DataFrame({
+        'name': np.array(names, dtype=object)[transcript[valid][order]],
+        'start': start[valid][order],
+        'end': end[valid][order],
+        'read': 'read',
+        'score': 0,
+        'strand': '+',
+    })
+
+def make_ribo(path, transcriptome, num_experiments=3, reads_per_transcript=40, seed=0):
+    """
+    Creates a ribo file with coverage of num_experiments experiments (exp0, exp1, ...) of synthetic footprints.
+
+    Parameters:
+        path (str): Path of the ribo file. Annotation and intermediate files are written to its directory.
+        transcriptome (dict): Transcripts from make_transcriptome().
+        num_experiments (int): Number of experiments.
+        reads_per_transcript (int): Mean number of footprints per transcript and experiment.
+        seed (int): Seed of the random number generator.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    lengths_path = os.path.join(directory, 'lengths.tsv')
+    annotation_path = os.path.join(directory, 'annotation.bed')
+    pd.DataFrame({'name': transcriptome['names'], 'length': transcriptome['lengths']}).to_csv(
+        lengths_path, sep='\t', header=False, index=False)
+    with open(annotation_path, 'w') as f:
+        for name, length in zip(transcriptome['names'], transcriptome['lengths']):
+            start, stop = transcriptome['cds_range'][name]
+            f.write(f'{name}\t0\t{start}\tUTR5\t0\t+\n{name}\t{start}\t{stop}\tCDS\t0\t+\n{name}\t{stop}\t{length}\tUTR3\t0\t+\n')
+
+    parts = []
+    for e in range(num_experiments):
+        bed_path = os.path.join(directory, f'exp{e}.bed')
+        make_reads(transcriptome, reads_per_transcript, seed + e).to_csv(bed_path, sep='\t', header=False, index=False)
+        part = os.path.join(directory, f'exp{e}.ribo')
+        with h5py.File(part, 'w') as handle:
+            create_ribo(handle, f'exp{e}', bed_path, 'synthetic', lengths_path, annotation_path,
+                        50, 35, 10, LENGTH_MIN, LENGTH_MAX, store_coverage=True)
+        os.remove(bed_path)
+        parts.append(part)
+
+    if os.path.exists(path):
+        os.remove(path)
+    merge_ribo_files(path, parts)
+    for part in parts:
+        os.remove(part)
+
+def make_coverage_dict(transcriptome, num_experiments=3, seed=0):
+    """
+    Generates adjusted coverage as from adj_coverage.py without a ribo file. Replicates share the expression of each
+    transcript and a set of stall sites with increased coverage, so that common stall sites can be found.
+
+    Returns:
+        dict: {Experiment : {Transcript : Adjusted coverage array of the CDS}}
+    """
+    rng = np.random.default_rng(seed)
+    names = transcriptome['names']
+    cds_lengths = np.array([stop - start for start, stop in (transcriptome['cds_range'][name] for name in names)])
+    expression = rng.gamma(0.5, 2.0, len(names))
+    offsets = np.concatenate(([0], np.cumsum(cds_lengths)))
+    rate = np.repeat(expression, cds_lengths)
+    stalls = rng.random(offsets[-1]) < 0.002
+    rate[stalls] *= 20
+
+    coverage_dict = {}
+    for e in range(num_experiments):
+        flat = rng.poisson(rate).astype(np.float64)
+        coverage_dict[f'exp{e}'] = {name: flat[offsets[i]:offsets[i + 1]] for i, name in enumerate(names)}
+    return coverage_dict
+
+def make_dataset(directory, preset='yeast', seed=0, with_ribo=True):
+    """
+    Generates the files of a benchmark preset in a directory, unless they already exist:
+    reference.fa, coverage.pkl.gz and, if with_ribo, all.ribo.
+
+    Returns:
+        dict: Paths of the 'reference', 'coverage' and 'ribo' files and the 'transcriptome'.
+    """
+    config = PRESETS[preset]
+    os.makedirs(directory, exist_ok=True)
+    transcriptome = make_transcriptome(config['num_transcripts'], config['cds_codons'], seed)
+    paths = {
+        'reference': os.path.join(directory, 'reference.fa'),
+        'coverage': os.path.join(directory, 'coverage.pkl.gz'),
+        'ribo': os.path.join(directory, 'all.ribo'),
+        'transcriptome': transcriptome,
+    }
+    if not os.path.exists(paths['reference']):
+        write_reference_fasta(paths['reference'], transcriptome)
+    if not os.path.exists(paths['coverage']):
+        with gzip.open(paths['coverage'], 'wb') as f:
+            pickle.dump(make_coverage_dict(transcriptome, config['num_experiments'], seed), f)
+    if with_ribo and not os.path.exists(paths['ribo']):
+        make_ribo(paths['ribo'], transcriptome, config['num_experiments'], config['reads_per_transcript'], seed)
+    return paths
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Generates a synthetic ribo file, coverage pickle and reference FASTA.')
+    parser.add_argument('directory', help='Output directory.')
+    parser.add_argument('--preset', choices=list(PRESETS), default='yeast', help='Transcriptome size (default: yeast).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random number generator (default: 0).')
+    parser.add_argument('--no-ribo', action='store_true', help='Only generate the coverage pickle and reference FASTA.')
+    args = parser.parse_args()
+    make_dataset(args.directory, args.preset, args.seed, not args.no_ribo)
@@ -3,262 +3,275 @@ from dash import dcc, html
 from dash.dependencies import Input, Output, State
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import pickle
 import numpy as np
-import ribopy
-from ribopy import Ribo
-from functions import get_cds_range_lookup, get_sequence
-from functions_filter import get_filtered_transcripts, get_filtered_zscores
-from functions_heatmap_v4 import find_common_stall_sites, collect_stall_sequences, create_raw_heatmap, normalize_heatmap, get_heatmap_df, get_stall_sites_df
-import base64
-import io
-import tempfile
+from functions_app import DATA_DIR, list_data_files, resolve_data_path, save_upload_chunk
+from functions_jobs import JobRunner
+from flask import request, jsonify, send_file
+from functions_heatmap_v4 import generate_heatmap_sweep
 import traceback
 import os
-import pandas as pd
 
 app = dash.Dash(__name__)
+runner = JobRunner()
 
-app.layout = html.Div([
-    html.H1("Heatmap", style={'margin-left': '25px'}),
-    html.Div([
+# Percentiles of the slider, computed in one sweep with the heatmaps of the entered percentile
+SWEEP_PERCENTILES = [80, 85, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 99.5, 99.9]
+
+@app.server.route('/upload', methods=['POST'])
+def upload_chunk():
+    try:
+        path, complete = save_upload_chunk(request.args['name'], int(request.args['offset']),
+                                           int(request.args['total']), request.stream)
+    except (KeyError, ValueError) as e:
+        return str(e), 400
+    return jsonify(path=path, complete=complete)
+
+def file_selector(kind, label):
+    """
+    Dropdown of the files of a kind in the data directory, with a chunked upload into the data directory.
+    """
+    return html.Div([
+        html.Label(f'Select {label}:', style={'margin-left': '25px'}),
+        dcc.Dropdown(
+            id=f'{kind}-path',
+            options=list_data_files(kind),
+            placeholder=f'File in {DATA_DIR}',
+            style={'width': '90%', 'margin-left': '10px'}
+        ),
+        html.Button('Upload file', className='chunked-upload', style={'margin-left': '25px', 'margin-top': '5px'},
+                    **{'data-kind': kind}),
+        html.Div(id=f'{kind}-upload-status', style={'margin-left': '25px'}),
+    ], style={'flex': '1', 'margin-right': '20px'})
+
+def serve_layout():
+    # Built on every page load so that the dropdowns list the current files of the data directory
+    return html.Div([
+        html.H1("Heatmap", style={'margin-left': '25px'}),
         html.Div([
-            html.Label('Upload ribo file:', style={'margin-left': '25px'}),
-            dcc.Upload(
-                id='upload-ribo-file',
-                children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                style={
-                    'width': '80%',
-                    'height': '60px',
-                    'lineHeight': '60px',
-                    'borderWidth': '1px',
-                    'borderStyle': 'dashed',
-                    'borderRadius': '5px',
-                    'textAlign': 'center',
-                    'margin-left': '20px'
-                },
-                multiple=False
-            )
-        ], style={'flex': '1', 'margin-right': '20px'}),
+            file_selector('ribo', 'ribo file'),
+            file_selector('coverage', 'coverage file'),
+            file_selector('reference', 'reference file'),
+        ], style={'display': 'flex', 'justify-content': 'space-between', 'margin-left': '25px'}),
+        html.Button('Refresh files', id='refresh_files', n_clicks=0, style={'margin-left': '50px', 'margin-top': '10px'}),
+        dcc.Store(id='uploaded-file'),
         html.Div([
-            html.Label('Upload pickle file:', 
+            html.Label('Select organism: ', 
                         style={'margin-left': '25px'}),
-            dcc.Upload(
-                id='upload-pickle-file',
-                children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                style={
-                    'width': '80%',
-                    'height': '60px',
-                    'lineHeight': '60px',
-                    'borderWidth': '1px',
-                    'borderStyle': 'dashed',
-                    'borderRadius': '5px',
-                    'textAlign': 'center',
-                    'margin-left': '20px'
-                },
-                multiple=False
-            )
-        ], style={'flex': '1', 'margin-right': '20px'}),
+            dcc.Dropdown(
+                id='organism',
+                options=[
+                    {'label': 'Mouse', 'value': 1},
+                    {'label': 'Other', 'value': 2},
+                ],
+                value=1,
+                style={'width': '99%', 'margin-left': '10px'}
+            ),
+        ], style={'margin-top': '20px'}),
         html.Div([
-            html.Label('Upload reference file:', 
+            html.Label('Enter a list of replicates of an experimental condition, separated by a space. To look at multiple conditions, separate by new line.',
                         style={'margin-left': '25px'}),
-            dcc.Upload(
-                id='upload-reference-file',
-                children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                style={
-                    'width': '80%',
-                    'height': '60px',
-                    'lineHeight': '60px',
-                    'borderWidth': '1px',
-                    'borderStyle': 'dashed',
-                    'borderRadius': '5px',
-                    'textAlign': 'center',
-                    'margin-left': '20px'
-                },
-                multiple=False
-            )
-        ], style={'flex': '1'})
-    ], style={'display': 'flex', 'justify-content': 'space-between', 'margin-left': '25px'}),
-    html.Div([
-        html.Label('Select organism: ', 
-                    style={'margin-left': '25px'}),
-        dcc.Dropdown(
-            id='organism',
-            options=[
-                {'label': 'Mouse', 'value': 1},
-                {'label': 'Other', 'value': 2},
-            ],
-            value=1,
-            style={'width': '99%', 'margin-left': '10px'}
-        ),
-    ], style={'margin-top': '20px'}),
-    html.Div([
-        html.Label('Enter a list of replicates of an experimental condition, separated by a space. To look at multiple conditions, separate by new line.',
-                    style={'margin-left': '25px'}),
-        html.P('Example input:', 
-                style={'margin-left': '50px', 'padding': '0'}),
-        html.P('Control_1 Control_2 Control_3',
-                style={'margin-left': '50px', 'line-height': '0.25'}),
-        html.P('Mutant_1 Mutant_2 Mutant_3', 
-                style={'margin-left': '50px', 'line-height': '0.1'}),
-        dcc.Textarea(id='experiments', style={'margin-left': '25px', 'width': '97%', 'height': '100px'}),
-    ], style={'margin-top': '20px'}),
-    html.Div([
-        html.Label('Enter number of transcripts to use, determined by the number of reads per nucleotide within the coding region: ', 
-                style={'margin-left': '25px'}),
-        dcc.Input(id='num_transcripts', type='number', value=100, style={'width': '4%'}),
-        html.P('If there is more than one experiment, the intersection of transcripts will be used.',
-            style={'margin-left': '25px', 'margin-top': '0px'}),
-    ], style={'margin-top': '20px'}), 
-    html.Div([
-        html.Label('Enter percentile threshold for determining stall sites (0 to 100): ',
+            html.P('Example input:', 
+                    style={'margin-left': '50px', 'padding': '0'}),
+            html.P('Control_1 Control_2 Control_3',
+                    style={'margin-left': '50px', 'line-height': '0.25'}),
+            html.P('Mutant_1 Mutant_2 Mutant_3', 
+                    style={'margin-left': '50px', 'line-height': '0.1'}),
+            dcc.Textarea(id='experiments', style={'margin-left': '25px', 'width': '97%', 'height': '100px'}),
+        ], style={'margin-top': '20px'}),
+        html.Div([
+            html.Label('Enter number of transcripts to use, determined by the number of reads per nucleotide within the coding region: ', 
                     style={'margin-left': '25px'}),
-        dcc.Input(id='percentile', type='number', value=99, style={'width': '3%'}),
-    ], style={'margin-top': '20px'}),
-    html.Button('Generate Heatmap', id='generate_button', n_clicks=0, style={'margin-left': '25px', 'margin-top': '20px'}),
-    dcc.Loading(
-        id="loading",
-        children=[html.Div(id='heatmap_output')],
-        type="default",
+            dcc.Input(id='num_transcripts', type='number', value=100, style={'width': '4%'}),
+            html.P('If there is more than one experiment, the intersection of transcripts will be used.',
+                style={'margin-left': '25px', 'margin-top': '0px'}),
+        ], style={'margin-top': '20px'}), 
+        html.Div([
+            html.Label('Enter percentile threshold for determining stall sites (0 to 100): ',
+                        style={'margin-left': '25px'}),
+            dcc.Input(id='percentile', type='number', value=99, style={'width': '3%'}),
+        ], style={'margin-top': '20px'}),
+        html.Button('Generate Heatmap', id='generate_button', n_clicks=0, style={'margin-left': '25px', 'margin-top': '20px'}),
+        html.Button('Cancel', id='cancel_button', n_clicks=0, style={'margin-left': '10px', 'margin-top': '20px'}),
+        dcc.Store(id='job-id'),
+        dcc.Interval(id='job-poll', interval=1000, disabled=True),
+        html.Div(id='job_status', style={'margin-left': '25px', 'margin-top': '10px'}),
+        html.Div([
+            html.Label('Percentile threshold:', style={'margin-left': '25px'}),
+            dcc.Slider(id='sweep_percentile', min=0, max=100, step=None, marks={}),
+            html.Div(id='sweep_counts', style={'margin-left': '25px'}),
+        ], id='sweep_controls', style={'display': 'none'}),
+        html.Div(id='heatmap_output')
+    ])
+
+app.layout = serve_layout
+
+@app.callback(
+    Output('ribo-path', 'options'),
+    Output('coverage-path', 'options'),
+    Output('reference-path', 'options'),
+    Output('ribo-path', 'value'),
+    Output('coverage-path', 'value'),
+    Output('reference-path', 'value'),
+    Input('refresh_files', 'n_clicks'),
+    Input('uploaded-file', 'data'),
+    prevent_initial_call=True
+)
+def refresh_files(n_clicks, uploaded_file):
+    options = [list_data_files(kind) for kind in ('ribo', 'coverage', 'reference')]
+    values = [dash.no_update] * 3
+    # Select a file as soon as its upload is complete
+    if dash.ctx.triggered_id == 'uploaded-file' and uploaded_file:
+        values[['ribo', 'coverage', 'reference'].index(uploaded_file['kind'])] = uploaded_file['path']
+    return *options, *values
+
+def make_heatmap_figure(all_norm_heatmaps, experiments):
+    """
+    Plots the normalized heatmaps of all experimental conditions side by side on a common color scale.
+    """
+    # Calculate global zmin and zmax; heatmaps without stall sites are all NaN
+    all_z_values = np.concatenate([norm_heatmap.values.flatten() for norm_heatmap in all_norm_heatmaps])
+    all_z_values = all_z_values[~np.isnan(all_z_values)]
+    zmin, zmax = (np.min(all_z_values), np.max(all_z_values)) if len(all_z_values) else (None, None)
+
+    # Create a subplot figure
+    fig = make_subplots(
+        rows=1, cols=len(all_norm_heatmaps),
+        subplot_titles=[f"Heatmap for {replicates[0]}" for replicates in experiments]
+    )
+
+    # Add each heatmap to the subplot
+    for i, norm_heatmap in enumerate(all_norm_heatmaps):
+        heatmap = go.Heatmap(
+            z=norm_heatmap.values,
+            x=norm_heatmap.columns,
+            y=norm_heatmap.index,
+            colorscale='Viridis',
+            zmin=zmin,
+            zmax=zmax
+        )
+        fig.add_trace(heatmap, row=1, col=i+1)
+
+    # Update layout settings for each subplot
+    for i in range(len(all_norm_heatmaps)):
+        fig.update_xaxes(tickfont=dict(size=10), dtick=1, row=1, col=i+1)
+        fig.update_yaxes(tickfont=dict(size=8), row=1, col=i+1)
+
+    fig.update_layout(
+        height=850,
+        width=(1400/len(all_norm_heatmaps)) * len(all_norm_heatmaps),
+        title_text="Combined Heatmaps"
     )
-])
+    return fig
+
+@app.server.route('/jobs/<job_id>/codon_heatmaps.xlsx')
+def download_heatmaps(job_id):
+    return send_file(os.path.abspath(runner.job_path(job_id, 'codon_heatmaps.xlsx')), as_attachment=True)
 
 @app.callback(
+    Output('job-id', 'data'),
+    Output('job-poll', 'disabled'),
     Output('heatmap_output', 'children'),
     Input('generate_button', 'n_clicks'),
-    State('upload-ribo-file', 'contents'),
-    State('upload-ribo-file', 'filename'),
-    State('upload-pickle-file', 'contents'),
-    State('upload-pickle-file', 'filename'),
-    State('upload-reference-file', 'contents'),
-    State('upload-reference-file', 'filename'),
+    State('ribo-path', 'value'),
+    State('coverage-path', 'value'),
+    State('reference-path', 'value'),
     State('organism', 'value'),
     State('experiments', 'value'),
     State('num_transcripts', 'value'),
-    State('percentile', 'value')
+    State('percentile', 'value'),
+    prevent_initial_call=True
 )
-def update_heatmap(n_clicks, ribo_content, ribo_filename, pickle_content, pickle_filename, ref_content, ref_filename, organism, experiments_str, num_transcripts, percentile):
-    if n_clicks > 0:
-        # Set alias based on organism
-        alias = True if organism == 1 else False
-        
-        # Parse experiments input
-        experiments = []
-        for replicates_str in experiments_str.split('\n'):
-            if replicates_str:
-                replicates = replicates_str.split(' ')
-                experiments.append(replicates)
-        
-        # Decode ribo file
-        content_type, content_string = ribo_content.split(',')
-        decoded = base64.b64decode(content_string)
-        try:
-            # Create a temporary file for ribo file
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(decoded)
-                temp_file_path = temp_file.name
-            
-            if alias == True:
-                ribo_object = Ribo(temp_file_path, alias=ribopy.api.alias.apris_human_alias)
-            else: 
-                ribo_object = Ribo(temp_file_path)
-            cds_range = get_cds_range_lookup(ribo_object)
-        except Exception as e:
-            traceback.print_exc()
-            return html.Div('Invalid ribo file.', style={'color': 'red'})
+def update_heatmap(n_clicks, ribo_path, coverage_path, reference_path, organism, experiments_str, num_transcripts, percentile):
+    # Set alias based on organism
+    alias = True if organism == 1 else False
 
+    # Parse experiments input
+    experiments = []
+    for replicates_str in (experiments_str or '').split('\n'):
+        if replicates_str:
+            replicates = replicates_str.split(' ')
+            experiments.append(replicates)
+    if not experiments:
+        return dash.no_update, True, html.Div('Enter the experiments.', style={'color': 'red'})
+
+    # Files are opened in place in the data directory
+    paths = []
+    for path, name in ((ribo_path, 'ribo'), (coverage_path, 'coverage'), (reference_path, 'reference')):
         try:
-            pickle_data = base64.b64decode(pickle_content.split(',')[1])
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(pickle_filename)[1]) as pickle_temp_file:
-                pickle_temp_file.write(pickle_data)
-                pickle_file_path = pickle_temp_file.name
+            paths.append(resolve_data_path(path))
         except Exception as e:
             traceback.print_exc()
-            return html.Div('Invalid pickle file.', style={'color': 'red'})
-        try:
-            # Decode reference file and create a temporary file
-            ref_data = base64.b64decode(ref_content.split(',')[1])
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(ref_filename)[1]) as ref_temp_file:
-                ref_temp_file.write(ref_data)
-                reference_file_path = ref_temp_file.name
-
-            # Get sequence and CDS range lookup
-            sequence = get_sequence(ribo_object, reference_file_path, alias)
-            cds_range = get_cds_range_lookup(ribo_object)
-            transcripts = get_filtered_transcripts(pickle_file_path, list(np.array(experiments).flat), num_transcripts)
-
-            # Main loop to generate heatmaps
-            output_excel_file = 'codon_heatmaps.xlsx'
-            with pd.ExcelWriter(output_excel_file, engine='xlsxwriter') as writer:
-                all_norm_heatmaps = []
-                for replicates in experiments:
-                    common_stall_sites = find_common_stall_sites(replicates, pickle_file_path, transcripts, percentile)
-                    stall_sequences = collect_stall_sequences(common_stall_sites, sequence, cds_range)
-                    raw_heatmap = create_raw_heatmap(stall_sequences)
-                    norm_heatmap = normalize_heatmap(raw_heatmap, sequence, cds_range, transcripts)
-                    all_norm_heatmaps.append(norm_heatmap)
-
-                    df_heatmap = get_heatmap_df(raw_heatmap, sequence, cds_range, transcripts)
-                    df_heatmap.to_excel(writer, sheet_name=f'heatmap_{replicates[0]}')
-                    df_stallsites = get_stall_sites_df(common_stall_sites, cds_range, sequence)
-                    df_stallsites.to_excel(writer, sheet_name=f'stall_sites_{replicates[0]}')
+            return dash.no_update, True, html.Div(f'Invalid {name} file.', style={'color': 'red'})
 
-            # Calculate global zmin and zmax
-            all_z_values = np.concatenate([norm_heatmap.values.flatten() for norm_heatmap in all_norm_heatmaps])
-            zmin, zmax = np.min(all_z_values), np.max(all_z_values)
+    # The heatmaps are generated in a background job, polled by update_job_status()
+    job_id = runner.submit(generate_heatmap_sweep, *paths, alias, experiments, num_transcripts, percentile, SWEEP_PERCENTILES)
+    return {'id': job_id, 'experiments': experiments}, False, html.Div()
 
-            # Create a subplot figure
-            fig = make_subplots(
-                rows=1, cols=len(all_norm_heatmaps),
-                subplot_titles=[f"Heatmap for {replicates[0]}" for replicates in experiments]
-            )
-
-            # Add each heatmap to the subplot
-            for i, norm_heatmap in enumerate(all_norm_heatmaps):
-                heatmap = go.Heatmap(
-                    z=norm_heatmap.values,
-                    x=norm_heatmap.columns,
-                    y=norm_heatmap.index,
-                    colorscale='Viridis',
-                    zmin=zmin,
-                    zmax=zmax
-                )
-                fig.add_trace(heatmap, row=1, col=i+1)
-
-            # Update layout settings for each subplot
-            for i in range(len(all_norm_heatmaps)):
-                fig.update_xaxes(tickfont=dict(size=10), dtick=1, row=1, col=i+1)
-                fig.update_yaxes(tickfont=dict(size=8), row=1, col=i+1)
+@app.callback(
+    Output('job_status', 'children'),
+    Output('heatmap_output', 'children', allow_duplicate=True),
+    Output('job-poll', 'disabled', allow_duplicate=True),
+    Output('sweep_controls', 'style'),
+    Output('sweep_percentile', 'marks'),
+    Output('sweep_percentile', 'min'),
+    Output('sweep_percentile', 'max'),
+    Output('sweep_percentile', 'value'),
+    Input('job-poll', 'n_intervals'),
+    State('job-id', 'data'),
+    prevent_initial_call=True
+)
+def update_job_status(n_intervals, job):
+    no_slider = ({'display': 'none'},) + (dash.no_update,) * 4
+    if not job:
+        return dash.no_update, dash.no_update, True, *no_slider
+    status = runner.status(job['id'])
 
-            fig.update_layout(
-                height=850,
-                width=(1400/len(all_norm_heatmaps)) * len(all_norm_heatmaps),
-                title_text="Combined Heatmaps"
-            )
+    if status['status'] in ('queued', 'running'):
+        return f"{status['stage']} ({status['progress']:.0%})", dash.no_update, False, *no_slider
+    if status['status'] == 'cancelled':
+        return 'Cancelled.', html.Div(), True, *no_slider
+    if status['status'] == 'failed':
+        print(status['traceback'])
+        return '', html.Div(f"Error generating heatmaps: {status['error']}", style={'color': 'red'}), True, *no_slider
 
-            # Return the figure to the output div
-            return dcc.Graph(figure=fig)
+    # Return the figure to the output div and show the slider over the percentiles of the sweep
+    result = runner.result(job['id'])
+    fig = make_heatmap_figure(result['heatmaps'], job['experiments'])
+    marks = {p: f'{p:g}' for p in result['percentiles']}
+    return (html.A('Download Excel worksheet', href=f"/jobs/{job['id']}/codon_heatmaps.xlsx"), dcc.Graph(figure=fig), True,
+            {'display': 'block'}, marks, result['percentiles'][0], result['percentiles'][-1], result['percentile'])
 
-        except Exception as e:
-            # Log the full traceback for debugging
-            traceback.print_exc()
-            return html.Div('Error processing reference file.', style={'color': 'red'})
-        finally:
-            # Ensure the temporary files are deleted
-            try:
-                os.remove(temp_file_path)
-            except Exception as e:
-                print(f"Error deleting temporary ribo file: {e}")
-            try:
-                os.remove(pickle_file_path)
-            except Exception as e:
-                print(f"Error deleting temporary pickle file: {e}")
-            try:
-                os.remove(reference_file_path)
-            except Exception as e:
-                print(f"Error deleting temporary reference file: {e}")
+@app.callback(
+    Output('heatmap_output', 'children', allow_duplicate=True),
+    Output('sweep_counts', 'children'),
+    Input('sweep_percentile', 'value'),
+    State('job-id', 'data'),
+    prevent_initial_call=True
+)
+def update_sweep_heatmap(percentile, job):
+    # Heatmaps of every slider percentile were computed by the job, so moving the slider only redraws the figure
+    if not job or percentile is None:
+        return dash.no_update, dash.no_update
+    result = runner.result(job['id'])
+    if percentile not in result['percentiles']:
+        return dash.no_update, dash.no_update
+    k = result['percentiles'].index(percentile)
+    fig = make_heatmap_figure(result['sweep_heatmaps'][k], job['experiments'])
+    counts = [f"{replicates[0]}: {counts['Common stall sites'].iloc[k]} common stall sites"
+              for replicates, counts in zip(job['experiments'], result['counts'])]
+    return dcc.Graph(figure=fig), f"Percentile {percentile:g}: " + ', '.join(counts)
 
-    return html.Div()
+@app.callback(
+    Output('job_status', 'children', allow_duplicate=True),
+    Input('cancel_button', 'n_clicks'),
+    State('job-id', 'data'),
+    prevent_initial_call=True
+)
+def cancel_job(n_clicks, job):
+    if not job:
+        return dash.no_update
+    runner.cancel(job['id'])
+    return 'Cancelling...'
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,796 @@
+import os
+import json
+import gzip
+import pickle
+import shutil
+import logging
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from collections.abc import Mapping
+from functions import get_file_fingerprint
+
+MANIFEST_FILE = 'manifest.json'
+OFFSETS_FILE = 'offsets.npy'
+STORE_FORMAT = 'ribopy_analysis.coverage'
+STORE_VERSION = 2
+SUMMARY_DTYPE = np.dtype([('total', np.float64), ('length', np.int64), ('density', np.float64),
+                          ('std', np.float64), ('nonzero', np.int64)])
+# Unsigned integer dtypes of read counts, from the smallest
+COUNT_DTYPES = [np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.uint32), np.dtype(np.uint64)]
+# Coverage is encoded as positions and counts of its nonzero positions when that takes at most this fraction of its dense size
+SPARSE_RATIO = 0.5
+
+def _write_json(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(temp_path, path)
+
+def _write_array(path, array):
+    # np.save appends .npy to names without it, so keep the suffix on the temporary file
+    temp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(temp_path, np.ascontiguousarray(array))
+    os.replace(temp_path, path)
+
+def get_count_dtype(max_count):
+    """
+    Returns the smallest unsigned integer dtype that holds counts up to max_count.
+
+    Parameters:
+        max_count (int): Largest count to hold.
+
+    Returns:
+        np.dtype: One of COUNT_DTYPES.
+    """
+    for dtype in COUNT_DTYPES:
+        if max_count <= np.iinfo(dtype).max:
+            return dtype
+    raise OverflowError(f"Count {max_count} does not fit in {COUNT_DTYPES[-1]}.")
+
+def is_count_array(coverage):
+    """
+    Checks whether coverage holds read counts, i.e., non-negative integers, whatever its dtype.
+    """
+    coverage = np.asarray(coverage)
+    if coverage.dtype.kind == 'u':
+        return True
+    if coverage.dtype.kind not in 'if':
+        return False
+    return not coverage.size or (coverage.min() >= 0 and (coverage.dtype.kind == 'i' or np.array_equal(coverage, np.floor(coverage))))
+
+def compact_coverage(coverage):
+    """
+    Casts read counts to the smallest unsigned integer dtype that holds its largest count.
+
+    Parameters:
+        coverage (np.ndarray): Read counts of any numeric dtype, e.g., float64 coverage of older pickle files.
+
+    Returns:
+        np.ndarray: The counts in a dtype of COUNT_DTYPES; coverage itself if it already has that dtype.
+    """
+    coverage = np.asarray(coverage)
+    if not is_count_array(coverage):
+        raise ValueError("Coverage must be non-negative integer read counts.")
+    return coverage.astype(get_count_dtype(coverage.max() if coverage.size else 0), copy=False)
+
+class SparseCoverage:
+    """
+    Coverage of one transcript stored as the positions and read counts of its nonzero positions.
+    It stands in for the dense coverage array: np.asarray(), indexing and iteration densify it transparently.
+    """
+
+    def __init__(self, length, positions, counts):
+        self.length = int(length)
+        self.positions = positions
+        self.counts = counts
+
+    @classmethod
+    def from_dense(cls, coverage):
+        coverage = np.asarray(coverage)
+        positions = np.flatnonzero(coverage)
+        return cls(len(coverage), positions.astype(get_count_dtype(max(len(coverage) - 1, 0))), coverage[positions])
+
+    @property
+    def dtype(self):
+        return self.counts.dtype
+
+    @property
+    def shape(self):
+        return (self.length,)
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.counts.nbytes
+
+    def toarray(self, dtype=None):
+        dense = np.zeros(self.length, dtype=self.counts.dtype if dtype is None else dtype)
+        dense[self.positions] = self.counts
+        return dense
+
+    def __array__(self, dtype=None):
+        return self.toarray(dtype)
+
+    def __getitem__(self, index):
+        return self.toarray()[index]
+
+    def __iter__(self):
+        return iter(self.toarray())
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return f'SparseCoverage(length={self.length}, nonzero={len(self.counts)}, dtype={self.dtype})'
+
+class SparseLengthCoverage:
+    """
+    Per-read-length coverage of one experiment stored as the positions of its nonzero entries in the row-major matrix
+    and their read counts. Indexing a row, i.e., a read length, densifies only that row; np.asarray() densifies the matrix.
+    """
+
+    def __init__(self, shape, positions, counts):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.positions = positions
+        self.counts = counts
+
+    @property
+    def dtype(self):
+        return self.counts.dtype
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.counts.nbytes
+
+    def row(self, i):
+        num_columns = self.shape[1]
+        lower, upper = np.searchsorted(self.positions, [i * num_columns, (i + 1) * num_columns])
+        dense = np.zeros(num_columns, dtype=self.counts.dtype)
+        dense[self.positions[lower:upper].astype(np.int64) - i * num_columns] = self.counts[lower:upper]
+        return dense
+
+    def toarray(self, dtype=None):
+        dense = np.zeros(self.shape[0] * self.shape[1], dtype=self.counts.dtype if dtype is None else dtype)
+        dense[self.positions] = self.counts
+        return dense.reshape(self.shape)
+
+    def __array__(self, dtype=None):
+        return self.toarray(dtype)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.row(range(self.shape[0])[index])
+        return self.toarray()[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'SparseLengthCoverage(shape={self.shape}, nonzero={len(self.counts)}, dtype={self.dtype})'
+
+def is_sparse_smaller(num_nonzero, num_positions, count_dtype):
+    """
+    Checks whether num_nonzero positions and counts, with positions in the smallest count dtype, take at most
+    SPARSE_RATIO of the size of num_positions dense counts of count_dtype.
+    """
+    position_size = get_count_dtype(max(num_positions - 1, 0)).itemsize
+    return num_nonzero * (position_size + np.dtype(count_dtype).itemsize) <= SPARSE_RATIO * num_positions * np.dtype(count_dtype).itemsize
+
+def _entry_files(entry):
+    # Files of an experiment entry of the manifest
+    read_lengths = entry.get('read_lengths', {})
+    files = [entry['file'], entry.get('summary'), entry.get('positions'), read_lengths.get('file'), read_lengths.get('positions')]
+    return [file_name for file_name in files if file_name]
+
+def is_coverage_store(path):
+    """
+    Checks whether the given path is a coverage store directory written by this module.
+
+    Parameters:
+        path (str): File or directory path.
+
+    Returns:
+        bool: True if the path is a coverage store.
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+def summarize_coverage(flat, cds_offsets, missing_mask=None):
+    """
+    Computes per-transcript summary statistics of a concatenated coverage array.
+
+    Parameters:
+        flat (np.ndarray): Concatenated coverage of one experiment.
+        cds_offsets (np.ndarray): Offsets of each transcript into flat (length n + 1).
+        missing_mask (np.ndarray): Boolean array marking transcripts without coverage. Their density and std are NaN.
+
+    Returns:
+        np.ndarray: Structured array of SUMMARY_DTYPE in transcript order with the total reads, CDS length,
+                    density (reads per nucleotide, i.e., the mean coverage), population standard deviation
+                    and number of nonzero positions of each transcript.
+    """
+    cds_offsets = np.asarray(cds_offsets, dtype=np.int64)
+    length = np.diff(cds_offsets)
+    summary = np.zeros(len(length), dtype=SUMMARY_DTYPE)
+    summary['length'] = length
+
+    # reduceat sums from each start to the next one, so only non-empty transcripts are used as starts
+    nonempty = np.flatnonzero(length > 0)
+    if len(nonempty):
+        flat = np.asarray(flat, dtype=np.float64)
+        starts = cds_offsets[nonempty]
+        nonempty_length = length[nonempty]
+        total = np.add.reduceat(flat, starts)
+        mean = total / nonempty_length
+        deviation = flat - np.repeat(mean, nonempty_length)
+        summary['total'][nonempty] = total
+        summary['std'][nonempty] = np.sqrt(np.add.reduceat(deviation * deviation, starts) / nonempty_length)
+        summary['nonzero'][nonempty] = np.add.reduceat((flat != 0).astype(np.int64), starts)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['density'] = summary['total'] / length
+    undefined = length == 0
+    if missing_mask is not None:
+        undefined |= missing_mask
+    summary['density'][undefined] = np.nan
+    summary['std'][undefined] = np.nan
+    return summary
+
+def create_coverage_store(path, names, cds_offsets, parameters=None, ribo=None):
+    """
+    Creates an empty coverage store. The transcript index is shared by all experiments of the store.
+    An existing store at the same path is replaced.
+
+    Parameters:
+        path (str): Directory of the store. Created if it does not exist.
+        names (list): Transcript identifiers in storage order.
+        cds_offsets (np.ndarray): Offsets of each transcript into the concatenated coverage (length n + 1).
+        parameters (dict): Parameters the coverage was computed with, e.g., read length range and offset mode.
+        ribo (dict): Fingerprint of the ribo file from get_file_fingerprint().
+
+    Returns:
+        CoverageStore: The opened store.
+    """
+    cds_offsets = np.asarray(cds_offsets, dtype=np.int64)
+    if len(cds_offsets) != len(names) + 1:
+        raise ValueError("cds_offsets must have one more entry than names.")
+
+    if is_coverage_store(path):
+        for entry in CoverageStore(path).manifest['experiments'].values():
+            for file_name in _entry_files(entry):
+                if os.path.exists(os.path.join(path, file_name)):
+                    os.remove(os.path.join(path, file_name))
+
+    os.makedirs(path, exist_ok=True)
+    _write_array(os.path.join(path, OFFSETS_FILE), cds_offsets)
+    manifest = {
+        'format': STORE_FORMAT,
+        'version': STORE_VERSION,
+        'parameters': parameters or {},
+        'ribo': ribo,
+        'transcripts': list(names),
+        'experiments': {},
+    }
+    _write_json(os.path.join(path, MANIFEST_FILE), manifest)
+    return CoverageStore(path)
+
+def add_experiment(path, exp, coverage, missing=(), metadata=None, length_coverage=None, min_len=None, flank=None):
+    """
+    Writes the concatenated coverage of one experiment and its per-transcript summary table into an existing store.
+    The arrays are written before the manifest is updated, so an interrupted write never leaves a partial experiment.
+    Read counts are stored in the smallest count dtype, and as the positions and counts of the nonzero positions
+    when that takes at most SPARSE_RATIO of the dense size; the same holds for the per-read-length coverage.
+
+    Parameters:
+        path (str): Directory of the store.
+        exp (str): Experiment name.
+        coverage (np.ndarray): Concatenated coverage laid out according to the store offsets.
+        missing (list): Transcripts without coverage in this experiment. These are returned as None.
+        metadata (dict): Additional information recorded for the experiment, e.g., its offsets and ribo file fingerprint.
+        length_coverage (np.ndarray): If given, the per-read-length coverage of the experiment from get_experiment_length_coverage(),
+                                      kept so that the coverage can be projected with other offsets or read lengths.
+        min_len (int): Read length of the first row of length_coverage.
+        flank (int): Number of nucleotides upstream of each CDS in length_coverage.
+    """
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    cds_offsets = np.load(os.path.join(path, OFFSETS_FILE))
+    if len(coverage) != cds_offsets[-1]:
+        raise ValueError(f"Coverage of {exp} has {len(coverage)} positions, expected {cds_offsets[-1]}.")
+    if length_coverage is not None and length_coverage.shape[1] != cds_offsets[-1] + flank * (len(cds_offsets) - 1):
+        raise ValueError(f"Per-read-length coverage of {exp} does not match the store offsets with a flank of {flank}.")
+
+    experiments = manifest['experiments']
+    if exp in experiments:
+        file_name = experiments[exp]['file']
+    else:
+        file_name = f'exp_{len(experiments)}.npy'
+        while any(entry['file'] == file_name for entry in experiments.values()):
+            file_name = '_' + file_name
+    summary_name = file_name[:-len('.npy')] + '_summary.npy'
+    positions_name = file_name[:-len('.npy')] + '_positions.npy'
+    lengths_name = file_name[:-len('.npy')] + '_lengths.npy'
+    lengths_positions_name = file_name[:-len('.npy')] + '_lengths_positions.npy'
+    missing_mask = np.isin(manifest['transcripts'], list(missing))
+    coverage = np.asarray(coverage)
+    _write_array(os.path.join(path, summary_name), summarize_coverage(coverage, cds_offsets, missing_mask))
+
+    encoding = 'dense'
+    if is_count_array(coverage):
+        coverage = compact_coverage(coverage)
+        positions = np.flatnonzero(coverage)
+        if is_sparse_smaller(len(positions), len(coverage), coverage.dtype):
+            encoding = 'sparse'
+            _write_array(os.path.join(path, positions_name), positions.astype(get_count_dtype(max(len(coverage) - 1, 0))))
+            coverage = coverage[positions]
+    _write_array(os.path.join(path, file_name), coverage)
+    if length_coverage is not None:
+        length_coverage = compact_coverage(length_coverage)
+        num_lengths = len(length_coverage)
+        length_encoding = 'dense'
+        length_positions = np.flatnonzero(length_coverage)
+        if is_sparse_smaller(len(length_positions), length_coverage.size, length_coverage.dtype):
+            length_encoding = 'sparse'
+            _write_array(os.path.join(path, lengths_positions_name),
+                         length_positions.astype(get_count_dtype(max(length_coverage.size - 1, 0))))
+            length_coverage = length_coverage.ravel()[length_positions]
+        _write_array(os.path.join(path, lengths_name), length_coverage)
+
+    previous = experiments.get(exp)
+    experiments[exp] = dict(metadata or {}, file=file_name, summary=summary_name, encoding=encoding,
+                            dtype=str(coverage.dtype), missing=sorted(missing))
+    if encoding == 'sparse':
+        experiments[exp]['positions'] = positions_name
+    if length_coverage is not None:
+        experiments[exp]['read_lengths'] = {'file': lengths_name, 'encoding': length_encoding, 'min_len': int(min_len),
+                                            'max_len': int(min_len) + num_lengths - 1, 'flank': int(flank)}
+        if length_encoding == 'sparse':
+            experiments[exp]['read_lengths']['positions'] = lengths_positions_name
+    _write_json(manifest_path, manifest)
+    # Remove files of the previous version of the experiment that the new one does not use
+    if previous is not None:
+        for stale in set(_entry_files(previous)) - set(_entry_files(experiments[exp])):
+            if os.path.exists(os.path.join(path, stale)):
+                os.remove(os.path.join(path, stale))
+
+def _same_file(first, second):
+    return first is not None and second is not None and \
+        (first['size'], first['sha1']) == (second['size'], second['sha1'])
+
+def get_completed_experiments(path, names, cds_offsets, parameters, ribo, append=False):
+    """
+    Checks that an existing store can be continued and returns the experiments already written to it.
+    The transcripts, their CDS lengths and the parameters must match the ones of the store.
+    When resuming, the ribo file must also be the same; when appending, experiments may come from a different
+    ribo file with the same reference, e.g., a ribo file with newly sequenced experiments merged in.
+
+    Parameters:
+        path (str): Directory of the store.
+        names (list): Transcript identifiers in storage order.
+        cds_offsets (np.ndarray): Offsets of each transcript into the concatenated coverage.
+        parameters (dict): Parameters of the current run.
+        ribo (dict): Fingerprint of the ribo file of the current run from get_file_fingerprint().
+        append (bool): Whether experiments from a different ribo file may be added.
+
+    Returns:
+        list: Names of the experiments already in the store.
+    """
+    store = CoverageStore(path)
+    manifest = store.manifest
+    if store.transcripts != list(names) or not np.array_equal(store.cds_offsets, cds_offsets):
+        raise ValueError(f"The transcripts of {path} do not match the ribo file.")
+    if manifest.get('parameters', {}) != parameters:
+        raise ValueError(f"{path} was built with {manifest.get('parameters')}, not {parameters}.")
+    if not append and not _same_file(manifest.get('ribo'), ribo):
+        raise ValueError(f"{path} was built from a different ribo file ({manifest.get('ribo')}).")
+
+    if append and not _same_file(manifest.get('ribo'), ribo):
+        manifest['ribo'] = ribo
+        _write_json(os.path.join(path, MANIFEST_FILE), manifest)
+    return store.experiments
+
+def write_coverage_store(path, coverage_dict, parameters=None, ribo=None, names=None):
+    """
+    Writes a dictionary of the adjusted coverage data {Experiment : {Transcript : Adjusted coverage array}} as a coverage store.
+
+    Parameters:
+        path (str): Directory of the store.
+        coverage_dict (dict): Coverage dictionary, e.g. loaded from a gzipped pickle file generated using adj_coverage.py.
+        parameters (dict): Parameters the coverage was computed with, see create_coverage_store().
+        ribo (dict): Fingerprint of the ribo file from get_file_fingerprint().
+        names (list): Transcript identifiers in storage order, e.g., the reference order of the ribo file. Defaults to the
+                      order of the coverage dictionary, which for pickle files is the order their coverage was finished in.
+
+    Returns:
+        CoverageStore: The written store.
+    """
+    order = []
+    lengths = {}
+    for exp_coverage in coverage_dict.values():
+        for transcript, coverage in exp_coverage.items():
+            if transcript not in lengths:
+                order.append(transcript)
+                lengths[transcript] = None
+            if coverage is None:
+                continue
+            if lengths[transcript] is None:
+                lengths[transcript] = len(coverage)
+            elif lengths[transcript] != len(coverage):
+                raise ValueError(f"Coverage of {transcript} has different lengths across experiments.")
+    if names is None:
+        names = order
+    else:
+        names = list(names)
+        unknown = set(order) - set(names)
+        if unknown:
+            raise ValueError(f"{len(unknown)} transcripts of the coverage are not in the given transcripts, e.g., {sorted(unknown)[0]}.")
+        for name in names:
+            lengths.setdefault(name, None)
+
+    cds_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([lengths[name] or 0 for name in names], out=cds_offsets[1:])
+    store = create_coverage_store(path, names, cds_offsets, parameters, ribo)
+
+    for exp, exp_coverage in coverage_dict.items():
+        arrays = [exp_coverage.get(name) for name in names]
+        dtypes = [coverage.dtype for coverage in arrays if coverage is not None]
+        flat = np.zeros(cds_offsets[-1], dtype=np.result_type(*dtypes) if dtypes else np.float64)
+        missing = []
+        for i, (name, coverage) in enumerate(zip(names, arrays)):
+            if coverage is None:
+                missing.append(name)
+            else:
+                flat[cds_offsets[i]:cds_offsets[i + 1]] = coverage
+        add_experiment(path, exp, flat, missing)
+
+    return store.reload()
+
+class ExperimentCoverage(Mapping):
+    """
+    Read-only mapping of transcript to coverage for one experiment of a coverage store.
+    Values of dense experiments are zero-copy views into the memory-mapped experiment array, and values of sparse
+    experiments are SparseCoverage views of their nonzero positions; transcripts without coverage map to None.
+    """
+
+    def __init__(self, store, exp, values, missing, positions=None):
+        self.store = store
+        self.exp = exp
+        # The concatenated coverage, or for sparse experiments the counts at positions of the concatenated coverage
+        self.values = values
+        self.positions = positions
+        self.missing = missing
+        self._bounds = None
+
+    @property
+    def flat(self):
+        """
+        The concatenated coverage laid out according to the store offsets. Sparse experiments are densified on each access.
+        """
+        if self.positions is None:
+            return self.values
+        flat = np.zeros(self.store.cds_offsets[-1], dtype=self.values.dtype)
+        flat[self.positions] = self.values
+        return flat
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.positions is None else self.positions.nbytes)
+
+    def load(self):
+        """
+        Returns a copy of the experiment read into memory, in the same encoding.
+        """
+        return ExperimentCoverage(self.store, self.exp, np.array(self.values), self.missing,
+                                  None if self.positions is None else np.array(self.positions))
+
+    def _segment(self, i):
+        offsets = self.store.cds_offsets
+        if self.positions is None:
+            return self.values[offsets[i]:offsets[i + 1]]
+        if self._bounds is None:
+            self._bounds = np.searchsorted(self.positions, offsets)
+        lower, upper = self._bounds[i], self._bounds[i + 1]
+        return SparseCoverage(offsets[i + 1] - offsets[i], self.positions[lower:upper] - offsets[i], self.values[lower:upper])
+
+    def __getitem__(self, transcript):
+        i = self.store.transcript_index[transcript]
+        if transcript in self.missing:
+            return None
+        return self._segment(i)
+
+    def __iter__(self):
+        return iter(self.store.transcripts)
+
+    def __len__(self):
+        return len(self.store.transcripts)
+
+    def items(self):
+        for i, transcript in enumerate(self.store.transcripts):
+            if transcript in self.missing:
+                yield transcript, None
+            else:
+                yield transcript, self._segment(i)
+
+class CoverageStore(Mapping):
+    """
+    Reader for coverage stores written by adj_coverage.py.
+    It behaves like the dictionary {Experiment : {Transcript : Adjusted coverage array}} stored in coverage.pkl.gz,
+    but experiment arrays are memory mapped and only the accessed transcripts are read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != STORE_FORMAT:
+            raise ValueError(f"{path} is not a coverage store.")
+        self.transcripts = self.manifest['transcripts']
+        self.cds_offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self._transcript_index = None
+        self._experiments = {}
+        self._summaries = {}
+
+    def reload(self):
+        return CoverageStore(self.path)
+
+    @property
+    def experiments(self):
+        return list(self.manifest['experiments'])
+
+    @property
+    def transcript_index(self):
+        if self._transcript_index is None:
+            self._transcript_index = {transcript: i for i, transcript in enumerate(self.transcripts)}
+        return self._transcript_index
+
+    def flat(self, exp):
+        """
+        Returns the concatenated coverage of an experiment, laid out according to cds_offsets.
+        It is memory mapped for dense experiments and densified in memory for sparse ones.
+        """
+        return self[exp].flat
+
+    def __getitem__(self, exp):
+        if exp not in self._experiments:
+            entry = self.manifest['experiments'][exp]
+            values = np.load(os.path.join(self.path, entry['file']), mmap_mode='r')
+            positions = None
+            if entry.get('encoding') == 'sparse':
+                positions = np.load(os.path.join(self.path, entry['positions']), mmap_mode='r')
+            self._experiments[exp] = ExperimentCoverage(self, exp, values, frozenset(entry['missing']), positions)
+        return self._experiments[exp]
+
+    def length_coverage(self, exp):
+        """
+        Returns the per-read-length coverage of an experiment (see get_experiment_length_coverage()) and
+        its 'min_len', 'max_len' and 'flank', or None if the experiment was added without it. The coverage is
+        memory-mapped, or a SparseLengthCoverage of the memory-mapped nonzero entries if it was stored sparse.
+        """
+        info = self.manifest['experiments'][exp].get('read_lengths')
+        if info is None:
+            return None
+        values = np.load(os.path.join(self.path, info['file']), mmap_mode='r')
+        if info.get('encoding') != 'sparse':
+            return values, info
+        num_columns = int(self.cds_offsets[-1]) + info['flank'] * (len(self.cds_offsets) - 1)
+        positions = np.load(os.path.join(self.path, info['positions']), mmap_mode='r')
+        return SparseLengthCoverage((info['max_len'] - info['min_len'] + 1, num_columns), positions, values), info
+
+    def summary(self, exp):
+        """
+        Returns the per-transcript summary table of an experiment (see summarize_coverage()) without reading its coverage.
+        Stores written before summary tables were added are summarized from the coverage once.
+        """
+        if exp not in self._summaries:
+            entry = self.manifest['experiments'][exp]
+            if entry.get('summary'):
+                self._summaries[exp] = np.load(os.path.join(self.path, entry['summary']))
+            else:
+                missing_mask = np.isin(self.transcripts, list(entry['missing']))
+                self._summaries[exp] = summarize_coverage(self.flat(exp), self.cds_offsets, missing_mask)
+        return self._summaries[exp]
+
+    def __iter__(self):
+        return iter(self.manifest['experiments'])
+
+    def __len__(self):
+        return len(self.manifest['experiments'])
+
+    def to_dict(self, experiments=None):
+        """
+        Copies the store into a dictionary {Experiment : {Transcript : Adjusted coverage array}}.
+        If experiments is given, only those experiments are copied, in the given order.
+        Coverage arrays are dense float64 arrays, as in the gzipped pickle files of adj_coverage.py, whatever their encoding in the store.
+        """
+        return {exp: {transcript: None if coverage is None else np.array(coverage, dtype=np.float64)
+                      for transcript, coverage in self[exp].items()}
+                for exp in (self if experiments is None else experiments)}
+
+def get_coverage_fingerprint(path):
+    """
+    Returns a fingerprint of coverage data, see get_file_fingerprint(). The fingerprint of a coverage store is
+    the one of its manifest, which changes whenever an experiment is written.
+    """
+    if is_coverage_store(path):
+        return get_file_fingerprint(os.path.join(path, MANIFEST_FILE))
+    return get_file_fingerprint(path)
+
+def load_coverage(path):
+    """
+    Opens coverage data generated using adj_coverage.py, either as a coverage store or as a gzipped pickle file.
+
+    Parameters:
+        path (str): Directory of a coverage store or file path to a gzipped pickle file.
+
+    Returns:
+        CoverageStore or dict: Mapping of experiment to a mapping of transcript to adjusted coverage array.
+    """
+    if is_coverage_store(path):
+        return CoverageStore(path)
+    with gzip.open(path, 'rb') as f:
+        return pickle.load(f)
+
+class CoverageSession:
+    """
+    Handle to coverage data that is opened once and shared by several analysis steps.
+    Experiments are read into memory on first use and kept in a least-recently-used cache within memory_budget bytes.
+    A gzipped pickle file is unpickled once; if it is larger than the budget, it is spilled into a temporary
+    coverage store so that evicted experiments can be reloaded without unpickling the file again.
+    The coverage is only opened when it is first accessed.
+    """
+
+    def __init__(self, path, memory_budget=4 * 2 ** 30):
+        self.path = path
+        self.memory_budget = memory_budget
+        self._cache = OrderedDict()
+        self._summaries = {}
+        self._spill_path = None
+        self._store = None
+        self._coverage_dict = None
+
+    def _open(self):
+        if self._store is not None or self._coverage_dict is not None:
+            return
+        if is_coverage_store(self.path):
+            self._store = CoverageStore(self.path)
+            return
+
+        with gzip.open(self.path, 'rb') as f:
+            coverage_dict = pickle.load(f)
+        size = sum(coverage.nbytes for exp_coverage in coverage_dict.values()
+                   for coverage in exp_coverage.values() if coverage is not None)
+        if size > self.memory_budget:
+            self._spill_path = tempfile.mkdtemp(prefix='coverage_session_')
+            self._store = write_coverage_store(self._spill_path, coverage_dict)
+        else:
+            self._coverage_dict = coverage_dict
+
+    @property
+    def experiments(self):
+        self._open()
+        if self._store is not None:
+            return self._store.experiments
+        return list(self._coverage_dict)
+
+    def __getitem__(self, exp):
+        """
+        Returns the mapping of transcript to adjusted coverage array of an experiment.
+        """
+        self._open()
+        if self._store is None:
+            return self._coverage_dict[exp]
+        if exp in self._cache:
+            self._cache.move_to_end(exp)
+            return self._cache[exp]
+
+        coverage = self._store[exp].load()
+        self._cache[exp] = coverage
+        while len(self._cache) > 1 and sum(c.nbytes for c in self._cache.values()) > self.memory_budget:
+            self._cache.popitem(last=False)
+        return coverage
+
+    def __contains__(self, exp):
+        return exp in self.experiments
+
+    def transcripts(self, exp):
+        """
+        Returns the transcript names of an experiment in the order of its summary table.
+        """
+        self._open()
+        if self._store is not None:
+            return self._store.transcripts
+        return list(self._coverage_dict[exp])
+
+    def summary(self, exp):
+        """
+        Returns the per-transcript summary table of an experiment (see summarize_coverage()).
+        """
+        self._open()
+        if self._store is not None:
+            return self._store.summary(exp)
+        if exp not in self._summaries:
+            self._summaries[exp] = summarize_coverage_dict(self._coverage_dict[exp])[1]
+        return self._summaries[exp]
+
+    def close(self):
+        self._cache.clear()
+        self._store = None
+        self._coverage_dict = None
+        if self._spill_path is not None:
+            shutil.rmtree(self._spill_path, ignore_errors=True)
+            self._spill_path = None
+
+    def __del__(self):
+        self.close()
+
+def summarize_coverage_dict(exp_coverage):
+    """
+    Computes the per-transcript summary table of one experiment of a coverage dictionary.
+
+    Parameters:
+        exp_coverage (dict): Dictionary mapping transcript to adjusted coverage array or None.
+
+    Returns:
+        tuple: Transcript names (list) and their summary table (np.ndarray of SUMMARY_DTYPE, see summarize_coverage()).
+    """
+    names = list(exp_coverage)
+    arrays = [exp_coverage[name] for name in names]
+    missing_mask = np.array([coverage is None for coverage in arrays], dtype=bool)
+    cds_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([0 if coverage is None else len(coverage) for coverage in arrays], out=cds_offsets[1:])
+    present = [coverage for coverage in arrays if coverage is not None]
+    flat = np.concatenate(present) if present else np.zeros(0)
+    return names, summarize_coverage(flat, cds_offsets, missing_mask)
+
+def get_coverage_summary(coverage, exp):
+    """
+    Returns the transcript names and the per-transcript summary table of an experiment.
+
+    Parameters:
+        coverage (CoverageSession, CoverageStore or dict): Opened coverage data.
+        exp (str): Experiment name.
+
+    Returns:
+        tuple: Transcript names (list) and their summary table (np.ndarray of SUMMARY_DTYPE, see summarize_coverage()).
+    """
+    if isinstance(coverage, CoverageSession):
+        return coverage.transcripts(exp), coverage.summary(exp)
+    if isinstance(coverage, CoverageStore):
+        return coverage.transcripts, coverage.summary(exp)
+    return summarize_coverage_dict(coverage[exp])
+
+def get_coverage_session(coverage):
+    """
+    Returns a CoverageSession for a coverage path; sessions and already loaded coverage dictionaries are returned as they are.
+    """
+    if isinstance(coverage, (CoverageSession, Mapping)):
+        return coverage
+    return CoverageSession(coverage)
+
+def import_pickle(pkl_gz_path, store_path, parameters=None, ribo=None, names=None):
+    """
+    Converts a gzipped pickle file generated using adj_coverage.py into a coverage store.
+    Pickle files do not record how the coverage was computed, so parameters and ribo can be given to record them in the store,
+    and names to store the transcripts in the order of the ribo file (see write_coverage_store()).
+    """
+    with gzip.open(pkl_gz_path, 'rb') as f:
+        coverage_dict = pickle.load(f)
+    return write_coverage_store(store_path, coverage_dict, parameters, ribo, names)
+
+def export_pickle(store_path, pkl_gz_path, experiments=None):
+    """
+    Converts a coverage store into a gzipped pickle file as previously generated by adj_coverage.py.
+    If experiments is given, only those experiments are exported, in the given order.
+    """
+    with gzip.open(pkl_gz_path, 'wb') as f:
+        pickle.dump(CoverageStore(store_path).to_dict(experiments), f)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    input_path = input('Enter coverage path to convert, e.g., \'/home/coverage.pkl.gz\' or \'/home/coverage\': ')
+    output_path = input('Enter output path: ')
+    if is_coverage_store(input_path):
+        export_pickle(input_path, output_path)
+    else:
+        import_pickle(input_path, output_path)
+    logging.info(f"Saved as {output_path}.")
@@ -3,36 +3,161 @@ from ribopy import Ribo
 from Fasta import FastaFile
 from ribopy.core.get_gadgets import get_region_boundaries, get_reference_names
 import pandas as pd
-
-def get_sequence(ribo_object, reference_file_path, alias):
+import numpy as np
+import os
+import json
+import hashlib
+import logging
+from functions_metrics import stage
+
+def get_sequence(ribo_object, reference_file_path, alias, transcripts=None):
     """
     Retrieves the sequences of transcripts from a reference FASTA file.
+    Only the requested transcripts are read when the reference file can be indexed (uncompressed or bgzip-compressed);
+    otherwise the file is read sequentially.
 
     Parameters:
         ribo_object (Ribo): The Ribo object containing ribosome profiling data.
         reference_file_path (str): The file path to the reference FASTA file.
         alias (bool): Whether or not alias is used.
+        transcripts (list): Transcript identifiers to retrieve. Defaults to all transcripts of the ribo object.
 
     Returns:
         dict: A dictionary mapping transcript identifiers to their respective sequences.
     """
     transcript_np = ribo_object.transcript_names
     fasta = FastaFile(reference_file_path)
-    
-    fasta_dict = {e.header: e.sequence for e in fasta}
+
     if alias == True:
-        sequence_dict = {
-            transcript.split("|")[4]: fasta_dict[transcript] for transcript in transcript_np
-        }
+        headers = {transcript.split("|")[4]: transcript for transcript in transcript_np}
     else:
-        sequence_dict = {
-        transcript: fasta_dict[transcript] for transcript in transcript_np
+        headers = {transcript: transcript for transcript in transcript_np}
+    if transcripts is not None:
+        headers = {transcript: headers[transcript] for transcript in transcripts}
+
+    if fasta.is_indexable():
+        try:
+            return {transcript: fasta.fetch(header).sequence for transcript, header in headers.items()}
+        except ValueError:
+            pass
+
+    wanted = set(headers.values())
+    fasta_dict = {e.header: e.sequence for e in FastaFile(reference_file_path) if e.header in wanted}
+    sequence_dict = {
+        transcript: fasta_dict[header] for transcript, header in headers.items()
     }
     return sequence_dict
 
+# Columns of the start site metagene (positions -50 to 50) searched for the peak of each offset mode
+OFFSET_WINDOWS = {'psite': (35, 41), 'asite': (38, 44)}
+# Offset tables are saved in a sidecar file next to the ribo file, e.g., all.ribo.offsets.json
+OFFSET_SIDECAR_SUFFIX = '.offsets.json'
+
+def compute_offset_report(ribo_object, experiments, mmin, mmax):
+    """
+    Calculates the P-site and A-site offsets of every read length of all given experiments
+    from one start site metagene, taking the peak of each offset window of all rows at once.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        experiments (list): Experiments for which offsets are calculated.
+        mmin (int): The minimum read length considered for offset calculation.
+        mmax (int): The maximum read length considered for offset calculation.
+
+    Returns:
+        DataFrame: Offset report indexed by experiment and read length, with the offset ('psite', 'asite') and
+                   the metagene reads at the peak ('psite_peak', 'asite_peak') of each offset mode, and the total
+                   metagene reads of the read length ('reads').
+    """
+    with stage('offsets', experiments=len(experiments)) as metrics:
+        df = ribo_object.get_metagene("start", experiments=list(experiments),
+                                      range_lower=mmin, range_upper=mmax,
+                                      sum_lengths=False,
+                                      sum_references=True)
+        values = df.to_numpy()
+        positions = np.asarray(df.columns, dtype=np.int64)
+        report = pd.DataFrame(index=df.index)
+        for mode, (lower, upper) in OFFSET_WINDOWS.items():
+            # argmax returns the first maximum, as idxmax did
+            peak = lower + np.argmax(values[:, lower:upper], axis=1)
+            report[mode] = 1 - positions[peak]
+            report[f'{mode}_peak'] = values[np.arange(len(values)), peak]
+        report['reads'] = values.sum(axis=1)
+        metrics.add(read_lengths=len(report))
+        return report
+
+def get_offset_sidecar_path(ribo_path):
+    """
+    Returns the path of the offset sidecar file of a ribo file.
+    """
+    return ribo_path + OFFSET_SIDECAR_SUFFIX
+
+def get_offset_report(ribo_object, ribo_path, experiments, mmin, mmax):
+    """
+    Returns the offset report of compute_offset_report(), reusing the offsets saved in the sidecar file next to the ribo file.
+    Offsets of experiments missing from the sidecar are calculated in one call and added to it.
+    The sidecar is keyed by the fingerprint of the ribo file and the read length range, so it is ignored when either changes.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        ribo_path (str): Path to the ribo file of ribo_object.
+        experiments (list): Experiments for which offsets are calculated.
+        mmin (int): The minimum read length considered for offset calculation.
+        mmax (int): The maximum read length considered for offset calculation.
+
+    Returns:
+        DataFrame: Offset report of the given experiments, see compute_offset_report().
+    """
+    path = get_offset_sidecar_path(ribo_path)
+    fingerprint = get_file_fingerprint(ribo_path)
+    range_key = f'{mmin}-{mmax}'
+    sidecar = None
+    try:
+        with open(path) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if sidecar is None or sidecar.get('ribo', {}).get('sha1') != fingerprint['sha1']:
+        sidecar = {'ribo': fingerprint, 'reports': {}}
+    saved = sidecar['reports'].setdefault(range_key, {})
+
+    missing = [exp for exp in experiments if exp not in saved]
+    if missing:
+        logging.info(f"Calculating offsets of {', '.join(missing)}...")
+        report = compute_offset_report(ribo_object, missing, mmin, mmax)
+        for exp in missing:
+            saved[exp] = report.loc[exp].reset_index().to_dict(orient='list')
+        try:
+            # A temporary file per process, as concurrent runs, e.g., shards, may save the same offsets
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(sidecar, f, indent=1, default=int)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not save offsets to {path}: {e}")
+
+    report = pd.concat({exp: pd.DataFrame(saved[exp]).set_index('read_length') for exp in experiments},
+                       names=['experiment', 'read_length'])
+    return report
+
+def get_offsets(report, exp, mode):
+    """
+    Returns the offsets of an experiment from an offset report.
+
+    Parameters:
+        report (DataFrame): Offset report from get_offset_report() or compute_offset_report().
+        exp (str): The name of the experiment.
+        mode (str): 'psite' or 'asite'.
+
+    Returns:
+        dict: A dictionary mapping read length to offset.
+    """
+    return {int(length): int(offset) for length, offset in report.loc[exp, mode].items()}
+
 def get_psite_offset(ribo_object, exp, mmin, mmax):
     """
     Calculates the P-site offsets for ribosome profiling experiments.
+    To calculate the offsets of several experiments at once, use get_offset_report().
 
     Parameters:
         ribo_object (Ribo): The Ribo object containing ribosome profiling data.
@@ -41,25 +166,14 @@ def get_psite_offset(ribo_object, exp, mmin, mmax):
         mmax (int): The maximum read length considered for P-site offset calculation.
 
     Returns:
-        dict: A dictionary mapping transcript identifiers to their respective P-site offsets.
+        dict: A dictionary mapping read length to its respective P-site offset.
     """
-    df = (ribo_object.get_metagene("start", experiments=exp,\
-                                   range_lower=mmin, range_upper=mmax,\
-                                   sum_lengths=False,\
-                                   sum_references=True))
-
-    p_site = {}
-
-    for index, row in df.iterrows():
-        max_value_index = row.iloc[35:41].idxmax()
-        offset = -1 * max_value_index + 1
-
-        p_site[index[1]] = offset 
-    return p_site
+    return get_offsets(compute_offset_report(ribo_object, [exp], mmin, mmax), exp, 'psite')
 
 def get_asite_offset(ribo_object, exp, mmin, mmax):
     """
     Calculates the A-site offsets for ribosome profiling experiments.
+    To calculate the offsets of several experiments at once, use get_offset_report().
 
     Parameters:
         ribo_object (Ribo): The Ribo object containing ribosome profiling data.
@@ -68,23 +182,9 @@ def get_asite_offset(ribo_object, exp, mmin, mmax):
         mmax (int): The maximum read length considered for A-site offset calculation.
 
     Returns:
-        dict: A dictionary mapping transcript identifiers to their respective A-site offsets.
+        dict: A dictionary mapping read length to its respective A-site offset.
     """
-    df = (ribo_object.get_metagene("start", experiments=exp,
-                                   range_lower=mmin, range_upper=mmax,
-                                   sum_lengths=False,
-                                   sum_references=True))
-
-    a_site = {}
-
-    for index, row in df.iterrows():
-        # Adjusted window for A-site offsetting
-        max_value_index = row.iloc[38:44].idxmax()
-        offset = -1 * max_value_index + 1
-
-        a_site[index[1]] = offset
-    return a_site
-
+    return get_offsets(compute_offset_report(ribo_object, [exp], mmin, mmax), exp, 'asite')
 
 def get_cds_range_lookup(ribo_object):
     """
@@ -104,4 +204,28 @@ def get_cds_range_lookup(ribo_object):
     cds_ranges = [boundary[1] for boundary in boundaries]
     boundary_lookup = dict(zip(list(names), cds_ranges))
 
-    return boundary_lookup
\ No newline at end of file
+    return boundary_lookup
+
+# Fingerprints already computed in this process, keyed by path, size and modification time
+_fingerprints = {}
+
+def get_file_fingerprint(path):
+    """
+    Identifies the content of a file, e.g., to check that a ribo file has not changed between runs.
+
+    Parameters:
+        path (str): File path.
+
+    Returns:
+        dict: A dictionary with the absolute 'path', the 'size' in bytes and the 'sha1' digest of the file content.
+              Two files are the same if their size and digest are equal.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _fingerprints:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _fingerprints[key] = {'path': key[0], 'size': stat.st_size, 'sha1': digest.hexdigest()}
+    return dict(_fingerprints[key])
@@ -0,0 +1,97 @@
+import os
+import shutil
+from werkzeug.utils import secure_filename
+from coverage_store import is_coverage_store
+
+# Directory on the server from which the Dash app opens files in place. Uploaded files are saved in its uploads directory.
+DATA_DIR = os.environ.get('RIBOPY_DATA_DIR', 'data')
+UPLOAD_DIR_NAME = 'uploads'
+PARTIAL_SUFFIX = '.part'
+
+FILE_KINDS = {
+    'ribo': ('.ribo',),
+    'coverage': ('.pkl.gz', '.pkl'),
+    'reference': ('.fa', '.fasta', '.fna', '.fa.gz', '.fasta.gz', '.fna.gz'),
+}
+
+def list_data_files(kind, data_dir=None):
+    """
+    Lists the files of a kind in the data directory.
+
+    Parameters:
+        kind (str): 'ribo', 'coverage' or 'reference'. Coverage also includes coverage store directories.
+        data_dir (str): Data directory. Defaults to DATA_DIR.
+
+    Returns:
+        list: Paths relative to the data directory, sorted.
+    """
+    data_dir = data_dir or DATA_DIR
+    if not os.path.isdir(data_dir):
+        return []
+
+    paths = []
+    for root, dirs, files in os.walk(data_dir):
+        if is_coverage_store(root):
+            if kind == 'coverage':
+                paths.append(os.path.relpath(root, data_dir))
+            dirs[:] = []
+            continue
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for name in files:
+            if name.endswith(FILE_KINDS[kind]) and not name.endswith(PARTIAL_SUFFIX):
+                paths.append(os.path.relpath(os.path.join(root, name), data_dir))
+    return sorted(paths)
+
+def resolve_data_path(relative_path, data_dir=None):
+    """
+    Returns the absolute path of a file in the data directory.
+
+    Parameters:
+        relative_path (str): Path relative to the data directory, e.g., from list_data_files().
+        data_dir (str): Data directory. Defaults to DATA_DIR.
+
+    Returns:
+        str: Absolute path of the file.
+    """
+    data_dir = os.path.realpath(data_dir or DATA_DIR)
+    path = os.path.realpath(os.path.join(data_dir, relative_path))
+    if os.path.commonpath([data_dir, path]) != data_dir or not os.path.exists(path):
+        raise ValueError(f"{relative_path} is not a file in the data directory.")
+    return path
+
+def save_upload_chunk(file_name, offset, total_size, stream, data_dir=None):
+    """
+    Writes one chunk of an uploaded file to disk. Chunks are written to a partial file,
+    which is renamed to the file name once all total_size bytes have been received.
+    An upload restarted from offset 0 replaces the partial file.
+
+    Parameters:
+        file_name (str): Name of the uploaded file. Directories are stripped.
+        offset (int): Position of the chunk in the file.
+        total_size (int): Size of the complete file.
+        stream (file): Readable stream of the chunk, e.g., the request body.
+        data_dir (str): Data directory. The file is saved in its uploads directory. Defaults to DATA_DIR.
+
+    Returns:
+        tuple: Path of the file relative to the data directory and whether the upload is complete.
+    """
+    data_dir = data_dir or DATA_DIR
+    upload_dir = os.path.join(data_dir, UPLOAD_DIR_NAME)
+    file_name = secure_filename(file_name)
+    if not file_name:
+        raise ValueError("Invalid file name.")
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, file_name)
+    partial_path = path + PARTIAL_SUFFIX
+
+    if offset > 0 and (not os.path.exists(partial_path) or os.path.getsize(partial_path) < offset):
+        raise ValueError(f"Chunk at {offset} of {file_name} does not follow the previous chunk.")
+    with open(partial_path, 'r+b' if offset > 0 else 'wb') as f:
+        f.seek(offset)
+        shutil.copyfileobj(stream, f, 1 << 20)
+        f.truncate()
+
+    complete = os.path.getsize(partial_path) >= total_size
+    if complete:
+        os.replace(partial_path, path)
+    return os.path.relpath(path, data_dir), complete
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+# Directory of the disk level of the stage cache shared by the processes of the heatmap app
+CACHE_DIR = os.environ.get('RIBOPY_CACHE_DIR', 'stage_cache')
+
+def _sizeof(value):
+    # Approximate memory used by a cached value, counting NumPy and pandas buffers and the attributes of objects
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, dict):
+        return sum(_sizeof(key) + _sizeof(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(_sizeof(item) for item in value)
+    if hasattr(value, '__dict__'):
+        return _sizeof(vars(value))
+    return sys.getsizeof(value)
+
+class StageCache:
+    """
+    Two-level cache of pipeline stage results. Computed results are written through to disk, where the least
+    recently used files are removed beyond disk_budget bytes, so that re-runs, other worker processes and restarts
+    reuse them. Memory only fronts the disk level, keeping results in least-recently-used order within
+    memory_budget bytes. Keys are built from the stage name and everything the stage depends on,
+    e.g., input file fingerprints and parameters, so that changing one parameter only recomputes the stages using it.
+    """
+
+    def __init__(self, memory_budget=2 * 2 ** 30, disk_budget=20 * 2 ** 30, cache_dir=None):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.cache_dir = cache_dir or CACHE_DIR
+        self._memory = OrderedDict()
+        self._memory_size = 0
+
+    @staticmethod
+    def key(stage, *depends_on):
+        """
+        Returns the cache key of a stage result. depends_on must be JSON serializable.
+        """
+        data = json.dumps([stage, depends_on], sort_keys=True, default=str)
+        return f'{stage}_{hashlib.sha1(data.encode()).hexdigest()}'
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, stage, depends_on, compute):
+        """
+        Returns the cached result of a stage, or computes and caches it.
+
+        Parameters:
+            stage (str): Name of the stage.
+            depends_on (list): Fingerprints and parameters the result depends on.
+            compute (callable): Computes the result when it is not cached.
+
+        Returns:
+            The result of the stage.
+        """
+        key = self.key(stage, *depends_on)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key][0]
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            logging.info(f"Loaded {stage} from {path}.")
+        except (OSError, EOFError, pickle.UnpicklingError):
+            value = compute()
+            self._write(key, value)
+        self._put(key, value)
+        return value
+
+    def _put(self, key, value):
+        size = _sizeof(value)
+        self._memory[key] = (value, size)
+        self._memory_size += size
+        while len(self._memory) > 1 and self._memory_size > self.memory_budget:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+    def _write(self, key, value):
+        path = self._disk_path(key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Several processes may compute the same key, so each writes its own temporary file
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_budget:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Removes all results from memory. Results stay on disk.
+        """
+        self._memory.clear()
+        self._memory_size = 0
+
+# Stage cache shared by all pipeline runs of a process, created on first use
+_stage_cache = None
+
+def get_stage_cache():
+    """
+    Returns the stage cache shared by all pipeline runs of this process.
+    """
+    global _stage_cache
+    if _stage_cache is None:
+        _stage_cache = StageCache()
+    return _stage_cache
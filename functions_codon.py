@@ -0,0 +1,341 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from functions import get_cds_range_lookup, get_sequence, get_file_fingerprint
+from functions_metrics import stage
+from functions_cache import CACHE_DIR
+
+# The 64 codons in sorted order, so that the ID of a codon over ACGT is 16 * first + 4 * second + third
+NUCLEOTIDES = 'ACGT'
+CODONS = [a + b + c for a in NUCLEOTIDES for b in NUCLEOTIDES for c in NUCLEOTIDES]
+
+# Label of the start codon when it is counted separately (start_codon_option == 1 in codon_occupancy.py)
+START_CODON_LABEL = 'UUU'
+
+# Lowercase (soft-masked) nucleotides have the same codes as uppercase ones; all other characters are 4
+_NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _nucleotide in enumerate(NUCLEOTIDES):
+    _NUCLEOTIDE_CODES[ord(_nucleotide)] = _code
+    _NUCLEOTIDE_CODES[ord(_nucleotide.lower())] = _code
+
+# Version of the codon encoding, part of the codon cache key so that caches of older encodings are rebuilt
+CODON_CACHE_VERSION = 2
+
+def new_codon_vocabulary():
+    """
+    Returns a codon vocabulary: a list whose index is the codon ID. The first 64 entries are CODONS.
+    Codons with other characters (e.g. N) and incomplete codons at the end of a CDS are appended, in uppercase,
+    as they are encountered.
+    """
+    return list(CODONS)
+
+def encode_codons(sequence, vocabulary):
+    """
+    Splits a CDS sequence into codons and converts them into integer codon IDs. Lowercase (soft-masked) nucleotides
+    are encoded like uppercase ones.
+
+    Parameters:
+        sequence (str): CDS nucleotide sequence.
+        vocabulary (list): Codon vocabulary from new_codon_vocabulary(). Extended in place with codons outside of CODONS.
+
+    Returns:
+        np.ndarray: uint8 array of codon IDs, one per codon (the last codon may be incomplete).
+    """
+    raw = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+    num_codons = -(-len(raw) // 3)
+    num_complete = len(raw) // 3
+    codes = _NUCLEOTIDE_CODES[raw[:num_complete * 3]].reshape(-1, 3).astype(np.int16)
+
+    ids = np.empty(num_codons, dtype=np.uint8)
+    ids[:num_complete] = codes[:, 0] * 16 + codes[:, 1] * 4 + codes[:, 2]
+    # Codons with characters other than ACGT, e.g., ambiguity codes, are looked up individually
+    for i in np.flatnonzero((codes > 3).any(axis=1)).tolist() + list(range(num_complete, num_codons)):
+        ids[i] = get_codon_id(sequence[i * 3:i * 3 + 3].upper(), vocabulary)
+    return ids
+
+def get_codon_id(codon, vocabulary):
+    """
+    Returns the ID of a codon, appending it to the vocabulary if it is not in it yet.
+    """
+    try:
+        return vocabulary.index(codon)
+    except ValueError:
+        if len(vocabulary) == 256:
+            raise ValueError("Too many distinct codons to encode as uint8.")
+        vocabulary.append(codon)
+        return len(vocabulary) - 1
+
+class CodonCache:
+    """
+    Per-transcript CDS codon IDs, precomputed from the reference file and the CDS ranges of a ribo file.
+    The cache file is only read when the codons are first accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._index = None
+        self._vocabulary = None
+
+    def _load(self):
+        if self._data is None:
+            with np.load(self.path) as data:
+                self._data = {key: data[key] for key in data.files}
+            self._index = {transcript: i for i, transcript in enumerate(self._data['names'].tolist())}
+        return self._data
+
+    @property
+    def names(self):
+        return self._load()['names'].tolist()
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = self._load()['vocabulary'].tolist()
+        return list(self._vocabulary)
+
+    @property
+    def codon_offsets(self):
+        return self._load()['offsets']
+
+    def __contains__(self, transcript):
+        self._load()
+        return transcript in self._index
+
+    def __getitem__(self, transcript):
+        data = self._load()
+        i = self._index[transcript]
+        return data['ids'][data['offsets'][i]:data['offsets'][i + 1]]
+
+def build_codon_cache(path, names, sequence, cds_range):
+    """
+    Encodes the CDS of the given transcripts into codon IDs and saves them as a codon cache file.
+
+    Parameters:
+        path (str): File path of the cache (.npz).
+        names (list): Transcripts to encode.
+        sequence (dict): Dictionary mapping transcript to nucleotide sequence from get_sequence().
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+
+    Returns:
+        CodonCache: The saved cache.
+    """
+    vocabulary = new_codon_vocabulary()
+    codon_ids = []
+    for transcript in names:
+        start, stop = cds_range[transcript]
+        codon_ids.append(encode_codons(sequence[transcript][start: stop], vocabulary))
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in codon_ids], out=offsets[1:])
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path[:-len('.npz')] + '.tmp.npz'
+    np.savez(temp_path,
+             names=np.array(names, dtype=str),
+             offsets=offsets,
+             ids=np.concatenate(codon_ids) if codon_ids else np.zeros(0, dtype=np.uint8),
+             vocabulary=np.array(vocabulary, dtype=str))
+    os.replace(temp_path, path)
+    return CodonCache(path)
+
+def get_codon_cache(ribo_object, ribo_path, reference_file_path, alias, cache_dir=None):
+    """
+    Returns the codon cache of a ribo file and reference file, building it on first use.
+    The cache file is keyed by the fingerprints of both files, so it is rebuilt whenever one of them changes.
+    Its path is absolute, so that the CodonCache can be kept in the stage cache and used from any working directory.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        ribo_path (str): Path to the ribo file of ribo_object.
+        reference_file_path (str): The file path to the reference FASTA file.
+        alias (bool): Whether or not alias is used.
+        cache_dir (str): Directory of the cache files. Defaults to codon_cache in the stage cache directory (see functions_cache.py).
+
+    Returns:
+        CodonCache: Codon IDs of the CDS of all transcripts of the ribo file.
+    """
+    key = hashlib.sha1()
+    for fingerprint in (get_file_fingerprint(reference_file_path), get_file_fingerprint(ribo_path)):
+        key.update(f"{fingerprint['size']}:{fingerprint['sha1']}:".encode())
+    key.update(f'{bool(alias)}:{CODON_CACHE_VERSION}'.encode())
+    path = os.path.abspath(os.path.join(cache_dir or os.path.join(CACHE_DIR, 'codon_cache'), f'codon_ids_{key.hexdigest()[:16]}.npz'))
+
+    if os.path.exists(path):
+        return CodonCache(path)
+    logging.info(f"Building codon cache {path}...")
+    cds_range = get_cds_range_lookup(ribo_object)
+    sequence = get_sequence(ribo_object, reference_file_path, alias)
+    return build_codon_cache(path, list(cds_range.keys()), sequence, cds_range)
+
+def get_cds_codon_ids(sequence, cds_range, transcript, vocabulary):
+    """
+    Returns the codon IDs of the CDS of a transcript, either from a CodonCache or by encoding the sequence.
+    When a CodonCache is given, vocabulary must start with the cache vocabulary.
+
+    Parameters:
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache.
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+        transcript (str): Transcript identifier.
+        vocabulary (list): Codon vocabulary, extended in place when encoding.
+
+    Returns:
+        np.ndarray: uint8 array of codon IDs.
+    """
+    if isinstance(sequence, CodonCache):
+        return sequence[transcript]
+    start, stop = cds_range[transcript]
+    return encode_codons(sequence[transcript][start: stop], vocabulary)
+
+def get_vocabulary(sequence):
+    """
+    Returns a new codon vocabulary for use with get_cds_codon_ids().
+    """
+    if isinstance(sequence, CodonCache):
+        return sequence.vocabulary
+    return new_codon_vocabulary()
+
+def count_cds_codons(sequence, cds_range, transcripts):
+    """
+    Counts each codon within the CDS, excluding the start codon, across the given transcripts.
+
+    Parameters:
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache.
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+        transcripts (list): List of transcripts.
+
+    Returns:
+        dict: A dictionary mapping codon to its number of occurrences.
+    """
+    vocabulary = get_vocabulary(sequence)
+    codon_ids = [get_cds_codon_ids(sequence, cds_range, transcript, vocabulary)[1:] for transcript in transcripts]
+    counts = np.bincount(np.concatenate(codon_ids) if codon_ids else np.zeros(0, dtype=np.uint8), minlength=len(vocabulary))
+    return {vocabulary[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+class CodonBackground:
+    """
+    Codon counts of transcript sets, computed once per set and memoized by a stable hash of the transcript names.
+    Used as the background codon frequencies of the heatmaps.
+    """
+
+    def __init__(self, sequence, cds_range):
+        self.sequence = sequence
+        self.cds_range = cds_range
+        self._counts = {}
+
+    @staticmethod
+    def key(transcripts):
+        """
+        Returns a hash of a transcript set that does not depend on the order of the transcripts.
+        """
+        key = hashlib.sha1()
+        for transcript in sorted(set(transcripts)):
+            key.update(transcript.encode() + b'\n')
+        return key.hexdigest()
+
+    def counts(self, transcripts):
+        """
+        Returns a dictionary mapping codon to its number of occurrences in the CDS of the transcripts (see count_cds_codons()).
+        """
+        key = self.key(transcripts)
+        if key not in self._counts:
+            self._counts[key] = count_cds_codons(self.sequence, self.cds_range, sorted(set(transcripts)))
+        return dict(self._counts[key])
+
+    def frequencies(self, transcripts):
+        """
+        Returns a Series of the frequency of each codon in the CDS of the transcripts.
+        """
+        counts = pd.Series(self.counts(transcripts), dtype=np.float64)
+        return counts / counts.sum()
+
+# Backgrounds of codon caches, keyed by cache path. The cache file name changes whenever the ribo or reference file does.
+_backgrounds = {}
+
+def get_codon_background(sequence, cds_range):
+    """
+    Returns the CodonBackground of a sequence source. Backgrounds of a CodonCache are shared across calls,
+    so that codon counts of a transcript set are only computed once per cache.
+
+    Parameters:
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache.
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+
+    Returns:
+        CodonBackground: Memoized codon counts of transcript sets.
+    """
+    if not isinstance(sequence, CodonCache):
+        return CodonBackground(sequence, cds_range)
+    path = os.path.abspath(sequence.path)
+    if path not in _backgrounds:
+        _backgrounds[path] = CodonBackground(sequence, cds_range)
+    return _backgrounds[path]
+
+def get_codon_occupancy(coverage_dict, sequence, cds_range, start_codon_option):
+    """
+    Counts the footprints at the P-site of each codon within the CDS across all transcripts for every experiment.
+    The codons of every transcript are encoded once and the per-codon coverage of each experiment is counted with a weighted bincount.
+
+    Parameters:
+        coverage_dict (dict): Mapping of experiment to a mapping of transcript to adjusted coverage array from load_coverage().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache.
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+        start_codon_option (int): 1 to count the start codon separately as UUU, 2 to not.
+
+    Returns:
+        DataFrame: Codon column, the total number of each codon in the CDS across all transcripts (Transcriptome)
+                   and one column of raw counts per experiment.
+    """
+    experiments = list(coverage_dict.keys())
+    if not experiments:
+        return pd.DataFrame()
+
+    names = list(coverage_dict[experiments[0]].keys())
+    vocabulary = get_vocabulary(sequence)
+
+    # Codon IDs of all transcripts, concatenated in the order of names
+    codon_ids = [get_cds_codon_ids(sequence, cds_range, transcript, vocabulary) for transcript in names]
+    num_codons = np.array([len(ids) for ids in codon_ids], dtype=np.int64)
+    codon_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(num_codons, out=codon_offsets[1:])
+    codon_ids = np.concatenate(codon_ids) if codon_ids else np.zeros(0, dtype=np.uint8)
+    if start_codon_option == 1:
+        codon_ids[codon_offsets[:-1][num_codons > 0]] = get_codon_id(START_CODON_LABEL, vocabulary)
+
+    # Position of every codon in the concatenated coverage
+    cds_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([stop - start for start, stop in (cds_range[transcript] for transcript in names)], out=cds_offsets[1:])
+    codon_starts = np.arange(len(codon_ids), dtype=np.int64) * 3
+    codon_starts += np.repeat(cds_offsets[:-1] - codon_offsets[:-1] * 3, num_codons)
+
+    df_codon_occ = pd.DataFrame()
+    for exp in experiments:
+        with stage('occupancy', experiment=exp) as metrics:
+            arrays = [coverage_dict[exp].get(transcript) for transcript in names]
+            valid = np.array([coverage is not None for coverage in arrays], dtype=bool)
+            flat = np.zeros(cds_offsets[-1], dtype=np.float64)
+            for i in np.flatnonzero(valid):
+                flat[cds_offsets[i]:cds_offsets[i + 1]] = arrays[i]
+
+            codon_valid = np.repeat(valid, num_codons)
+            if len(flat):
+                codon_coverage = np.add.reduceat(flat, np.minimum(codon_starts, len(flat) - 1))
+            else:
+                codon_coverage = np.zeros(len(codon_ids))
+            occupancy = np.bincount(codon_ids[codon_valid], weights=codon_coverage[codon_valid], minlength=len(vocabulary))
+            codon_counts = np.bincount(codon_ids[codon_valid], minlength=len(vocabulary))
+
+            present = sorted(np.flatnonzero(codon_counts).tolist(), key=lambda i: vocabulary[i])
+            df_temp = pd.DataFrame({'Codon': [vocabulary[i] for i in present], exp: occupancy[present]})
+
+            if df_codon_occ.empty:
+                df_codon_dist = pd.DataFrame({'Codon': [vocabulary[i] for i in present], 'Transcriptome': codon_counts[present]})
+                df_codon_occ = pd.merge(df_codon_dist, df_temp, on='Codon', how='inner')
+            else:
+                df_codon_occ = pd.merge(df_codon_occ, df_temp, on='Codon', how='outer')
+            metrics.add(transcripts=int(valid.sum()))
+
+    return df_codon_occ
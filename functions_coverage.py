@@ -0,0 +1,425 @@
+import os
+import time
+import numpy as np
+import multiprocessing
+import logging
+import ribopy
+from ribopy import Ribo
+from ribopy.settings import EXPERIMENTS_name, REF_DG_COVERAGE
+from ribopy.core.get_gadgets import get_reference_lengths, get_read_length_range, has_coverage_data
+from coverage_store import get_count_dtype, compact_coverage
+from functions_metrics import emit, metrics_enabled, read_bytes, peak_rss_mb, stage, LatencyHistogram
+
+# Default number of nucleotides kept upstream of each CDS in per-read-length coverage; P-site and A-site offsets are smaller
+DEFAULT_FLANK = 30
+
+def get_transcript_layout(ribo_object, cds_range):
+    """
+    Describes where each transcript and its CDS lie in the flat, nucleotide-level coverage vector of the ribo file.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+
+    Returns:
+        dict: A dictionary of arrays in reference order:
+              'names' (transcript identifiers), 'tx_start' (offset of the transcript in the flat coverage vector),
+              'tx_length', 'cds_start' and 'cds_stop' (CDS boundaries relative to the transcript).
+    """
+    tx_length = get_reference_lengths(ribo_object._handle).astype(np.int64)
+    tx_start = np.zeros(len(tx_length), dtype=np.int64)
+    np.cumsum(tx_length[:-1], out=tx_start[1:])
+    boundaries = np.array(list(cds_range.values()), dtype=np.int64).reshape(-1, 2)
+
+    return {
+        'names': list(cds_range.keys()),
+        'tx_start': tx_start,
+        'tx_length': tx_length,
+        'cds_start': boundaries[:, 0],
+        'cds_stop': boundaries[:, 1],
+    }
+
+def get_coverage_info(ribo_object, exp):
+    """
+    Reads the metadata needed to locate the coverage of any read length of an experiment in the ribo file,
+    so that it is read once per experiment instead of once per read length.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        exp (str): Experiment name.
+
+    Returns:
+        tuple: The minimum and maximum read length of the ribo file and the total number of nucleotides of all transcripts.
+    """
+    handle = ribo_object._handle
+    if not has_coverage_data(handle, exp):
+        raise ValueError(f"The experiment {exp} doesn't have coverage data.")
+    length_min, length_max = get_read_length_range(handle)
+    total_nucleotides = int(np.sum(get_reference_lengths(handle), dtype=np.int64))
+    return length_min, length_max, total_nucleotides
+
+def read_length_coverage(ribo_object, exp, read_length, lower, upper, coverage_info=None):
+    """
+    Reads the raw coverage of a single read length for a contiguous stretch of the flat coverage vector.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        exp (str): Experiment name.
+        read_length (int): Read length to read.
+        lower (int): First position of the flat coverage vector to read.
+        upper (int): Position after the last one to read.
+        coverage_info (tuple): Metadata of the experiment from get_coverage_info(). Read from the ribo file if not given.
+
+    Returns:
+        np.ndarray: Coverage of the given read length for positions lower to upper.
+    """
+    if coverage_info is None:
+        coverage_info = get_coverage_info(ribo_object, exp)
+    length_min, length_max, total_nucleotides = coverage_info
+    if not length_min <= read_length <= length_max:
+        raise ValueError(f"Read length {read_length} is outside of the ribo file range {length_min}-{length_max}.")
+
+    base = (read_length - length_min) * total_nucleotides
+    coverage_handle = ribo_object._handle[EXPERIMENTS_name][exp][REF_DG_COVERAGE][REF_DG_COVERAGE]
+    return coverage_handle[base + lower: base + upper]
+
+def get_experiment_coverage(ribo_object, exp, min_len, max_len, layout, offset, indices=None):
+    """
+    Retrieves offset-adjusted CDS coverage for many transcripts of one experiment at once.
+    The coverage of each read length is read once and shifted by its offset for all transcripts together;
+    CDS positions that the shift moves outside the transcript are padded with zeros.
+    Counts are summed in the smallest unsigned integer dtype that holds the largest possible sum, so they cannot overflow.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        exp (str): Experiment name.
+        min_len (int): Minimum read length to be analyzed.
+        max_len (int): Maximum read length to be analyzed.
+        layout (dict): Transcript layout from get_transcript_layout().
+        offset (dict): Dictionary mapping read length to offset from get_psite_offset() or get_asite_offset().
+        indices (array): Sorted indices of the transcripts (in reference order) to process. Defaults to all transcripts.
+
+    Returns:
+        tuple: The concatenated CDS coverage of the transcripts (np.ndarray of read counts) and the CDS offsets into it (np.ndarray of length n + 1).
+    """
+    if indices is None:
+        indices = np.arange(len(layout['names']))
+    indices = np.asarray(indices, dtype=np.int64)
+
+    tx_start = layout['tx_start'][indices]
+    tx_length = layout['tx_length'][indices]
+    cds_start = layout['cds_start'][indices]
+    cds_length = layout['cds_stop'][indices] - cds_start
+
+    cds_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(cds_length, out=cds_offsets[1:])
+    if len(indices) == 0 or cds_offsets[-1] == 0 or min_len > max_len:
+        return np.zeros(cds_offsets[-1], dtype=np.uint8), cds_offsets
+
+    # Read only the stretch of the flat vector spanned by the requested transcripts
+    lower = int(tx_start[0])
+    upper = int(tx_start[-1] + tx_length[-1])
+
+    # Position of every CDS nucleotide within its transcript, before shifting
+    position = np.arange(cds_offsets[-1], dtype=np.int64)
+    position -= np.repeat(cds_offsets[:-1] - cds_start, cds_length)
+    flat_start = np.repeat(tx_start - lower, cds_length)
+    flat_length = np.repeat(tx_length, cds_length)
+
+    coverage_info = get_coverage_info(ribo_object, exp)
+    coverage = None
+    for i in range(min_len, max_len + 1):
+        raw = read_length_coverage(ribo_object, exp, i, lower, upper, coverage_info)
+        if coverage is None:
+            coverage = np.zeros(cds_offsets[-1], dtype=get_count_dtype(int(np.iinfo(raw.dtype).max) * (max_len - min_len + 1)))
+        shifted = position - offset[i]
+        valid = (shifted >= 0) & (shifted < flat_length)
+        if valid.all():
+            coverage += raw[flat_start + shifted]
+        else:
+            coverage[valid] += raw[flat_start[valid] + shifted[valid]]
+
+    return coverage, cds_offsets
+
+def get_experiment_length_coverage(ribo_object, exp, min_len, max_len, layout, flank, indices=None):
+    """
+    Retrieves the coverage of each read length, before applying offsets, over the CDS of many transcripts of one experiment
+    and flank nucleotides upstream of each CDS. Any offset from 0 to flank can later be applied with project_length_coverage()
+    without reading the ribo file again. Positions upstream of the transcript start are padded with zeros.
+
+    Parameters:
+        ribo_object (Ribo): The Ribo object containing ribosome profiling data.
+        exp (str): Experiment name.
+        min_len (int): Minimum read length to keep.
+        max_len (int): Maximum read length to keep.
+        layout (dict): Transcript layout from get_transcript_layout().
+        flank (int): Number of nucleotides kept upstream of each CDS, i.e., the largest offset that can be applied.
+        indices (array): Sorted indices of the transcripts (in reference order) to process. Defaults to all transcripts.
+
+    Returns:
+        tuple: The per-read-length coverage (np.ndarray of read counts with one row per read length from min_len to max_len
+               and one column per position of the concatenated flank and CDS of each transcript) and the offsets of
+               each transcript into its columns (np.ndarray of length n + 1).
+    """
+    if indices is None:
+        indices = np.arange(len(layout['names']))
+    indices = np.asarray(indices, dtype=np.int64)
+
+    tx_start = layout['tx_start'][indices]
+    tx_length = layout['tx_length'][indices]
+    window_start = layout['cds_start'][indices] - flank
+    window_length = layout['cds_stop'][indices] - layout['cds_start'][indices] + flank
+
+    window_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(window_length, out=window_offsets[1:])
+    num_lengths = max(max_len - min_len + 1, 0)
+    if len(indices) == 0 or window_offsets[-1] == 0 or num_lengths == 0:
+        return np.zeros((num_lengths, window_offsets[-1]), dtype=np.uint8), window_offsets
+
+    lower = int(tx_start[0])
+    upper = int(tx_start[-1] + tx_length[-1])
+
+    # Position of every flank and CDS nucleotide within its transcript
+    position = np.arange(window_offsets[-1], dtype=np.int64)
+    position -= np.repeat(window_offsets[:-1] - window_start, window_length)
+    valid = (position >= 0) & (position < np.repeat(tx_length, window_length))
+    index = np.repeat(tx_start - lower, window_length)[valid] + position[valid]
+
+    coverage_info = get_coverage_info(ribo_object, exp)
+    coverage = None
+    for row, i in enumerate(range(min_len, max_len + 1)):
+        raw = read_length_coverage(ribo_object, exp, i, lower, upper, coverage_info)
+        if coverage is None:
+            coverage = np.zeros((num_lengths, window_offsets[-1]), dtype=raw.dtype)
+        coverage[row, valid] = raw[index]
+
+    return compact_coverage(coverage), window_offsets
+
+def project_length_coverage(length_coverage, cds_offsets, flank, first_len, offset, min_len=None, max_len=None):
+    """
+    Sums per-read-length coverage into the offset-adjusted CDS coverage, as get_experiment_coverage() would from the ribo file.
+    Each read length is shifted by its offset for all transcripts together, so any offset table or range of read lengths
+    can be tried in seconds.
+
+    Parameters:
+        length_coverage (np.ndarray): Per-read-length coverage from get_experiment_length_coverage() or CoverageStore.length_coverage().
+        cds_offsets (np.ndarray): CDS offsets of its transcripts into the concatenated coverage (length n + 1).
+        flank (int): Number of nucleotides upstream of each CDS in length_coverage.
+        first_len (int): Read length of the first row of length_coverage.
+        offset (dict): Dictionary mapping read length to offset from 0 to flank, e.g., from get_offsets().
+        min_len (int): Minimum read length to sum. Defaults to first_len.
+        max_len (int): Maximum read length to sum. Defaults to the read length of the last row.
+
+    Returns:
+        np.ndarray: The concatenated CDS coverage of the transcripts in the smallest count dtype.
+    """
+    cds_offsets = np.asarray(cds_offsets, dtype=np.int64)
+    last_len = first_len + len(length_coverage) - 1
+    min_len = first_len if min_len is None else min_len
+    max_len = last_len if max_len is None else max_len
+    if min_len < first_len or max_len > last_len:
+        raise ValueError(f"Read lengths {min_len}-{max_len} are outside of the kept read lengths {first_len}-{last_len}.")
+    for i in range(min_len, max_len + 1):
+        if not 0 <= offset[i] <= flank:
+            raise ValueError(f"Offset {offset[i]} of read length {i} is outside of the kept flank 0-{flank}.")
+
+    # Column of every CDS nucleotide for an offset of 0
+    cds_length = np.diff(cds_offsets)
+    column = np.arange(cds_offsets[-1], dtype=np.int64) + flank
+    column += np.repeat(np.arange(len(cds_length), dtype=np.int64) * flank, cds_length)
+
+    coverage = np.zeros(cds_offsets[-1], dtype=get_count_dtype(
+        int(np.iinfo(length_coverage.dtype).max) * max(max_len - min_len + 1, 0)))
+    for i in range(min_len, max_len + 1):
+        coverage += length_coverage[i - first_len][column - offset[i]]
+    return compact_coverage(coverage)
+
+def project_store_coverage(store, exp, offset, min_len=None, max_len=None):
+    """
+    Projects the adjusted coverage of one experiment of a coverage store from its per-read-length coverage, see project_length_coverage().
+
+    Parameters:
+        store (CoverageStore): Coverage store with per-read-length coverage, e.g., written by adj_coverage.py with read lengths kept.
+        exp (str): Experiment name.
+        offset (dict): Dictionary mapping read length to offset.
+        min_len (int): Minimum read length to sum. Defaults to the smallest kept read length.
+        max_len (int): Maximum read length to sum. Defaults to the largest kept read length.
+
+    Returns:
+        np.ndarray: The concatenated CDS coverage laid out according to the store offsets.
+    """
+    kept = store.length_coverage(exp)
+    if kept is None:
+        raise ValueError(f"{exp} of {store.path} has no per-read-length coverage.")
+    length_coverage, info = kept
+    return project_length_coverage(length_coverage, store.cds_offsets, info['flank'], info['min_len'], offset, min_len, max_len)
+
+def split_coverage(coverage, cds_offsets, names):
+    """
+    Splits concatenated CDS coverage into per-transcript arrays without copying.
+
+    Parameters:
+        coverage (np.ndarray): Concatenated CDS coverage from get_experiment_coverage().
+        cds_offsets (np.ndarray): CDS offsets into coverage.
+        names (list): Transcript identifiers in the same order as the offsets.
+
+    Returns:
+        dict: A dictionary mapping transcript to its adjusted coverage array.
+    """
+    return {name: coverage[cds_offsets[i]:cds_offsets[i + 1]] for i, name in enumerate(names)}
+
+def get_transcript_chunks(layout, num_chunks):
+    """
+    Splits the transcripts into contiguous chunks of roughly equal CDS length.
+    Contiguous chunks let each task read a single stretch of the ribo file coverage.
+
+    Parameters:
+        layout (dict): Transcript layout from get_transcript_layout().
+        num_chunks (int): Desired number of chunks.
+
+    Returns:
+        list: A list of (lower, upper) transcript index ranges covering all transcripts in order.
+    """
+    num_transcripts = len(layout['names'])
+    cumulative = np.cumsum(layout['cds_stop'] - layout['cds_start'])
+    if num_transcripts == 0:
+        return []
+    targets = cumulative[-1] * np.arange(1, num_chunks) / num_chunks
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(cumulative, targets, side='right'), [num_transcripts])))
+    return [(int(lower), int(upper)) for lower, upper in zip(bounds[:-1], bounds[1:])]
+
+# State of a coverage worker process, set once by init_coverage_worker
+_worker_state = {}
+
+def init_coverage_worker(ribo_path, alias, layout, offsets, min_len, max_len, flank=None):
+    """
+    Initializes a worker process of the coverage pool with its own Ribo handle and the shared lookup tables.
+
+    Parameters:
+        ribo_path (str): Path to the ribo file.
+        alias (bool): Whether or not alias is used.
+        layout (dict): Transcript layout from get_transcript_layout().
+        offsets (dict): Dictionary mapping experiment to its offset dictionary.
+        min_len (int): Minimum read length to be analyzed.
+        max_len (int): Maximum read length to be analyzed.
+        flank (int): If given, workers compute per-read-length coverage with this flank instead of adjusted coverage.
+    """
+    if alias == True:
+        ribo_object = Ribo(ribo_path, alias=ribopy.api.alias.apris_human_alias)
+    else:
+        ribo_object = Ribo(ribo_path)
+    _worker_state.update(ribo_object=ribo_object, layout=layout, offsets=offsets, min_len=min_len, max_len=max_len, flank=flank)
+
+def process_chunk(task):
+    """
+    Computes the adjusted coverage of one (experiment, transcript chunk) task in a worker initialized by init_coverage_worker().
+
+    Parameters:
+        task (tuple): Experiment name and (lower, upper) transcript index range.
+
+    Returns:
+        tuple: The task, the concatenated CDS coverage of its transcripts in the smallest count dtype (or their per-read-length
+               coverage if the worker was initialized with a flank) and, when metrics are on,
+               the worker's pid, task seconds, bytes read and peak RSS (otherwise None).
+    """
+    exp, (lower, upper) = task
+    if metrics_enabled():
+        start, start_read = time.perf_counter(), read_bytes()
+    if _worker_state['flank'] is None:
+        coverage, _ = get_experiment_coverage(_worker_state['ribo_object'], exp,
+                                              _worker_state['min_len'], _worker_state['max_len'],
+                                              _worker_state['layout'], _worker_state['offsets'][exp],
+                                              np.arange(lower, upper))
+    else:
+        coverage, _ = get_experiment_length_coverage(_worker_state['ribo_object'], exp,
+                                                     _worker_state['min_len'], _worker_state['max_len'],
+                                                     _worker_state['layout'], _worker_state['flank'],
+                                                     np.arange(lower, upper))
+    task_metrics = None
+    if metrics_enabled():
+        end_read = read_bytes()
+        task_metrics = {'pid': os.getpid(), 'seconds': time.perf_counter() - start,
+                        'read_bytes': None if start_read is None or end_read is None else end_read - start_read,
+                        'process_peak_rss_mb': peak_rss_mb()}
+    # Compact counts also make the coverage cheaper to send back to the parent process
+    return task, compact_coverage(coverage), task_metrics
+
+def compute_coverages(ribo_path, alias, layout, offsets, min_len, max_len, experiments, num_workers=None, flank=None):
+    """
+    Computes the adjusted coverage of experiments in one multiprocessing pool.
+    All (experiment, transcript chunk) pairs are scheduled on the same pool so that workers stay busy across experiments,
+    and experiments can finish out of order.
+
+    Parameters:
+        ribo_path (str): Path to the ribo file.
+        alias (bool): Whether or not alias is used.
+        layout (dict): Transcript layout from get_transcript_layout().
+        offsets (dict): Dictionary mapping experiment to its offset dictionary.
+        min_len (int): Minimum read length to be analyzed.
+        max_len (int): Maximum read length to be analyzed.
+        experiments (list): Experiments to compute.
+        num_workers (int): Number of worker processes. Defaults to the number of CPUs.
+        flank (int): If given, the per-read-length coverage of each experiment is also kept, with this flank
+                     (see get_experiment_length_coverage()), and the adjusted coverage is projected from it.
+
+    Yields:
+        tuple: Experiment name and its concatenated CDS coverage in the order of the layout, as each experiment is finished,
+               followed by its per-read-length coverage if flank is given.
+               The coverage has the smallest count dtype that holds the counts of all its chunks.
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    cds_offsets = np.zeros(len(layout['names']) + 1, dtype=np.int64)
+    np.cumsum(layout['cds_stop'] - layout['cds_start'], out=cds_offsets[1:])
+    # Columns of each transcript in the chunk results: its CDS, preceded by the flank for per-read-length coverage
+    column_offsets = cds_offsets
+    shape = ()
+    if flank is not None:
+        for exp in experiments:
+            if not all(0 <= offsets[exp][i] <= flank for i in range(min_len, max_len + 1)):
+                raise ValueError(f"The offsets of {exp} must be from 0 to the flank of {flank}.")
+        column_offsets = cds_offsets + flank * np.arange(len(cds_offsets), dtype=np.int64)
+        shape = (max_len - min_len + 1,)
+    chunks = get_transcript_chunks(layout, num_workers * 4)
+    tasks = [(exp, chunk) for exp in experiments for chunk in chunks]
+    pending = {exp: len(chunks) for exp in experiments}
+    coverages = {}
+    # Task metrics reported by the workers, summed per experiment and collected into one latency histogram per worker
+    worker_metrics = {}
+    experiment_metrics = {exp: {'worker_s': 0.0, 'read_bytes': 0} for exp in experiments}
+    start = time.perf_counter()
+
+    with stage('coverage', experiments=len(experiments), workers=num_workers) as metrics, \
+            multiprocessing.Pool(num_workers, initializer=init_coverage_worker,
+                                 initargs=(ribo_path, alias, layout, offsets, min_len, max_len, flank)) as pool:
+        for (exp, (lower, upper)), chunk_coverage, task_metrics in pool.imap_unordered(process_chunk, tasks):
+            if exp not in coverages:
+                logging.info(f"Receiving {exp}...")
+                coverages[exp] = np.zeros(shape + (column_offsets[-1],), dtype=chunk_coverage.dtype)
+            elif not np.can_cast(chunk_coverage.dtype, coverages[exp].dtype):
+                coverages[exp] = coverages[exp].astype(chunk_coverage.dtype)
+            coverages[exp][..., column_offsets[lower]:column_offsets[upper]] = chunk_coverage
+            if task_metrics is not None:
+                worker = worker_metrics.setdefault(task_metrics['pid'], {'latency': LatencyHistogram(), 'read_bytes': 0, 'process_peak_rss_mb': None})
+                worker['latency'].add(task_metrics['seconds'])
+                worker['read_bytes'] += task_metrics['read_bytes'] or 0
+                if task_metrics['process_peak_rss_mb'] is not None:
+                    worker['process_peak_rss_mb'] = max(worker['process_peak_rss_mb'] or 0.0, task_metrics['process_peak_rss_mb'])
+                experiment_metrics[exp]['worker_s'] += task_metrics['seconds']
+                experiment_metrics[exp]['read_bytes'] += task_metrics['read_bytes'] or 0
+            pending[exp] -= 1
+            if pending[exp] == 0:
+                num_transcripts = len(layout['names'])
+                worker_s = experiment_metrics[exp]['worker_s']
+                emit('experiment', stage='coverage', experiment=exp, wall_s=time.perf_counter() - start, worker_s=worker_s,
+                     transcripts=num_transcripts, transcripts_per_s=num_transcripts / worker_s if worker_s > 0 else None,
+                     read_bytes=experiment_metrics[exp]['read_bytes'])
+                metrics.add(transcripts=num_transcripts)
+                if flank is None:
+                    yield exp, coverages.pop(exp)
+                else:
+                    length_coverage = coverages.pop(exp)
+                    yield exp, project_length_coverage(length_coverage, cds_offsets, flank, min_len, offsets[exp]), length_coverage
+
+    for pid, worker in worker_metrics.items():
+        emit('worker_latency', stage='coverage', worker_pid=pid, read_bytes=worker['read_bytes'],
+             process_peak_rss_mb=worker['process_peak_rss_mb'], **worker['latency'].to_dict())
@@ -1,51 +1,151 @@
-import pickle
-import gzip
-from scipy.stats import zscore
+import numpy as np
+from collections.abc import Mapping
+from coverage_store import CoverageSession, get_coverage_session, get_coverage_summary
+from functions_metrics import stage
+
+class SegmentedArray(Mapping):
+    """
+    Read-only mapping of transcript to a segment of one concatenated array, e.g., z-scores or stall site masks.
+    Segments are kept in reference order and returned as views without copying.
+    """
+
+    def __init__(self, names, flat, offsets):
+        self.names = list(names)
+        self.flat = flat
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._index = None
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, transcript):
+        if self._index is None:
+            self._index = {name: i for i, name in enumerate(self.names)}
+        i = self._index[transcript]
+        return self.flat[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        for i, name in enumerate(self.names):
+            yield name, self.flat[self.offsets[i]:self.offsets[i + 1]]
+
+    def local_positions(self):
+        """
+        Returns the position of every element of flat within its own segment.
+        """
+        return np.arange(len(self.flat), dtype=np.int64) - np.repeat(self.offsets[:-1], self.lengths)
+
+def get_reference_transcripts(coverage_dict, exp):
+    """
+    Returns all transcripts of an experiment in reference order.
+    """
+    if isinstance(coverage_dict, CoverageSession):
+        return coverage_dict.transcripts(exp)
+    return list(coverage_dict[exp])
+
+def get_top_indices(density, top_n):
+    """
+    Selects the indices of the top_n highest densities with a partial selection instead of a full sort.
+    Ties at the cutoff are broken in favor of earlier indices, and NaN densities are never selected.
+
+    Parameters:
+        density (np.ndarray): Density of each transcript in reference order.
+        top_n (int): Number of indices to select.
+
+    Returns:
+        np.ndarray: Selected indices in increasing order.
+    """
+    valid = np.flatnonzero(~np.isnan(density))
+    if top_n <= 0:
+        return valid[:0]
+    if top_n >= len(valid):
+        return valid
+
+    values = density[valid]
+    cutoff = np.partition(values, len(values) - top_n)[len(values) - top_n]
+    above = valid[values > cutoff]
+    ties = valid[values == cutoff][:top_n - len(above)]
+    return np.sort(np.concatenate((above, ties)))
 
 def get_filtered_transcripts(pkl_gz_path, experiments, top_n):
     """
     Finds top_n number of highly expressed transcripts based on the coverage density, calculated as the number of reads per nucleotide.
+    Transcripts with equal density are ranked in reference order.
     If more than one experiment is given, the intersection of these filtered transcripts of the given experiments will be returned.
 
     Parameters:
-        pkl_gz_path (str): File path to the gzipped pickle file generated using adj_coverage.py.
+        pkl_gz_path (str or CoverageSession): Coverage store directory or file path to the gzipped pickle file generated using adj_coverage.py, or an open CoverageSession.
         experiments (str): Experiments used in analysis, specifically in codon_heatmaps.py.
         top_n (int): Number of transcripts with the highest coverage density.
 
     Returns:
         list: A list of transcripts with the highest coverage density. 
     """
-    with gzip.open(pkl_gz_path, 'rb') as f:
-        coverage_dict = pickle.load(f)
+    with stage('filter_transcripts', experiments=len(experiments), top_n=top_n) as metrics:
+        coverage_dict = get_coverage_session(pkl_gz_path)
 
-    all_transcript_list = []
-    for exp in experiments:
-        exp_transcripts = [(transcript, sum(coverage) / len(coverage)) for transcript, coverage in coverage_dict[exp].items() if coverage is not None]
-        exp_transcripts.sort(key=lambda x: x[1], reverse=True)  # Sort transcripts based on density
-        top_transcripts = [transcript for transcript, density in exp_transcripts[:top_n]]  # Select top n transcripts
-        all_transcript_list.append(set(top_transcripts))  # Convert to set for efficient intersection
+        all_transcript_list = []
+        for exp in experiments:
+            # Densities come from the summary table, so no coverage array is read
+            names, summary = get_coverage_summary(coverage_dict, exp)
+            top_indices = get_top_indices(summary['density'], top_n)  # Select top n transcripts
+            all_transcript_list.append({names[i] for i in top_indices})  # Convert to set for efficient intersection
     
-    if all_transcript_list:
-        filtered_transcripts = set.intersection(*all_transcript_list)
-    else:
-        filtered_transcripts = set() 
+        if all_transcript_list:
+            filtered_transcripts = set.intersection(*all_transcript_list)
+        else:
+            filtered_transcripts = set() 
     
-    return filtered_transcripts
+        metrics.add(transcripts=len(filtered_transcripts))
+        return filtered_transcripts
 
 def get_filtered_zscores(pkl_gz_path, transcripts, exp):
     """
     Normalizes coverage data into z-scores for the given transcripts for the given experiment.
+    The z-scores of all transcripts are computed together in one concatenated array with segment reductions.
 
     Parameters:
-        pkl_gz_path (str): File path to the gzipped pickle file generated using adj_coverage.py.
+        pkl_gz_path (str or CoverageSession): Coverage store directory or file path to the gzipped pickle file generated using adj_coverage.py, or an open CoverageSession.
         Transcripts (list): List of transcripts used in analysis, specifically in codon_heatmaps.py.
         exp (str): Experiment name.
 
     Returns:
-        dict: A dictionary mapping transcript to z-scores of coverage data. 
+        SegmentedArray: A mapping of transcript to z-scores of coverage data, in reference order.
     """
-    with gzip.open(pkl_gz_path, 'rb') as f:
-        coverage_dict = pickle.load(f)
-    zscores = {transcript: zscore(coverage) for transcript, coverage in coverage_dict[exp].items() 
-               if coverage is not None and transcript in transcripts}
-    return zscores
\ No newline at end of file
+    with stage('zscores', experiment=exp) as metrics:
+        coverage_dict = get_coverage_session(pkl_gz_path)
+        exp_coverage = coverage_dict[exp]
+        names = []
+        arrays = []
+        for transcript in get_reference_transcripts(coverage_dict, exp):
+            if transcript in transcripts:
+                coverage = exp_coverage[transcript]
+                if coverage is not None:
+                    names.append(transcript)
+                    arrays.append(coverage)
+
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(coverage) for coverage in arrays], out=offsets[1:])
+        flat = np.concatenate(arrays).astype(np.float64, copy=False) if arrays else np.zeros(0)
+        zscores = SegmentedArray(names, flat, offsets)
+
+        # Segment means and population standard deviations, as in scipy.stats.zscore
+        lengths = zscores.lengths
+        nonempty = lengths > 0
+        mean = np.zeros(len(names))
+        std = np.zeros(len(names))
+        if nonempty.any():
+            starts = offsets[:-1][nonempty]
+            mean[nonempty] = np.add.reduceat(flat, starts) / lengths[nonempty]
+            flat -= np.repeat(mean, lengths)
+            std[nonempty] = np.sqrt(np.add.reduceat(flat * flat, starts) / lengths[nonempty])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            flat /= np.repeat(std, lengths)
+        metrics.add(transcripts=len(names))
+        return zscores
\ No newline at end of file
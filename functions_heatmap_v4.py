@@ -1,7 +1,12 @@
 import ribopy
 from ribopy import Ribo
-from functions import get_cds_range_lookup, get_sequence
-from functions_filter import get_filtered_transcripts, get_filtered_zscores
+from functions import get_cds_range_lookup, get_sequence, get_file_fingerprint
+from functions_filter import get_filtered_transcripts, get_filtered_zscores, get_reference_transcripts, SegmentedArray
+from coverage_store import CoverageSession, get_coverage_session, get_coverage_fingerprint
+from functions_cache import get_stage_cache
+from functions_codon import get_codon_background, get_codon_cache, get_cds_codon_ids, get_vocabulary
+from functions_metrics import stage
+import os
 import pickle
 from scipy.stats import zscore
 import numpy as np
@@ -12,120 +17,427 @@ import plotly.io as pio
 from plotly.subplots import make_subplots
 import gzip
 
-def calculate_threshold(zscores, percentile):
+# Number of z-scores of a SegmentedArray fed to the QuantileSketch at once
+SKETCH_CHUNK_SIZE = 1 << 20
+
+class QuantileSketch:
+    """
+    Fixed-memory, mergeable quantile sketch with a relative error bound, in the manner of DDSketch.
+    Values are counted in logarithmic buckets, so any quantile is returned within relative_error of the exact value.
+    Magnitudes below min_value are counted as zero and magnitudes above max_value are counted in the last bucket.
+    """
+
+    def __init__(self, relative_error=0.01, min_value=1e-9, max_value=1e9):
+        if not 0 < relative_error < 1:
+            raise ValueError("relative_error must be between 0 and 1.")
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.min_value = min_value
+        self.min_key = self._key(min_value)
+        num_buckets = self._key(max_value) - self.min_key + 1
+        self.positive = np.zeros(num_buckets, dtype=np.int64)
+        self.negative = np.zeros(num_buckets, dtype=np.int64)
+        self.zero_count = 0
+        self.nan_count = 0
+
+    def _key(self, magnitude):
+        return int(np.ceil(np.log(magnitude) / np.log(self.gamma)))
+
+    def _bucket_counts(self, magnitudes):
+        keys = np.ceil(np.log(magnitudes) / np.log(self.gamma)).astype(np.int64) - self.min_key
+        np.clip(keys, 0, len(self.positive) - 1, out=keys)
+        return np.bincount(keys, minlength=len(self.positive))
+
+    @property
+    def count(self):
+        return int(self.positive.sum() + self.negative.sum()) + self.zero_count + self.nan_count
+
+    def add(self, values):
+        """
+        Adds an array of values to the sketch.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        nan = np.isnan(values)
+        self.nan_count += int(nan.sum())
+        values = values[~nan]
+        magnitudes = np.abs(values)
+        zero = magnitudes < self.min_value
+        self.zero_count += int(zero.sum())
+        self.positive += self._bucket_counts(magnitudes[~zero & (values > 0)])
+        self.negative += self._bucket_counts(magnitudes[~zero & (values < 0)])
+
+    def merge(self, other):
+        """
+        Adds the counts of another sketch with the same parameters to this sketch.
+        """
+        if (other.gamma, other.min_key, len(other.positive)) != (self.gamma, self.min_key, len(self.positive)):
+            raise ValueError("Only sketches with the same parameters can be merged.")
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zero_count += other.zero_count
+        self.nan_count += other.nan_count
+
+    def percentile(self, percentile):
+        """
+        Returns the approximate percentile of the added values. Like np.percentile, NaN is returned if any value was NaN.
+        """
+        if self.nan_count:
+            return np.nan
+        count = self.count
+        if count == 0:
+            raise IndexError("Cannot calculate a percentile of an empty sketch.")
+        rank = percentile / 100 * (count - 1)
+
+        # Walk the buckets from the most negative to the most positive value
+        negative_cumulative = np.cumsum(self.negative[::-1])
+        if rank < negative_cumulative[-1]:
+            key = len(self.negative) - 1 - np.searchsorted(negative_cumulative, rank, side='right')
+            return -self._bucket_value(key)
+        rank -= negative_cumulative[-1]
+        if rank < self.zero_count:
+            return 0.0
+        rank -= self.zero_count
+        key = min(np.searchsorted(np.cumsum(self.positive), rank, side='right'), len(self.positive) - 1)
+        return self._bucket_value(key)
+
+    def _bucket_value(self, key):
+        return 2 * self.gamma ** (key + self.min_key) / (self.gamma + 1)
+
+def calculate_threshold(zscores, percentile, relative_error=None):
     """
     Calculates threshold to determine stall sites based on the given percentile. 
+    The first 18 and last 15 positions of each transcript are excluded.
 
     Parameters:
-        zscores (dict): Dictionary mapping transcript to an array of the respective coverage data normalized into z-scores. 
+        zscores (dict or SegmentedArray): Mapping of transcript to an array of the respective coverage data normalized into z-scores. 
         percentile (float): Percentile to determine threshold. In codon_heatmaps.py, this is defaulted to the 99th percentile.
+        relative_error (float): If given, the threshold is approximated with a fixed-memory QuantileSketch within this relative error
+                                instead of being calculated exactly.
 
     Returns:
         float: The z-score cutoff to determine stall sites.
     """
-    all_zscores = [score for z_scores in zscores.values() for score in z_scores[18:-15]]
-    return np.percentile(all_zscores, percentile)
+    if relative_error is not None:
+        sketch = QuantileSketch(relative_error)
+        if isinstance(zscores, SegmentedArray):
+            # Feed fixed-size chunks of the flat z-scores so memory stays fixed
+            for start in range(0, len(zscores.flat), SKETCH_CHUNK_SIZE):
+                positions = np.arange(start, min(start + SKETCH_CHUNK_SIZE, len(zscores.flat)), dtype=np.int64)
+                segments = np.searchsorted(zscores.offsets, positions, side='right') - 1
+                local = positions - zscores.offsets[segments]
+                chunk = zscores.flat[start:start + SKETCH_CHUNK_SIZE]
+                sketch.add(chunk[(local >= 18) & (local < zscores.lengths[segments] - 15)])
+        else:
+            for z_scores in zscores.values():
+                sketch.add(z_scores[18:-15])
+        return sketch.percentile(percentile)
+
+    # np.percentile may partition the new array of trimmed z-scores in place
+    return np.percentile(get_trimmed_zscores(zscores), percentile, overwrite_input=True)
 
-def find_common_stall_sites(replicates, pickle_path, transcripts, percentile):
+def get_trimmed_zscores(zscores):
+    """
+    Collects the z-scores of all transcripts, excluding the first 18 and last 15 positions of each transcript.
+
+    Parameters:
+        zscores (dict or SegmentedArray): Mapping of transcript to an array of the respective coverage data normalized into z-scores.
+
+    Returns:
+        ndarray: New array of the trimmed z-scores of all transcripts.
+    """
+    if isinstance(zscores, SegmentedArray):
+        # Same positions as z_scores[18:-15] of every segment, selected in one step
+        local = zscores.local_positions()
+        return zscores.flat[(local >= 18) & (local < np.repeat(zscores.lengths, zscores.lengths) - 15)]
+
+    # Copy the trimmed z-scores into one preallocated buffer
+    total = sum(len(z_scores[18:-15]) for z_scores in zscores.values())
+    all_zscores = np.empty(total, dtype=np.float64)
+    position = 0
+    for z_scores in zscores.values():
+        trimmed = z_scores[18:-15]
+        all_zscores[position:position + len(trimmed)] = trimmed
+        position += len(trimmed)
+    return all_zscores
+
+def find_common_stall_sites(replicates, pickle_path, transcripts, percentile, relative_error=None, zscores=None):
     """
     Finds common stall sites across replicates.
 
     Parameters:
         replicates (list): List of replicates.
-        pickle_path (str): File path to gzipped pickle file.
+        pickle_path (str or CoverageSession): Coverage path or an open CoverageSession. Pass a session to load the coverage only once for all replicates.
         transcripts (list): List of transcripts.
         percentile (float): Percentile to determine threshold.
+        relative_error (float): If given, thresholds are approximated within this relative error, see calculate_threshold().
+        zscores (dict): Dictionary mapping replicate to its z-scores from get_filtered_zscores(), if already computed.
 
     Returns:
-        dict: Dictionary mapping transcript to an array of booleans, each value representing the presence of a common stall site at each nucleotide position. 
-              True represents stall site.
-    """
-    common_stall_sites = {}
-    for exp in replicates:
-        zscores = get_filtered_zscores(pickle_path, transcripts, exp)        
-        threshold = calculate_threshold(zscores, percentile)
-
-        for transcript, zscore in zscores.items():
-            stall_sites = zscore > threshold
-            if transcript not in common_stall_sites:
-                common_stall_sites[transcript] = [stall_sites]
-            else:
-                common_stall_sites[transcript].append(stall_sites)
-    
-    # Intersection of stall sites
-    for transcript, stall_sites_list in common_stall_sites.items():
-        common_stall_sites[transcript] = np.all(stall_sites_list, axis=0)
-    
-    return common_stall_sites
+        SegmentedArray: Mapping of transcript to an array of booleans, each value representing the presence of a common stall site at each nucleotide position. 
+                        True represents stall site. Transcripts are in reference order.
+    """
+    with stage('stall_sites', experiment=replicates[0], replicates=len(replicates), percentile=percentile) as metrics:
+        pickle_path = get_coverage_session(pickle_path)
+        zscores = zscores or {}
+        stall_sites = {}
+        for exp in replicates:
+            exp_zscores = zscores[exp] if exp in zscores else get_filtered_zscores(pickle_path, transcripts, exp)
+            threshold = calculate_threshold(exp_zscores, percentile, relative_error)
+            stall_sites[exp] = (exp_zscores, exp_zscores.flat > threshold)
+
+        # Intersection of stall sites; transcripts missing from a replicate are not constrained by it
+        metrics.add(transcripts=len(transcripts))
+        return _combine_replicates(stall_sites, pickle_path, replicates, True, np.logical_and)
+
+def _combine_replicates(values, coverage, replicates, initial, combine):
+    # Combines per-position values of each replicate, given as (z-scores, values on the layout of the z-scores),
+    # on one layout of every transcript with z-scores in any replicate, in reference order
+    all_names = [exp_zscores.names for exp_zscores, _ in values.values()]
+    if all(exp_names == all_names[0] for exp_names in all_names):
+        names = all_names[0] if all_names else []
+    else:
+        present = set().union(*all_names)
+        names = [transcript for transcript in get_reference_transcripts(coverage, replicates[0]) if transcript in present]
+    lengths = {}
+    for exp_zscores, _ in values.values():
+        lengths.update(zip(exp_zscores.names, exp_zscores.lengths))
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([lengths[transcript] for transcript in names], out=offsets[1:])
+    index = {transcript: i for i, transcript in enumerate(names)}
+
+    dtype = next(iter(values.values()))[1].dtype if values else bool
+    combined = np.full(offsets[-1], initial, dtype=dtype)
+    for exp_zscores, exp_values in values.values():
+        if exp_zscores.names == names:
+            combine(combined, exp_values, out=combined)
+        else:
+            segments = np.array([index[transcript] for transcript in exp_zscores.names], dtype=np.int64)
+            positions = exp_zscores.local_positions() + np.repeat(offsets[segments], exp_zscores.lengths)
+            combined[positions] = combine(combined[positions], exp_values)
+
+    return SegmentedArray(names, combined, offsets)
+
+class StallCodonMatrix:
+    """
+    Codon IDs at and around every stall site, one row per stall site and one column per codon from -5 to 5.
+    Rows are ordered by transcript, in the order of the stall site masks, and by position within the transcript.
+    levels holds the stall level of each row, or True for every row of boolean stall site masks.
+    """
+
+    def __init__(self, transcripts, positions, ids, vocabulary, levels=None):
+        self.transcripts = transcripts
+        self.positions = positions
+        self.ids = ids
+        self.vocabulary = vocabulary
+        self.levels = levels
+
+    def __len__(self):
+        return len(self.ids)
+
+    def codons(self):
+        """
+        Returns the codons of the matrix as a 2D array of strings.
+        """
+        return np.array(self.vocabulary, dtype=object)[self.ids]
+
+def get_stall_codon_matrix(common_stall_sites, sequence, cds_range, upstream=5, downstream=5):
+    """
+    Finds the codons at and around stall sites in one pass over all transcripts.
+    A codon is a stall site if any of its nucleotides is one, skipping the first 18 and last 15 nucleotides of the CDS.
+    Instead of booleans, the stall sites may be given as integer stall levels, see sweep_stall_sites(); the level of a codon
+    is then the highest level of its nucleotides and codons of level 0 are not stall sites.
+
+    Parameters:
+        common_stall_sites (dict or SegmentedArray): Mapping of transcript to an array of booleans at each nucleotide position representing stall sites from find_common_stall_sites().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+        upstream (int): Number of codons before the stall site codon.
+        downstream (int): Number of codons after the stall site codon.
+
+    Returns:
+        StallCodonMatrix: Codon IDs of the upstream + 1 + downstream codons of every stall site.
+    """
+    if not isinstance(common_stall_sites, SegmentedArray):
+        names = list(common_stall_sites)
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(common_stall_sites[transcript]) for transcript in names], out=offsets[1:])
+        flat = np.concatenate([common_stall_sites[transcript] for transcript in names]) \
+            if names else np.zeros(0, dtype=bool)
+        if flat.dtype.kind not in 'iu':
+            flat = flat.astype(bool)
+        common_stall_sites = SegmentedArray(names, flat, offsets)
+    names = common_stall_sites.names
+    lengths = common_stall_sites.lengths
+
+    # Codon IDs of all transcripts concatenated, with offsets per transcript
+    vocabulary = get_vocabulary(sequence)
+    codon_ids = [get_cds_codon_ids(sequence, cds_range, transcript, vocabulary) for transcript in names]
+    codon_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in codon_ids], out=codon_offsets[1:])
+    all_codon_ids = np.concatenate(codon_ids) if codon_ids else np.zeros(0, dtype=np.uint8)
+
+    # Codon index within its transcript for every codon of the stall site masks
+    num_codons = (lengths + 2) // 3
+    mask_codon_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(num_codons, out=mask_codon_offsets[1:])
+    segment = np.repeat(np.arange(len(names)), num_codons)
+    codon_index = np.arange(mask_codon_offsets[-1], dtype=np.int64) - mask_codon_offsets[segment]
+
+    # A codon is stalled if any of its nucleotides is; the codons are those of range(start + 18, stop - 15, 3)
+    levels = np.zeros(len(segment), dtype=common_stall_sites.flat.dtype)
+    if len(segment):
+        levels = np.maximum.reduceat(common_stall_sites.flat, common_stall_sites.offsets[segment] + 3 * codon_index)
+    selected = np.flatnonzero((levels > 0) & (codon_index >= 6) & (3 * codon_index < lengths[segment] - 15))
+
+    site_segment = segment[selected]
+    site_codon = codon_offsets[site_segment] + codon_index[selected]
+    ids = all_codon_ids[site_codon[:, None] + np.arange(-upstream, downstream + 1)]
+    cds_start = np.array([cds_range[transcript][0] for transcript in names], dtype=np.int64)
+    return StallCodonMatrix(np.array(names, dtype=object)[site_segment],
+                            cds_start[site_segment] + 3 * codon_index[selected],
+                            ids, vocabulary, levels[selected])
 
 def collect_stall_sequences(common_stall_sites, sequence, cds_range):
     """
     Finds codon sequences at and around stall sites.
 
     Parameters: 
-        common_stall_sites (dict): Dictionary mapping transcript to an array of booleans at each nucleotide position representing stall sites from find_common_stall_sites().
-        sequence (dict): Dictionary mapping transcript to nucleotide sequence from get_sequence().
+        common_stall_sites (dict or SegmentedArray): Mapping of transcript to an array of booleans at each nucleotide position representing stall sites from find_common_stall_sites().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
         cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
 
     Returns:
         list: A list of stall sequences including 5 codons downstream and 5 codons upstream of the stall site codon.
     """
-    stall_sequences = []
-    for transcript, stall_sites in common_stall_sites.items():
-        start, stop = cds_range[transcript]
-        for i in range(start + 18, stop - 15, 3):
-            if stall_sites[i - start:i - start + 3].any():
-                stall_sequences.append(sequence[transcript][i - 15:i + 18])
-    return stall_sequences
+    return [''.join(codons) for codons in get_stall_codon_matrix(common_stall_sites, sequence, cds_range).codons()]
 
 def create_raw_heatmap(stall_sequences):
     """
     Creates a DataFrame for the heatmap with the raw counts of codons at/around the stall sites. 
 
     Parameters:
-        stall_sequences (list): List of stall sequences from collect_stall_sequences().
+        stall_sequences (list or StallCodonMatrix): List of stall sequences from collect_stall_sequences(), or the matrix from get_stall_codon_matrix().
     
     Returns:
         DataFrame: DataFrame with columns from -5 to 5 and rows of all the codons at/around the stall sites.
     """
+    if isinstance(stall_sequences, StallCodonMatrix):
+        ids = stall_sequences.ids.astype(np.int64)
+        num_ids = len(stall_sequences.vocabulary)
+        num_columns = ids.shape[1]
+        # One bincount for all columns, with the IDs of column j shifted by j * num_ids
+        counts = np.bincount((ids + np.arange(num_columns) * num_ids).ravel(), minlength=num_ids * num_columns)
+        return _counts_to_raw_heatmap(counts.reshape(num_columns, num_ids).T, stall_sequences.vocabulary)
+
     df = pd.DataFrame(columns=range(-5, 6), index=range(len(stall_sequences)))
     for i, seq in enumerate(stall_sequences):
         df.loc[i] = [seq[j:j+3] for j in range(0, len(seq), 3)]
     return df.apply(pd.Series.value_counts).fillna(0)
 
+def _counts_to_raw_heatmap(counts, vocabulary):
+    # DataFrame of create_raw_heatmap() from an array of counts with one row per codon ID and one column per codon position
+    present = np.flatnonzero(counts.any(axis=1))
+    num_columns = counts.shape[1]
+    upstream = (num_columns - 1) // 2
+    df = pd.DataFrame(counts[present].astype(np.float64),
+                      index=[vocabulary[i] for i in present],
+                      columns=range(-upstream, num_columns - upstream))
+    return df.sort_index()
+
+def sweep_stall_sites(replicates, pickle_path, transcripts, percentiles, sequence, cds_range, zscores=None):
+    """
+    Finds stall sites for a grid of percentiles at once. The thresholds of all percentiles are calculated from one
+    partition of the z-scores of each replicate, and each position is ranked once by the number of thresholds it exceeds
+    with a binary search. The stall sites at the k-th percentile are then the positions with a rank above k,
+    so counts and heatmaps of all percentiles are accumulated in one pass over the stall sites of the lowest percentile.
+    The results at each percentile are the same as those of find_common_stall_sites() and create_raw_heatmap().
+
+    Parameters:
+        replicates (list): List of replicates.
+        pickle_path (str or CoverageSession): Coverage path or an open CoverageSession.
+        transcripts (list): List of transcripts.
+        percentiles (list): Percentiles to determine thresholds.
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+        zscores (dict): Dictionary mapping replicate to its z-scores from get_filtered_zscores(), if already computed.
+
+    Returns:
+        dict: 'percentiles' (ndarray): The percentiles in ascending order.
+              'thresholds' (DataFrame): z-score cutoff of each replicate (columns) at each percentile (rows).
+              'counts' (DataFrame): Number of stall positions of each replicate and number of common stall sites
+                                    ('Common stall sites', codons as in get_stall_sites_df()) at each percentile.
+              'raw_heatmaps' (list): DataFrame from create_raw_heatmap() at each percentile.
+    """
+    with stage('percentile_sweep', experiment=replicates[0], percentiles=len(percentiles)) as metrics:
+        pickle_path = get_coverage_session(pickle_path)
+        zscores = zscores or {}
+        percentiles = np.unique(np.asarray(percentiles, dtype=np.float64))
+        num_levels = len(percentiles)
+
+        thresholds = {}
+        counts = {}
+        levels = {}
+        for exp in replicates:
+            exp_zscores = zscores[exp] if exp in zscores else get_filtered_zscores(pickle_path, transcripts, exp)
+            # Thresholds increase with the percentile, so a position exceeds the thresholds of the first `level` percentiles
+            thresholds[exp] = np.percentile(get_trimmed_zscores(exp_zscores), percentiles, overwrite_input=True)
+            exp_levels = np.searchsorted(thresholds[exp], exp_zscores.flat, side='left').astype(np.int32)
+            exp_levels[np.isnan(exp_zscores.flat)] = 0
+            levels[exp] = (exp_zscores, exp_levels)
+            counts[exp] = _count_above_levels(exp_levels, num_levels)
+
+        # A position is a common stall site at the k-th percentile if its lowest level across replicates is above k
+        common_levels = _combine_replicates(levels, pickle_path, replicates, num_levels, np.minimum)
+        stall_matrix = get_stall_codon_matrix(common_levels, sequence, cds_range)
+        site_levels = stall_matrix.levels.astype(np.int64)
+        counts['Common stall sites'] = _count_above_levels(site_levels, num_levels)
+
+        # Codon counts of each column by level, accumulated from the highest level down
+        ids = stall_matrix.ids.astype(np.int64)
+        num_ids = len(stall_matrix.vocabulary)
+        num_columns = ids.shape[1]
+        index = (site_levels[:, None] * num_columns + np.arange(num_columns)) * num_ids + ids
+        by_level = np.bincount(index.ravel(), minlength=(num_levels + 1) * num_columns * num_ids)
+        by_level = by_level.reshape(num_levels + 1, num_columns, num_ids)
+        above_level = np.cumsum(by_level[::-1], axis=0)[::-1]
+        raw_heatmaps = [_counts_to_raw_heatmap(above_level[k + 1].T, stall_matrix.vocabulary) for k in range(num_levels)]
+
+        metrics.add(transcripts=len(transcripts))
+        return {
+            'percentiles': percentiles,
+            'thresholds': pd.DataFrame(thresholds, index=percentiles),
+            'counts': pd.DataFrame(counts, index=percentiles),
+            'raw_heatmaps': raw_heatmaps,
+        }
+
+def _count_above_levels(levels, num_levels):
+    # Number of values above each level from 0 to num_levels - 1
+    histogram = np.bincount(levels, minlength=num_levels + 1)
+    return np.cumsum(histogram[::-1])[::-1][1:]
+
 def normalize_heatmap(raw_heatmap, sequence, cds_range, transcripts):
     """
     Creates a DataFrame for the heatmap, normalized by the total number of codons across all given transcripts within the CDS. 
+    The codon counts of a transcript set are memoized, see get_codon_background().
 
     Parameters:
         raw_heatmap (DataFrame): DataFrame from create_raw_heatmap().
-        sequence (dict): Dictionary mapping transcript to nucleotide sequence from get_sequence().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
         cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
         transcripts (list): List of transcripts for analysis.
     
     Returns:
         DataFrame: Normalized DataFrame of raw_heatmap using total number of codons across all given transcripts within the CDS.
     """
-    codon_counts = {}
-    for transcript in transcripts:
-        start, stop = cds_range[transcript]
-        for i in range(start + 3, stop, 3):
-            codon = sequence[transcript][i:i+3]
-
-            codon_counts[codon] = codon_counts.get(codon, 0) + 1
-    
-    total_codons = sum(codon_counts.values())
-    norm_counts = {codon: count / total_codons for codon, count in codon_counts.items()}
+    norm_counts = get_codon_background(sequence, cds_range).frequencies(transcripts)
     # Reindex raw_heatmap to include all codons from norm_counts
-    all_codons = list(norm_counts.keys())
+    all_codons = list(norm_counts.index)
     norm_heatmap = raw_heatmap.reindex(all_codons).fillna(0)
     norm_heatmap = norm_heatmap.div(norm_heatmap.sum(axis=0), axis=1)
     norm_heatmap = norm_heatmap.sort_index(ascending=False)
-    
-    for index, row in norm_heatmap.iterrows():
-        norm_heatmap.loc[index] = row - norm_counts.get(index, 0)
-        
-    return norm_heatmap
+
+    # Subtract the background frequency of each codon from its row
+    return norm_heatmap.sub(norm_counts.reindex(norm_heatmap.index).fillna(0), axis=0)
 
 def get_heatmap_df(raw_heatmap, sequence, cds_range, transcripts):
     """
@@ -133,7 +445,7 @@ def get_heatmap_df(raw_heatmap, sequence, cds_range, transcripts):
 
     Parameters:
         raw_heatmap (DataFrame): DataFrame from create_raw_heatmap().
-        sequence (dict): Dictionary mapping transcript to nucleotide sequence from get_sequence().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
         cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
         transcripts (list): List of transcripts for analysis.
     
@@ -141,12 +453,7 @@ def get_heatmap_df(raw_heatmap, sequence, cds_range, transcripts):
         DataFrame: DataFrame of raw counts of codons at/around stall sites. 
                    There is an additional column containing the total number of each codon within the CDS across all given transcripots.
     """
-    codon_counts = {}
-    for transcript in transcripts:
-        start, stop = cds_range[transcript]
-        for i in range(start + 3, stop, 3):
-            codon = sequence[transcript][i:i+3]
-            codon_counts[codon] = codon_counts.get(codon, 0) + 1
+    codon_counts = get_codon_background(sequence, cds_range).counts(transcripts)
     
     all_codons = list(codon_counts.keys())
     df = raw_heatmap.reindex(all_codons).fillna(0)
@@ -154,31 +461,185 @@ def get_heatmap_df(raw_heatmap, sequence, cds_range, transcripts):
     df = df.sort_index(ascending=True)
     return df
 
-def get_stall_sites_df(common_stall_sites, cds_range, sequence):
+def get_stall_sites_df(common_stall_sites, cds_range, sequence, stall_matrix=None):
     """
     Retrieves transcript, nucleotide position, and sequence of the stall sites.
 
     Parameters:
-        common_stall_sites (dict): Dictionary mapping transcript to an array of booleans at each nucleotide position representing stall sites from find_common_stall_sites().
+        common_stall_sites (dict or SegmentedArray): Mapping of transcript to an array of booleans at each nucleotide position representing stall sites from find_common_stall_sites().
         cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
-        sequence (dict): Dictionary mapping transcript to nucleotide sequence from get_sequence().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
+        stall_matrix (StallCodonMatrix): Matrix from get_stall_codon_matrix() for the same stall sites, if already computed.
     """
-    df_list = []
-    
-    for transcript, stall_sites in common_stall_sites.items():
-        start, stop = cds_range[transcript]
-        
-        for i in range(start + 18, stop - 15, 3):
-            if any(stall_sites[i - start:i - start + 3]):
-                sequence_window = sequence[transcript][i - 15:i + 18]
-                codons = [sequence_window[j:j + 3] for j in range(0, len(sequence_window), 3)]
-                
-                df_temp = pd.DataFrame({
-                    'Transcript': [transcript],
-                    'StallSite': [i + 1],
-                    'Codons': [codons]
-                })
-                df_list.append(df_temp)
-    
-    df = pd.concat(df_list, ignore_index=True)
-    return df
\ No newline at end of file
+    if stall_matrix is None:
+        stall_matrix = get_stall_codon_matrix(common_stall_sites, sequence, cds_range)
+    return pd.DataFrame({
+        'Transcript': stall_matrix.transcripts,
+        'StallSite': stall_matrix.positions + 1,
+        'Codons': stall_matrix.codons().tolist(),
+    })
+
+def compute_condition_heatmaps(common_stall_sites, sequence, cds_range, transcripts):
+    """
+    Computes the heatmaps and stall site table of one experimental condition from its common stall sites.
+
+    Parameters:
+        common_stall_sites (dict or SegmentedArray): Mapping of transcript to an array of booleans at each nucleotide position representing stall sites from find_common_stall_sites().
+        sequence (dict or CodonCache): Dictionary mapping transcript to nucleotide sequence from get_sequence(), or a codon cache from get_codon_cache().
+        cds_range (dict): Dictionary mapping transcript to CDS range (start, stop) from get_cds_range_lookup().
+        transcripts (list): List of transcripts for analysis.
+
+    Returns:
+        tuple: DataFrames from normalize_heatmap(), get_heatmap_df() and get_stall_sites_df().
+    """
+    with stage('heatmaps') as metrics:
+        stall_matrix = get_stall_codon_matrix(common_stall_sites, sequence, cds_range)
+        raw_heatmap = create_raw_heatmap(stall_matrix)
+        metrics.add(transcripts=len(transcripts), stall_sites=len(stall_matrix))
+        return (normalize_heatmap(raw_heatmap, sequence, cds_range, transcripts),
+                get_heatmap_df(raw_heatmap, sequence, cds_range, transcripts),
+                get_stall_sites_df(common_stall_sites, cds_range, sequence, stall_matrix))
+
+def write_heatmap_sheets(writer, replicates, df_heatmap, df_stallsites):
+    """
+    Writes the raw counts and stall sites of one experimental condition to the sheets of an Excel worksheet.
+
+    Parameters:
+        writer (ExcelWriter): Writer of the worksheet.
+        replicates (list): Replicates of the experimental condition. The sheets are named after the first replicate.
+        df_heatmap (DataFrame): DataFrame from get_heatmap_df().
+        df_stallsites (DataFrame): DataFrame from get_stall_sites_df().
+    """
+    df_heatmap.to_excel(writer, sheet_name=f'heatmap_{replicates[0]}')
+    df_stallsites.to_excel(writer, sheet_name=f'stall_sites_{replicates[0]}')
+
+def _load_heatmap_inputs(ribo_path, coverage_path, reference_path, alias, experiments, num_transcripts, progress, num_steps, cache):
+    # First three stages of generate_heatmaps() and generate_heatmap_sweep(), returning their results and cache keys
+    progress('Opening ribo file', 0.0)
+    ribo_key = [get_file_fingerprint(ribo_path)['sha1'], bool(alias)]
+    if alias == True:
+        ribo_object = Ribo(ribo_path, alias=ribopy.api.alias.apris_human_alias)
+    else:
+        ribo_object = Ribo(ribo_path)
+    cds_range = cache.get('metadata', ribo_key, lambda: get_cds_range_lookup(ribo_object))
+
+    progress('Reading codons of the reference file', 1 / num_steps)
+    sequence_key = ribo_key + [get_file_fingerprint(reference_path)['sha1']]
+    sequence = cache.get('sequence', sequence_key, lambda: get_codon_cache(ribo_object, ribo_path, reference_path, alias))
+
+    progress('Selecting transcripts', 2 / num_steps)
+    coverage = CoverageSession(coverage_path)
+    coverage_key = [get_coverage_fingerprint(coverage_path)['sha1']]
+    all_experiments = [exp for replicates in experiments for exp in replicates]
+    transcripts = cache.get('transcripts', coverage_key + [all_experiments, num_transcripts],
+                            lambda: get_filtered_transcripts(coverage, all_experiments, num_transcripts))
+    transcripts_key = coverage_key + [sorted(transcripts)]
+    return cds_range, sequence, sequence_key, coverage, transcripts, transcripts_key
+
+def _get_cached_zscores(cache, coverage, transcripts, transcripts_key, replicates):
+    return {exp: cache.get('zscores', transcripts_key + [exp], lambda: get_filtered_zscores(coverage, transcripts, exp))
+            for exp in replicates}
+
+def generate_heatmaps(ribo_path, coverage_path, reference_path, alias, experiments, num_transcripts, percentile,
+                      progress=None, output_dir='.', cache=None):
+    """
+    Generates the normalized codon heatmaps of each experimental condition and saves the Excel worksheet
+    of the raw counts and stall sites of each condition as codon_heatmaps.xlsx in output_dir.
+    The result of each stage is cached by the fingerprints of the input files and the parameters the stage depends on,
+    so that a run with a changed parameter only recomputes the stages after it.
+
+    Parameters:
+        ribo_path (str): Path to the ribo file.
+        coverage_path (str): Coverage store directory or file path to the gzipped pickle file generated using adj_coverage.py.
+        reference_path (str): The file path to the reference FASTA file.
+        alias (bool): Whether or not alias is used.
+        experiments (list): List of experimental conditions, each a list of replicates.
+        num_transcripts (int): Number of transcripts with the highest coverage density to use.
+        percentile (float): Percentile to determine threshold for stall sites.
+        progress (callable): Called as progress(stage, fraction) before each stage, e.g., a JobProgress.
+        output_dir (str): Directory of the Excel worksheet.
+        cache (StageCache): Cache of the stage results. Defaults to the cache shared by all runs of this process.
+
+    Returns:
+        list: Normalized heatmap DataFrame of each experimental condition from normalize_heatmap().
+    """
+    if progress is None:
+        progress = lambda stage, fraction: None
+    if cache is None:
+        cache = get_stage_cache()
+    num_steps = 3 + len(experiments)
+    cds_range, sequence, sequence_key, coverage, transcripts, transcripts_key = _load_heatmap_inputs(
+        ribo_path, coverage_path, reference_path, alias, experiments, num_transcripts, progress, num_steps, cache)
+
+    all_norm_heatmaps = []
+    with pd.ExcelWriter(os.path.join(output_dir, 'codon_heatmaps.xlsx'), engine='xlsxwriter') as writer:
+        for i, replicates in enumerate(experiments):
+            progress(f'Finding stall sites of {replicates[0]} ({i + 1} of {len(experiments)})', (3 + i) / num_steps)
+            zscores = _get_cached_zscores(cache, coverage, transcripts, transcripts_key, replicates)
+            stall_sites_key = transcripts_key + [replicates, percentile]
+            common_stall_sites = cache.get('stall_sites', stall_sites_key,
+                                           lambda: find_common_stall_sites(replicates, coverage, transcripts, percentile, zscores=zscores))
+
+            norm_heatmap, df_heatmap, df_stallsites = cache.get(
+                'heatmaps', stall_sites_key + sequence_key,
+                lambda: compute_condition_heatmaps(common_stall_sites, sequence, cds_range, transcripts))
+            all_norm_heatmaps.append(norm_heatmap)
+            write_heatmap_sheets(writer, replicates, df_heatmap, df_stallsites)
+
+    return all_norm_heatmaps
+
+def generate_heatmap_sweep(ribo_path, coverage_path, reference_path, alias, experiments, num_transcripts, percentile, percentiles,
+                           progress=None, output_dir='.', cache=None):
+    """
+    Generates the heatmaps of generate_heatmaps() at the given percentile, including the Excel worksheet,
+    and the normalized heatmaps of each experimental condition at every percentile of a grid from sweep_stall_sites(),
+    e.g., for a percentile slider. Stages shared with generate_heatmaps() are computed once through the stage cache.
+
+    Parameters:
+        ribo_path (str): Path to the ribo file.
+        coverage_path (str): Coverage store directory or file path to the gzipped pickle file generated using adj_coverage.py.
+        reference_path (str): The file path to the reference FASTA file.
+        alias (bool): Whether or not alias is used.
+        experiments (list): List of experimental conditions, each a list of replicates.
+        num_transcripts (int): Number of transcripts with the highest coverage density to use.
+        percentile (float): Percentile of the Excel worksheet.
+        percentiles (list): Percentiles of the sweep.
+        progress (callable): Called as progress(stage, fraction) before each stage, e.g., a JobProgress.
+        output_dir (str): Directory of the Excel worksheet.
+        cache (StageCache): Cache of the stage results. Defaults to the cache shared by all runs of this process.
+
+    Returns:
+        dict: 'percentile' (float): The percentile of the Excel worksheet.
+              'heatmaps' (list): Normalized heatmap DataFrame of each experimental condition at the given percentile.
+              'percentiles' (list): Percentiles of the sweep in ascending order, including the given percentile.
+              'sweep_heatmaps' (list): Normalized heatmap DataFrames of each experimental condition at each percentile of the sweep.
+              'counts' (list): DataFrame of stall site counts of each experimental condition from sweep_stall_sites().
+    """
+    if progress is None:
+        progress = lambda stage, fraction: None
+    if cache is None:
+        cache = get_stage_cache()
+    num_steps = 3 + 2 * len(experiments)
+    all_norm_heatmaps = generate_heatmaps(ribo_path, coverage_path, reference_path, alias, experiments, num_transcripts, percentile,
+                                          lambda stage, fraction: progress(stage, fraction * (3 + len(experiments)) / num_steps),
+                                          output_dir, cache)
+    # Stages already computed by generate_heatmaps() are read from the cache
+    cds_range, sequence, sequence_key, coverage, transcripts, transcripts_key = _load_heatmap_inputs(
+        ribo_path, coverage_path, reference_path, alias, experiments, num_transcripts, lambda stage, fraction: None, num_steps, cache)
+
+    percentiles = sorted(set(percentiles) | {percentile})
+    sweeps = []
+    for i, replicates in enumerate(experiments):
+        progress(f'Sweeping percentiles of {replicates[0]} ({i + 1} of {len(experiments)})', (3 + len(experiments) + i) / num_steps)
+        zscores = _get_cached_zscores(cache, coverage, transcripts, transcripts_key, replicates)
+        sweeps.append(cache.get('sweep', transcripts_key + [replicates, percentiles] + sequence_key,
+                                lambda: sweep_stall_sites(replicates, coverage, transcripts, percentiles, sequence, cds_range, zscores)))
+
+    return {
+        'percentile': percentile,
+        'heatmaps': all_norm_heatmaps,
+        'percentiles': percentiles,
+        'sweep_heatmaps': [[normalize_heatmap(sweep['raw_heatmaps'][k], sequence, cds_range, transcripts) for sweep in sweeps]
+                           for k in range(len(percentiles))],
+        'counts': [sweep['counts'] for sweep in sweeps],
+    }
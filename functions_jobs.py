@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# Directory of the job store: one directory per job with its status (job.json), result and output files
+JOB_DIR = os.environ.get('RIBOPY_JOB_DIR', 'jobs')
+JOB_FILE = 'job.json'
+CANCEL_FILE = 'cancel'
+RESULT_FILE = 'result.pkl'
+
+class JobCancelled(Exception):
+    """
+    Raised in a job when its cancellation was requested.
+    """
+
+def _write_json(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(temp_path, path)
+
+def read_job(path):
+    """
+    Reads the status of a job from its directory.
+
+    Parameters:
+        path (str): Directory of the job.
+
+    Returns:
+        dict: Job status with 'id', 'status' ('queued', 'running', 'done', 'failed' or 'cancelled'),
+              'stage', 'progress' (0 to 1), 'error' and timestamps.
+    """
+    with open(os.path.join(path, JOB_FILE)) as f:
+        return json.load(f)
+
+def update_job(path, **fields):
+    """
+    Updates fields of the status of a job.
+    """
+    job = read_job(path)
+    job.update(fields)
+    _write_json(os.path.join(path, JOB_FILE), job)
+    return job
+
+class JobProgress:
+    """
+    Progress callback passed to job functions as progress(stage, fraction).
+    Each report is saved in the job store and is the point where a requested cancellation takes effect.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def check_cancelled(self):
+        if os.path.exists(os.path.join(self.path, CANCEL_FILE)):
+            raise JobCancelled()
+
+    def __call__(self, stage, fraction):
+        self.check_cancelled()
+        update_job(self.path, stage=stage, progress=fraction)
+        logging.info(f"Job {os.path.basename(self.path)}: {stage}")
+
+def _run_job(path, function, args, kwargs):
+    # Runs in a worker process of the pool
+    progress = JobProgress(path)
+    try:
+        progress.check_cancelled()
+        update_job(path, status='running', started=time.time())
+        result = function(*args, progress=progress, output_dir=path, **kwargs)
+        with open(os.path.join(path, RESULT_FILE), 'wb') as f:
+            pickle.dump(result, f)
+        update_job(path, status='done', stage='Done', progress=1.0, finished=time.time())
+    except JobCancelled:
+        update_job(path, status='cancelled', finished=time.time())
+    except Exception as e:
+        update_job(path, status='failed', error=str(e), traceback=traceback.format_exc(), finished=time.time())
+
+class JobRunner:
+    """
+    Runs jobs in a local process pool and keeps their status, results and output files in a job store directory,
+    so that long computations do not block the web process and their progress can be polled from any process.
+    """
+
+    def __init__(self, max_workers=None, job_dir=None):
+        self.max_workers = max_workers
+        self.job_dir = job_dir or JOB_DIR
+        self._executor = None
+        self._futures = {}
+
+    def job_path(self, job_id, file_name=None):
+        """
+        Returns the directory of a job, or the path of one of its files.
+        """
+        path = os.path.join(self.job_dir, os.path.basename(job_id))
+        return path if file_name is None else os.path.join(path, file_name)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues function(*args, progress=..., output_dir=..., **kwargs) in the pool.
+        The function reports progress with progress(stage, fraction), writes output files to output_dir
+        and returns a picklable result.
+
+        Returns:
+            str: ID of the job.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.max_workers)
+        job_id = uuid.uuid4().hex
+        path = self.job_path(job_id)
+        os.makedirs(path)
+        _write_json(os.path.join(path, JOB_FILE), {
+            'id': job_id,
+            'status': 'queued',
+            'stage': 'Queued',
+            'progress': 0.0,
+            'error': None,
+            'submitted': time.time(),
+        })
+        self._futures[job_id] = self._executor.submit(_run_job, path, function, args, kwargs)
+        self._futures[job_id].add_done_callback(lambda future: self._futures.pop(job_id, None))
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns the status of a job, see read_job().
+        """
+        return read_job(self.job_path(job_id))
+
+    def result(self, job_id):
+        """
+        Returns the result of a finished job.
+        """
+        with open(self.job_path(job_id, RESULT_FILE), 'rb') as f:
+            return pickle.load(f)
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation of a job. Queued jobs are removed from the queue;
+        running jobs stop at their next progress report.
+        """
+        path = self.job_path(job_id)
+        open(os.path.join(path, CANCEL_FILE), 'w').close()
+        future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            update_job(path, status='cancelled', finished=time.time())
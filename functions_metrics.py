@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import socket
+import numpy as np
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where memory is not reported
+    resource = None
+
+# Metrics are appended as JSON lines to this file. Unset (the default) turns metrics off.
+METRICS_ENV = 'RIBOPY_METRICS'
+_metrics_path = os.environ.get(METRICS_ENV) or None
+
+# Upper bounds in milliseconds of the task latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS_MS = [2.0 ** i for i in range(18)]
+
+def configure_metrics(path):
+    """
+    Turns metrics on, appending to the JSON lines file at path, or off if path is None.
+    The setting is also passed to worker processes started afterwards through the RIBOPY_METRICS environment variable.
+    """
+    global _metrics_path
+    _metrics_path = path or None
+    if _metrics_path is None:
+        os.environ.pop(METRICS_ENV, None)
+    else:
+        os.environ[METRICS_ENV] = _metrics_path
+
+def metrics_enabled():
+    return _metrics_path is not None
+
+def emit(event, **fields):
+    """
+    Appends one metrics record {'event', 'time', 'host', 'pid', **fields} as a JSON line. Does nothing when metrics are off.
+    Each record is written with a single append, so several processes can share the file.
+    """
+    if _metrics_path is None:
+        return
+    record = {'event': event, 'time': time.time(), 'host': socket.gethostname(), 'pid': os.getpid()}
+    record.update(fields)
+    with open(_metrics_path, 'a') as f:
+        f.write(json.dumps(record, default=_to_json) + '\n')
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def read_bytes():
+    """
+    Returns the number of bytes this process has read so far, including reads served from the page cache,
+    or None where /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def rss_mb():
+    """
+    Returns the current resident memory of this process in MB, or None where /proc/self/statm is not available.
+    """
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return None
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of this process in MB since it started, not only during the current stage,
+    or None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 2 ** 10
+
+class StageMetrics:
+    """
+    Context manager recording the wall time, CPU time, change of RSS and bytes read of a stage, emitted as a 'stage' record on exit.
+    The peak RSS is the one of the process so far, as the operating system does not report it per stage.
+    Counts added with add(), e.g., transcripts=n, are also reported per second of wall time.
+    """
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.counts = {}
+
+    def add(self, **counts):
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def __enter__(self):
+        self._read = read_bytes()
+        self._rss = rss_mb()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        read = read_bytes()
+        rss = rss_mb()
+        fields = dict(self.labels)
+        fields.update(self.counts)
+        fields.update({f'{name}_per_s': count / wall if wall > 0 else None for name, count in self.counts.items()})
+        emit('stage', stage=self.stage, wall_s=wall, cpu_s=cpu, rss_mb=rss,
+             rss_delta_mb=None if rss is None or self._rss is None else rss - self._rss, process_peak_rss_mb=peak_rss_mb(),
+             read_bytes=None if read is None or self._read is None else read - self._read,
+             failed=exc_type is not None, **fields)
+        return False
+
+class _NullStageMetrics:
+    # Returned by stage() when metrics are off, so instrumented code pays only for one function call
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStageMetrics()
+
+def stage(name, **labels):
+    """
+    Returns a context manager measuring a stage, e.g.:
+
+        with stage('occupancy', experiment=exp) as metrics:
+            ...
+            metrics.add(transcripts=len(names))
+
+    Parameters:
+        name (str): Name of the stage.
+        **labels: Fields identifying the stage run, e.g., the experiment.
+
+    Returns:
+        StageMetrics: Context manager of the stage, or a no-op when metrics are off.
+    """
+    if _metrics_path is None:
+        return _NULL_STAGE
+    return StageMetrics(name, labels)
+
+class LatencyHistogram:
+    """
+    Histogram of task latencies over the buckets of LATENCY_BUCKETS_MS, e.g., of the tasks of one pool worker.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(len(LATENCY_BUCKETS_MS) + 1, dtype=np.int64)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[np.searchsorted(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return {
+            'count': int(self.counts.sum()),
+            'sum_s': self.total,
+            'max_s': self.max,
+            'buckets_le_ms': LATENCY_BUCKETS_MS + [None],
+            'bucket_counts': self.counts.tolist(),
+        }
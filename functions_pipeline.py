@@ -0,0 +1,222 @@
+import os
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+import ribopy
+from ribopy import Ribo
+from functions import get_cds_range_lookup, get_offset_report, get_offsets, get_file_fingerprint
+from functions_coverage import get_transcript_layout, compute_coverages, project_store_coverage
+from functions_codon import get_codon_cache, get_codon_occupancy
+from functions_filter import SegmentedArray, get_filtered_transcripts, get_filtered_zscores
+from functions_heatmap_v4 import find_common_stall_sites, compute_condition_heatmaps, write_heatmap_sheets
+from coverage_store import create_coverage_store, add_experiment, export_pickle, load_coverage, CoverageStore
+
+# Stages of the pipeline in the order they are run
+STAGES = ['coverage', 'occupancy', 'heatmap']
+OFFSET_MODES = {1: 'psite', 2: 'asite'}
+
+class PipelineState:
+    """
+    Inputs shared by the stages of one pipeline run. The ribo file, CDS ranges, codons of the reference file
+    and coverage are each loaded once, on first use, and then passed between stages in memory.
+    """
+
+    def __init__(self, ribo_path, reference_path, alias, coverage_path=None):
+        self.ribo_path = ribo_path
+        self.reference_path = reference_path
+        self.alias = alias
+        self.coverage_path = coverage_path
+        self._ribo_object = None
+        self._cds_range = None
+        self._sequence = None
+        self._coverage = None
+
+    @property
+    def ribo_object(self):
+        if self._ribo_object is None:
+            if self.alias == True:
+                self._ribo_object = Ribo(self.ribo_path, alias=ribopy.api.alias.apris_human_alias)
+            else:
+                self._ribo_object = Ribo(self.ribo_path)
+        return self._ribo_object
+
+    @property
+    def cds_range(self):
+        if self._cds_range is None:
+            self._cds_range = get_cds_range_lookup(self.ribo_object)
+        return self._cds_range
+
+    @property
+    def sequence(self):
+        # Codon IDs from the codon cache, so the reference file is parsed at most once across runs
+        if self._sequence is None:
+            self._sequence = get_codon_cache(self.ribo_object, self.ribo_path, self.reference_path, self.alias)
+        return self._sequence
+
+    @property
+    def coverage(self):
+        # Coverage computed by the coverage stage, or read from coverage_path when the stage is not run
+        if self._coverage is None:
+            if self.coverage_path is None:
+                raise ValueError("No coverage: run the coverage stage or give a coverage path.")
+            self._coverage = load_coverage(self.coverage_path)
+        return self._coverage
+
+    @coverage.setter
+    def coverage(self, coverage):
+        self._coverage = coverage
+
+def _create_output_store(state, output_path, names, cds_offsets, min_len, max_len, offset_mode, flank=None):
+    # Coverage is written to a store as each experiment is finished; pickle outputs are exported from a temporary store
+    if output_path is None:
+        return None
+    store_path = output_path + '.checkpoint' if output_path.endswith('.pkl.gz') else output_path
+    parameters = {'min_len': min_len, 'max_len': max_len, 'offset_mode': offset_mode, 'alias': state.alias}
+    if flank is not None:
+        parameters['flank'] = flank
+    create_coverage_store(store_path, names, cds_offsets, parameters, get_file_fingerprint(state.ribo_path))
+    return store_path
+
+def _finish_output_store(store_path, output_path, experiments):
+    if store_path is not None and store_path != output_path:
+        export_pickle(store_path, output_path, experiments)
+        shutil.rmtree(store_path)
+    if output_path is not None:
+        logging.info(f"Saved coverage as {output_path}.")
+
+def run_coverage_stage(state, min_len, max_len, offset_mode, output_path=None, flank=None):
+    """
+    Computes the adjusted coverage of all experiments of the ribo file and keeps it in state.coverage.
+
+    Parameters:
+        state (PipelineState): State of the pipeline run.
+        min_len (int): Minimum read length to be analyzed.
+        max_len (int): Maximum read length to be analyzed.
+        offset_mode (int): 1 for P-site offset, 2 for A-site offset.
+        output_path (str): If given, the coverage is also saved as a coverage store at this directory,
+                           or as a gzipped pickle file if the path ends with .pkl.gz.
+        flank (int): If given, the per-read-length coverage with this flank is also saved in the coverage store at output_path,
+                     so that run_projection_stage() can later apply other offsets or read lengths without the ribo file coverage.
+
+    Returns:
+        dict: Mapping of experiment to a SegmentedArray of transcript to adjusted coverage array.
+    """
+    if flank is not None and (output_path is None or output_path.endswith('.pkl.gz')):
+        raise ValueError("Per-read-length coverage can only be saved in a coverage store.")
+    layout = get_transcript_layout(state.ribo_object, state.cds_range)
+    cds_offsets = np.zeros(len(layout['names']) + 1, dtype=np.int64)
+    np.cumsum(layout['cds_stop'] - layout['cds_start'], out=cds_offsets[1:])
+    experiments = list(state.ribo_object.experiments)
+
+    offset_report = get_offset_report(state.ribo_object, state.ribo_path, experiments, min_len, max_len)
+    offsets = {exp: get_offsets(offset_report, exp, OFFSET_MODES[offset_mode]) for exp in experiments}
+    store_path = _create_output_store(state, output_path, layout['names'], cds_offsets, min_len, max_len, offset_mode, flank)
+
+    coverage = {}
+    for exp, flat, *length_coverage in compute_coverages(state.ribo_path, state.alias, layout, offsets, min_len, max_len,
+                                                         experiments, flank=flank):
+        coverage[exp] = SegmentedArray(layout['names'], flat, cds_offsets)
+        if store_path is not None:
+            add_experiment(store_path, exp, flat,
+                           metadata={'offset': {int(i): int(offset) for i, offset in offsets[exp].items()},
+                                     'ribo': get_file_fingerprint(state.ribo_path)},
+                           length_coverage=length_coverage[0] if length_coverage else None, min_len=min_len, flank=flank)
+        logging.info(f"Finished coverage of {exp}.")
+    _finish_output_store(store_path, output_path, experiments)
+
+    # Experiments in the order of the ribo file, as in the coverage stores and pickle files
+    state.coverage = {exp: coverage[exp] for exp in experiments}
+    return state.coverage
+
+def run_projection_stage(state, length_store_path, min_len, max_len, offset_mode, output_path=None, offsets=None):
+    """
+    Computes the adjusted coverage of all experiments of a coverage store from their per-read-length coverage
+    saved by run_coverage_stage() with a flank, instead of from the ribo file, and keeps it in state.coverage.
+
+    Parameters:
+        state (PipelineState): State of the pipeline run.
+        length_store_path (str): Directory of the coverage store with per-read-length coverage.
+        min_len (int): Minimum read length to be analyzed, within the kept read lengths.
+        max_len (int): Maximum read length to be analyzed, within the kept read lengths.
+        offset_mode (int): 1 for P-site offset, 2 for A-site offset.
+        output_path (str): If given, the coverage is also saved as a coverage store at this directory,
+                           or as a gzipped pickle file if the path ends with .pkl.gz.
+        offsets (dict): Dictionary mapping experiment to its offset dictionary. Defaults to the offsets of offset_mode from get_offset_report().
+
+    Returns:
+        dict: Mapping of experiment to a SegmentedArray of transcript to adjusted coverage array.
+    """
+    if output_path is not None and os.path.abspath(output_path) == os.path.abspath(length_store_path):
+        raise ValueError("The projected coverage cannot replace the store it is projected from.")
+    length_store = CoverageStore(length_store_path)
+    experiments = [exp for exp in length_store.experiments if length_store.length_coverage(exp) is not None]
+    if not experiments:
+        raise ValueError(f"{length_store_path} has no per-read-length coverage.")
+    if offsets is None:
+        offset_report = get_offset_report(state.ribo_object, state.ribo_path, experiments, min_len, max_len)
+        offsets = {exp: get_offsets(offset_report, exp, OFFSET_MODES[offset_mode]) for exp in experiments}
+    store_path = _create_output_store(state, output_path, length_store.transcripts, length_store.cds_offsets,
+                                      min_len, max_len, offset_mode)
+
+    coverage = {}
+    for exp in experiments:
+        flat = project_store_coverage(length_store, exp, offsets[exp], min_len, max_len)
+        coverage[exp] = SegmentedArray(length_store.transcripts, flat, length_store.cds_offsets)
+        if store_path is not None:
+            add_experiment(store_path, exp, flat, metadata={'offset': {int(i): int(offsets[exp][i]) for i in range(min_len, max_len + 1)},
+                                                            'read_lengths_from': length_store_path})
+        logging.info(f"Projected coverage of {exp}.")
+    _finish_output_store(store_path, output_path, experiments)
+
+    state.coverage = coverage
+    return state.coverage
+
+def run_occupancy_stage(state, start_codon_option, output_path=None):
+    """
+    Counts the codon occupancy of every experiment of state.coverage, see get_codon_occupancy().
+
+    Parameters:
+        state (PipelineState): State of the pipeline run.
+        start_codon_option (int): 1 to count the start codon separately as UUU, 2 to not.
+        output_path (str): If given, the occupancy is saved as a CSV file at this path.
+
+    Returns:
+        DataFrame: Codon occupancy from get_codon_occupancy().
+    """
+    df_codon_occ = get_codon_occupancy(state.coverage, state.sequence, state.cds_range, start_codon_option)
+    if output_path is not None:
+        df_codon_occ.to_csv(output_path, index=False)
+        logging.info(f"Saved codon occupancy as {output_path}.")
+    return df_codon_occ
+
+def run_heatmap_stage(state, experiments, num_transcripts, percentile, output_path=None):
+    """
+    Finds the stall sites and codon heatmaps of each experimental condition from state.coverage.
+
+    Parameters:
+        state (PipelineState): State of the pipeline run.
+        experiments (list): List of experimental conditions, each a list of replicates.
+        num_transcripts (int): Number of transcripts with the highest coverage density to use.
+        percentile (float): Percentile to determine threshold for stall sites.
+        output_path (str): If given, the raw counts and stall sites of each condition are saved as an Excel worksheet at this path.
+
+    Returns:
+        list: Tuple of DataFrames from compute_condition_heatmaps() of each experimental condition.
+    """
+    all_experiments = [exp for replicates in experiments for exp in replicates]
+    transcripts = get_filtered_transcripts(state.coverage, all_experiments, num_transcripts)
+
+    results = []
+    for replicates in experiments:
+        logging.info(f"Finding stall sites of {replicates[0]}...")
+        zscores = {exp: get_filtered_zscores(state.coverage, transcripts, exp) for exp in replicates}
+        common_stall_sites = find_common_stall_sites(replicates, state.coverage, transcripts, percentile, zscores=zscores)
+        results.append(compute_condition_heatmaps(common_stall_sites, state.sequence, state.cds_range, transcripts))
+
+    if output_path is not None:
+        with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+            for replicates, (_, df_heatmap, df_stallsites) in zip(experiments, results):
+                write_heatmap_sheets(writer, replicates, df_heatmap, df_stallsites)
+        logging.info(f"Saved heatmaps as {output_path}.")
+    return results
@@ -0,0 +1,258 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import ribopy
+from ribopy import Ribo
+from functions import get_cds_range_lookup, get_offset_report, get_offsets, get_file_fingerprint
+from functions_coverage import get_transcript_layout, compute_coverages
+from coverage_store import (CoverageStore, create_coverage_store, add_experiment, get_completed_experiments,
+                            export_pickle, is_coverage_store)
+
+SHARD_MODES = ['transcripts', 'experiments']
+OFFSET_MODES = {1: 'psite', 2: 'asite'}
+
+def get_shard_ranges(cds_lengths, num_shards):
+    """
+    Splits transcripts into num_shards contiguous ranges of roughly equal total CDS length.
+    The split only depends on the CDS lengths, so every node computes the same shards.
+
+    Parameters:
+        cds_lengths (np.ndarray): CDS length of each transcript in reference order.
+        num_shards (int): Number of shards.
+
+    Returns:
+        list: num_shards (lower, upper) transcript index ranges covering all transcripts in order. Ranges may be empty
+              if there are fewer transcripts than shards or a single transcript outweighs several shares.
+    """
+    # Total CDS length before each possible boundary, from 0 to all transcripts
+    cumulative = np.zeros(len(cds_lengths) + 1, dtype=np.int64)
+    np.cumsum(np.asarray(cds_lengths, dtype=np.int64), out=cumulative[1:])
+    targets = cumulative[-1] * np.arange(1, num_shards) / num_shards
+    # Each shard ends at whichever of the boundaries around its share of the total CDS length is closer to it
+    after = np.minimum(np.searchsorted(cumulative, targets, side='left'), len(cds_lengths))
+    before = np.maximum(after - 1, 0)
+    closer = np.where(targets - cumulative[before] < cumulative[after] - targets, before, after)
+    bounds = np.concatenate(([0], closer, [len(cds_lengths)]))
+    bounds = np.maximum.accumulate(bounds)
+    return [(int(lower), int(upper)) for lower, upper in zip(bounds[:-1], bounds[1:])]
+
+def get_shard_experiments(experiments, num_shards):
+    """
+    Splits experiments into num_shards contiguous groups whose sizes differ by at most one.
+
+    Returns:
+        list: num_shards lists of experiments. Lists may be empty if there are fewer experiments than shards.
+    """
+    bounds = np.linspace(0, len(experiments), num_shards + 1).round().astype(np.int64)
+    return [list(experiments[lower:upper]) for lower, upper in zip(bounds[:-1], bounds[1:])]
+
+def get_layout_fingerprint(names, cds_lengths):
+    """
+    Returns a digest of the transcript names and CDS lengths of a ribo file, identifying the transcripts that shards split.
+    """
+    digest = hashlib.sha1('\n'.join(names).encode())
+    digest.update(np.asarray(cds_lengths, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def run_shard(ribo_path, alias, min_len, max_len, offset_mode, shard_index, num_shards, output_path,
+              by='transcripts', flank=None, num_workers=None):
+    """
+    Computes the adjusted coverage of one shard of a ribo file into its own coverage store.
+    Shards can run independently, e.g., on different nodes, and are combined with merge_shards().
+    A shard that was interrupted is resumed from the experiments already in its store.
+
+    Parameters:
+        ribo_path (str): Path to the ribo file.
+        alias (bool): Whether or not alias is used.
+        min_len (int): Minimum read length to be analyzed.
+        max_len (int): Maximum read length to be analyzed.
+        offset_mode (int): 1 for P-site offset, 2 for A-site offset.
+        shard_index (int): Index of the shard, from 0 to num_shards - 1.
+        num_shards (int): Number of shards.
+        output_path (str): Directory of the coverage store of the shard.
+        by (str): 'transcripts' to split the transcripts by CDS length, or 'experiments' to split the experiments.
+        flank (int): If given, per-read-length coverage with this flank is also kept, see compute_coverages().
+        num_workers (int): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        CoverageStore: The coverage store of the shard.
+    """
+    if by not in SHARD_MODES:
+        raise ValueError(f"Shards must be split by one of {SHARD_MODES}, not {by}.")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} is outside of 0-{num_shards - 1}.")
+
+    if alias == True:
+        ribo_object = Ribo(ribo_path, alias=ribopy.api.alias.apris_human_alias)
+    else:
+        ribo_object = Ribo(ribo_path)
+    layout = get_transcript_layout(ribo_object, get_cds_range_lookup(ribo_object))
+    cds_lengths = layout['cds_stop'] - layout['cds_start']
+    all_experiments = list(ribo_object.experiments)
+
+    if by == 'transcripts':
+        lower, upper = get_shard_ranges(cds_lengths, num_shards)[shard_index]
+        experiments = all_experiments
+    else:
+        lower, upper = 0, len(layout['names'])
+        experiments = get_shard_experiments(all_experiments, num_shards)[shard_index]
+    shard_layout = {key: value[lower:upper] for key, value in layout.items()}
+    cds_offsets = np.zeros(upper - lower + 1, dtype=np.int64)
+    np.cumsum(cds_lengths[lower:upper], out=cds_offsets[1:])
+
+    parameters = {
+        'min_len': min_len, 'max_len': max_len, 'offset_mode': offset_mode, 'alias': alias,
+        'shard': {'by': by, 'index': shard_index, 'count': num_shards, 'experiments': experiments,
+                  'all_experiments': all_experiments, 'transcripts': len(layout['names']),
+                  'layout': get_layout_fingerprint(layout['names'], cds_lengths)},
+    }
+    if flank is not None:
+        parameters['flank'] = flank
+    ribo_fingerprint = get_file_fingerprint(ribo_path)
+    if is_coverage_store(output_path):
+        completed = get_completed_experiments(output_path, shard_layout['names'], cds_offsets, parameters, ribo_fingerprint)
+        for exp in completed:
+            logging.info(f"Skipping {exp}, already in {output_path}.")
+    else:
+        create_coverage_store(output_path, shard_layout['names'], cds_offsets, parameters, ribo_fingerprint)
+        completed = []
+    experiments = [exp for exp in experiments if exp not in completed]
+
+    logging.info(f"Shard {shard_index + 1} of {num_shards}: transcripts {lower}-{upper}, experiments {', '.join(experiments) or 'none'}.")
+    offsets = {}
+    if experiments and upper > lower:
+        # The offsets are calibrated on the whole ribo file, so that all shards apply the same offsets
+        offset_report = get_offset_report(ribo_object, ribo_path, all_experiments, min_len, max_len)
+        offsets = {exp: get_offsets(offset_report, exp, OFFSET_MODES[offset_mode]) for exp in experiments}
+        for exp, coverage, *length_coverage in compute_coverages(ribo_path, alias, shard_layout, offsets, min_len, max_len,
+                                                                 experiments, num_workers, flank):
+            add_experiment(output_path, exp, coverage,
+                           metadata={'offset': {int(i): int(offset) for i, offset in offsets[exp].items()},
+                                     'ribo': ribo_fingerprint},
+                           length_coverage=length_coverage[0] if length_coverage else None, min_len=min_len, flank=flank)
+            logging.info(f"Finished {exp}.")
+    else:
+        # Shards without transcripts still record every experiment, so that merge_shards() can check completeness
+        for exp in experiments:
+            add_experiment(output_path, exp, np.zeros(0, dtype=np.uint8), metadata={'ribo': ribo_fingerprint},
+                           length_coverage=None if flank is None else np.zeros((max_len - min_len + 1, 0), dtype=np.uint8),
+                           min_len=min_len, flank=flank)
+
+    return CoverageStore(output_path)
+
+def check_shards(shard_paths):
+    """
+    Checks that coverage stores written by run_shard() are all the shards of one run and that every shard is complete.
+
+    Parameters:
+        shard_paths (list): Directories of the shard stores, in any order.
+
+    Returns:
+        list: The shard stores (CoverageStore) in shard order.
+    """
+    stores = []
+    for path in shard_paths:
+        if not is_coverage_store(path):
+            raise ValueError(f"{path} is not a coverage store.")
+        store = CoverageStore(path)
+        if 'shard' not in store.manifest.get('parameters', {}):
+            raise ValueError(f"{path} is not a shard.")
+        stores.append(store)
+    if not stores:
+        raise ValueError("No shards to merge.")
+
+    first = stores[0].manifest
+    shared = {key: value for key, value in first['parameters'].items() if key != 'shard'}
+    shard = {key: value for key, value in first['parameters']['shard'].items() if key not in ('index', 'experiments')}
+    by_index = {}
+    for store in stores:
+        parameters = store.manifest['parameters']
+        if {key: value for key, value in parameters.items() if key != 'shard'} != shared or \
+                {key: value for key, value in parameters['shard'].items() if key not in ('index', 'experiments')} != shard:
+            raise ValueError(f"{store.path} was built with different parameters than {stores[0].path}.")
+        ribo, first_ribo = store.manifest.get('ribo'), first.get('ribo')
+        if (ribo['size'], ribo['sha1']) != (first_ribo['size'], first_ribo['sha1']):
+            raise ValueError(f"{store.path} was built from a different ribo file than {stores[0].path}.")
+        index = parameters['shard']['index']
+        if index in by_index:
+            raise ValueError(f"{store.path} and {by_index[index].path} are both shard {index}.")
+        by_index[index] = store
+
+    missing_shards = sorted(set(range(shard['count'])) - set(by_index))
+    if missing_shards:
+        raise ValueError(f"Missing shards {', '.join(map(str, missing_shards))} of {shard['count']}.")
+    stores = [by_index[index] for index in range(shard['count'])]
+    for store in stores:
+        missing = [exp for exp in store.manifest['parameters']['shard']['experiments'] if exp not in store.experiments]
+        if missing:
+            raise ValueError(f"{store.path} has not finished {', '.join(missing)}.")
+
+    if shard['by'] == 'transcripts':
+        names = [name for store in stores for name in store.transcripts]
+        cds_lengths = np.concatenate([np.diff(store.cds_offsets) for store in stores])
+        if get_layout_fingerprint(names, cds_lengths) != shard['layout']:
+            raise ValueError("The transcripts of the shards do not add up to the transcripts of the ribo file.")
+    else:
+        for store in stores:
+            if get_layout_fingerprint(store.transcripts, np.diff(store.cds_offsets)) != shard['layout']:
+                raise ValueError(f"The transcripts of {store.path} do not match the ribo file.")
+        experiments = [exp for store in stores for exp in store.manifest['parameters']['shard']['experiments']]
+        if experiments != shard['all_experiments']:
+            raise ValueError("The experiments of the shards do not add up to the experiments of the ribo file.")
+    return stores
+
+def merge_shards(shard_paths, output_path):
+    """
+    Merges the coverage stores of all shards of a run (see run_shard()) into one coverage output,
+    after checking that the shards are complete with check_shards().
+
+    Parameters:
+        shard_paths (list): Directories of the shard stores, in any order.
+        output_path (str): Directory of the merged coverage store, or a gzipped pickle file if the path ends with .pkl.gz.
+
+    Returns:
+        list: Experiments of the merged coverage.
+    """
+    stores = check_shards(shard_paths)
+    parameters = {key: value for key, value in stores[0].manifest['parameters'].items() if key != 'shard'}
+    shard = stores[0].manifest['parameters']['shard']
+    experiments = shard['all_experiments']
+
+    store_path = output_path + '.checkpoint' if output_path.endswith('.pkl.gz') else output_path
+    if shard['by'] == 'transcripts':
+        names = [name for store in stores for name in store.transcripts]
+        cds_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([np.diff(store.cds_offsets) for store in stores]), out=cds_offsets[1:])
+    else:
+        names, cds_offsets = stores[0].transcripts, stores[0].cds_offsets
+    create_coverage_store(store_path, names, cds_offsets, parameters, stores[0].manifest.get('ribo'))
+
+    for exp in experiments:
+        exp_stores = [store for store in stores if exp in store.experiments]
+        entries = [store.manifest['experiments'][exp] for store in exp_stores]
+        metadata = {key: value for key, value in entries[0].items()
+                    if key not in ('file', 'summary', 'positions', 'encoding', 'dtype', 'missing', 'read_lengths')}
+        # Empty shards have no offsets, the others must agree
+        offsets = [json.dumps(entry['offset'], sort_keys=True) for entry in entries if 'offset' in entry]
+        if len(set(offsets)) > 1:
+            raise ValueError(f"The shards applied different offsets to {exp}.")
+        if offsets:
+            metadata['offset'] = json.loads(offsets[0])
+        coverage = np.concatenate([store.flat(exp) for store in exp_stores])
+        missing = [name for entry in entries for name in entry['missing']]
+
+        length_coverage, min_len, flank = None, None, None
+        if all('read_lengths' in entry for entry in entries):
+            min_len, flank = entries[0]['read_lengths']['min_len'], entries[0]['read_lengths']['flank']
+            length_coverage = np.concatenate([store.length_coverage(exp)[0] for store in exp_stores], axis=1)
+        add_experiment(store_path, exp, coverage, missing, metadata, length_coverage, min_len, flank)
+        logging.info(f"Merged {exp} from {len(exp_stores)} shards.")
+
+    if store_path != output_path:
+        export_pickle(store_path, output_path, experiments)
+        shutil.rmtree(store_path)
+    logging.info(f"Saved as {output_path}.")
+    return experiments
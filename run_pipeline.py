@@ -0,0 +1,89 @@
+import os
+import argparse
+import logging
+from functions_metrics import METRICS_ENV, configure_metrics
+from functions_coverage import DEFAULT_FLANK
+from functions_pipeline import (STAGES, OFFSET_MODES, PipelineState, run_coverage_stage, run_projection_stage,
+                                run_occupancy_stage, run_heatmap_stage)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Runs coverage, codon occupancy and stall site heatmaps as stages of one process, '
+                    'sharing the ribo file, CDS ranges, codons and coverage between stages in memory.')
+    parser.add_argument('--ribo', required=True, help="Ribo file path, e.g., '/home/all.ribo'.")
+    parser.add_argument('--reference', required=True, help='Reference FASTA file path.')
+    parser.add_argument('--mouse', action='store_true', help='Use the APRIS human/mouse alias for transcript names.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run (default: all).')
+    parser.add_argument('--coverage', help='Coverage store directory or gzipped pickle file. Read when the coverage stage is not run, '
+                                           'written when the coverage stage is run and coverage is in --save.')
+    parser.add_argument('--save', nargs='*', choices=STAGES, default=['occupancy', 'heatmap'],
+                        help='Stages whose outputs are saved (default: occupancy heatmap).')
+    parser.add_argument('--output-dir', default='.', help='Directory of the saved occupancy and heatmap outputs.')
+    parser.add_argument('--metrics', help=f'Append stage metrics as JSON lines to this file (default: ${METRICS_ENV}, if set).')
+
+    coverage = parser.add_argument_group('coverage stage')
+    coverage.add_argument('--min-len', type=int, help='Minimum read length to be analyzed.')
+    coverage.add_argument('--max-len', type=int, help='Maximum read length to be analyzed.')
+    coverage.add_argument('--offset', choices=list(OFFSET_MODES.values()), default='psite', help='Offset mode (default: psite).')
+    coverage.add_argument('--keep-read-lengths', action='store_true',
+                          help='Also save the coverage of each read length in the --coverage store, so that it can be projected '
+                               'with other offsets or read lengths with --from-read-lengths.')
+    coverage.add_argument('--flank', type=int, default=DEFAULT_FLANK,
+                          help=f'Nucleotides kept upstream of each CDS with --keep-read-lengths, i.e., the largest offset (default: {DEFAULT_FLANK}).')
+    coverage.add_argument('--from-read-lengths', metavar='STORE',
+                          help='Project the coverage from the read lengths kept in this coverage store instead of reading the ribo file coverage.')
+
+    occupancy = parser.add_argument_group('occupancy stage')
+    occupancy.add_argument('--separate-start-codon', action='store_true', help='Count the start codon separately as UUU.')
+
+    heatmap = parser.add_argument_group('heatmap stage')
+    heatmap.add_argument('--experiments', nargs='+', metavar='REPLICATES',
+                         help="Replicates of each experimental condition, separated by a space, e.g., 'Control_1 Control_2' 'Mutant_1 Mutant_2'.")
+    heatmap.add_argument('--num-transcripts', type=int, default=100, help='Number of transcripts with the highest coverage density (default: 100).')
+    heatmap.add_argument('--percentile', type=float, default=99, help='Percentile threshold for stall sites (default: 99).')
+
+    args = parser.parse_args(argv)
+    if 'coverage' in args.stages and (args.min_len is None or args.max_len is None):
+        parser.error('the coverage stage requires --min-len and --max-len')
+    if 'coverage' not in args.stages and args.coverage is None:
+        parser.error('--coverage is required when the coverage stage is not run')
+    if 'coverage' in args.stages and 'coverage' in args.save and args.coverage is None:
+        parser.error('--coverage is required to save the coverage')
+    if args.keep_read_lengths and ('coverage' not in args.save or args.coverage is None or args.coverage.endswith('.pkl.gz')):
+        parser.error('--keep-read-lengths requires saving the coverage as a coverage store (--save coverage --coverage DIRECTORY)')
+    if args.keep_read_lengths and args.from_read_lengths:
+        parser.error('--keep-read-lengths and --from-read-lengths cannot be combined')
+    if 'heatmap' in args.stages and not args.experiments:
+        parser.error('the heatmap stage requires --experiments')
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.metrics:
+        configure_metrics(args.metrics)
+    state = PipelineState(args.ribo, args.reference, args.mouse,
+                          coverage_path=None if 'coverage' in args.stages else args.coverage)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if 'coverage' in args.stages:
+        offset_mode = {mode: i for i, mode in OFFSET_MODES.items()}[args.offset]
+        output_path = args.coverage if 'coverage' in args.save else None
+        if args.from_read_lengths:
+            run_projection_stage(state, args.from_read_lengths, args.min_len, args.max_len, offset_mode, output_path)
+        else:
+            run_coverage_stage(state, args.min_len, args.max_len, offset_mode, output_path,
+                               flank=args.flank if args.keep_read_lengths else None)
+
+    if 'occupancy' in args.stages:
+        run_occupancy_stage(state, 1 if args.separate_start_codon else 2,
+                            output_path=os.path.join(args.output_dir, 'codon_occupancy.csv') if 'occupancy' in args.save else None)
+
+    if 'heatmap' in args.stages:
+        experiments = [replicates.split() for replicates in args.experiments]
+        run_heatmap_stage(state, experiments, args.num_transcripts, args.percentile,
+                          output_path=os.path.join(args.output_dir, 'codon_heatmaps.xlsx') if 'heatmap' in args.save else None)
+
+    logging.info("Pipeline finished.")
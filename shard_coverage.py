@@ -0,0 +1,48 @@
+import argparse
+import logging
+from functions_coverage import DEFAULT_FLANK
+from functions_shard import SHARD_MODES, OFFSET_MODES, run_shard, merge_shards
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Computes the adjusted coverage of a ribo file in shards that run independently, e.g., on different nodes, '
+                    'and merges the shards into one coverage output.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Compute the coverage of one shard into its own coverage store.')
+    run.add_argument('--ribo', required=True, help="Ribo file path, e.g., '/home/all.ribo'.")
+    run.add_argument('--mouse', action='store_true', help='Use the APRIS human/mouse alias for transcript names.')
+    run.add_argument('--min-len', type=int, required=True, help='Minimum read length to be analyzed.')
+    run.add_argument('--max-len', type=int, required=True, help='Maximum read length to be analyzed.')
+    run.add_argument('--offset', choices=list(OFFSET_MODES.values()), default='psite', help='Offset mode (default: psite).')
+    run.add_argument('--shard', type=int, required=True, help='Index of the shard, from 0 to --shards - 1.')
+    run.add_argument('--shards', type=int, required=True, help='Number of shards.')
+    run.add_argument('--by', choices=SHARD_MODES, default='transcripts',
+                     help='Split the transcripts into shards of equal total CDS length, or split the experiments (default: transcripts).')
+    run.add_argument('--output', required=True, help='Directory of the coverage store of the shard. An interrupted shard is resumed.')
+    run.add_argument('--keep-read-lengths', action='store_true', help='Also keep the coverage of each read length, see run_pipeline.py.')
+    run.add_argument('--flank', type=int, default=DEFAULT_FLANK,
+                     help=f'Nucleotides kept upstream of each CDS with --keep-read-lengths (default: {DEFAULT_FLANK}).')
+    run.add_argument('--workers', type=int, help='Number of worker processes (default: number of CPUs).')
+
+    merge = commands.add_parser('merge', help='Check that all shards are complete and merge them.')
+    merge.add_argument('shards', nargs='+', help='Coverage store directories of all shards.')
+    merge.add_argument('--output', required=True, help='Coverage store directory, or gzipped pickle file if it ends with .pkl.gz.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run' and not 0 <= args.shard < args.shards:
+        parser.error('--shard must be from 0 to --shards - 1')
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'run':
+        offset_mode = {mode: i for i, mode in OFFSET_MODES.items()}[args.offset]
+        run_shard(args.ribo, args.mouse, args.min_len, args.max_len, offset_mode, args.shard, args.shards, args.output,
+                  by=args.by, flank=args.flank if args.keep_read_lengths else None, num_workers=args.workers)
+        logging.info(f"Saved shard {args.shard} as {args.output}.")
+    else:
+        merge_shards(args.shards, args.output)